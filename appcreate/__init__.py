@@ -25,6 +25,18 @@ from imgcreate.fs import *
 from imgcreate.debug import *
 from appcreate.appliance import *
 from appcreate.partitionedfs import *
+from appcreate.partitiontable import *
+from appcreate.superblock import *
+from appcreate.compress import *
+from appcreate.qcow2 import *
+from appcreate.vmdk import *
+from appcreate.ova import *
+from appcreate.checksum import *
+from appcreate.cache import *
+from appcreate.state import *
+from appcreate.batch import *
+from appcreate.treecopy import *
+from appcreate.parallel import default_workers
 
 """A set of classes for building Fedora applinace images.
 
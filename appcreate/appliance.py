@@ -26,12 +26,29 @@ import tarfile
 import subprocess
 import logging
 import re
+import hashlib
+import xml.sax.saxutils
 
 from imgcreate.errors import *
 from imgcreate.fs import *
 from imgcreate.creator import *
 from appcreate.partitionedfs import *
-import urlgrabber.progress as progress
+from appcreate.parallel import parallel_map, default_workers
+from appcreate.compress import BlockCompressor, COMPRESSORS, DEFAULT_BLOCK_SIZE
+from appcreate.checksum import MultiHasher, checksum_file, DEFAULT_CHECKSUMS
+from appcreate.archive import SparseZipFile, add_to_tar, open_tar
+from appcreate.partitiontable import set_bootable
+from appcreate.stats import Stats
+from appcreate.loop import PooledLoopbackDisk
+from appcreate.bootcode import install_grub2_bios
+from appcreate.qcow2 import Qcow2Writer
+from appcreate.vmdk import StreamVmdkWriter, VMDK_FORMAT_URL
+from appcreate.ova import OvaArchive
+from appcreate.cache import repo_metadata_digest, code_digest, digest_path, \
+     digest_root, snapshot_root, restore_root
+
+# the grub2 modules and images for BIOS booting inside the installed tree
+GRUB2_MODULES = "/usr/lib/grub/i386-pc"
 
 class ApplianceImageCreator(ImageCreator):
     """Installs a system into a file containing a partitioned disk image.
@@ -46,7 +63,10 @@ class ApplianceImageCreator(ImageCreator):
     def __init__(self, ks, name, disk_format, vmem, vcpu):
         """Initialize a ApplianceImageCreator instance.
 
-        This method takes the same arguments as ImageCreator.__init__()
+        This method takes the same arguments as ImageCreator.__init__(),
+        plus the disk format(s) to produce. disk_format may be a single
+        format, a comma separated list of formats or a list; every disk
+        is produced in every format.
 
         """
         ImageCreator.__init__(self, ks, name)
@@ -54,14 +74,53 @@ class ApplianceImageCreator(ImageCreator):
         self.__instloop = None
         self.__imgdir = None
         self.__disks = {}
-        self.__disk_format = disk_format
+        if isinstance(disk_format, basestring):
+            disk_format = disk_format.split(",")
+        self.__disk_formats = []
+        for fmt in disk_format:
+            fmt = fmt.strip()
+            if fmt and not fmt in self.__disk_formats:
+                self.__disk_formats.append(fmt)
+        if not self.__disk_formats:
+            self.__disk_formats = ["raw"]
 
         #appliance parameters
         self.vmem = vmem
         self.vcpu = vcpu
         self.checksum = False
+        self.checksum_types = list(DEFAULT_CHECKSUMS)
         self.appliance_version = None
         self.appliance_release = None
+        # number of concurrent workers, None means one per cpu
+        self.jobs = None
+        # filesystem UUIDs are derived from this when set, random otherwise
+        self.uuid_seed = None
+        # compression applied to raw disks, None leaves them uncompressed
+        self.compression = "xz"
+        self.compress_block_size = DEFAULT_BLOCK_SIZE
+        # "native" writes compressed qcow2 itself, "qemu-img" runs qemu-img
+        self.qcow2_writer = "native"
+        self.__convert_workers = None
+        self.__compressed = {}
+        self.__checksums = {}
+        # when streaming, raw disks are archived straight from the loop files
+        self.__streaming = False
+        # timing and resource usage of every build phase
+        self.stats = Stats()
+        # ContentCache of finished packages, None disables caching
+        self.artifact_cache = None
+        # ContentCache of installed roots, None always installs with yum
+        self.root_cache = None
+        # BuildState kept to resume the build after a failure, or None
+        self.state = None
+        # "loop" installs into loop mounted partitions, "directory" into
+        # a plain tree the disk images are built from afterwards
+        self.backend = "loop"
+        # shrink the disks to what they hold plus shrink_headroom percent
+        self.shrink = False
+        self.shrink_headroom = 10
+        self.__shrunk = False
+        self.__artifact_keys = {}
 
         #additional modules to include
         self.modules = ["sym53c8xx", "aic7xxx", "mptspi"]
@@ -70,6 +129,53 @@ class ApplianceImageCreator(ImageCreator):
         # This determines which partition layout we'll be using
         self.bootloader = None
 
+    def install(self, repo_urls = {}):
+        """Install the packages into the mounted partitions.
+
+        With a root cache the installed root is restored from a snapshot
+        when an earlier build installed the same packages from the same
+        repo metadata on the same starting tree; otherwise the packages
+        are installed with yum and a snapshot is taken before %post runs.
+        """
+        key = self.__root_key()
+        if key:
+            with self.root_cache.entry(key) as entry:
+                if entry is not None:
+                    logging.info("Restoring installed root from snapshot %s" % key)
+                    with self.stats.phase("root-restore"):
+                        restore_root(os.path.join(entry, "root.tar.zst"), self._instroot)
+                    return
+            logging.info("Installed root snapshot cache miss for %s" % key)
+
+        ImageCreator.install(self, repo_urls)
+
+        if key:
+            with self.stats.phase("root-snapshot"):
+                tmp = self.root_cache.mkdtemp()
+                try:
+                    snapshot = os.path.join(tmp, "root.tar.zst")
+                    snapshot_root(self._instroot, snapshot, self.jobs)
+                    self.root_cache.store(key, [snapshot], {"name": self.name},
+                                          move = True)
+                finally:
+                    shutil.rmtree(tmp, ignore_errors = True)
+
+    def __root_key(self):
+        """Returns the digest of everything which determines the installed
+        root, or None without a root cache or repo metadata."""
+        if self.root_cache is None:
+            return None
+        repos = repo_metadata_digest(self.ks, getattr(self, "releasever", None))
+        if repos is None:
+            logging.info("Not using the root cache, repo metadata unavailable")
+            return None
+        h = hashlib.sha256()
+        h.update("%s\0%s\0%s\0" % (repos, os.uname()[4], self.ks.handler.packages))
+        # what the creator wrote before installing (mkinitrd config,
+        # ...) feeds the package scriptlets, so it is part of the key
+        digest_root(h, self._instroot)
+        return h.hexdigest()
+
     def _get_fstab(self):
         s = ""
         for mp in self.__instloop.mountOrder:
@@ -112,9 +218,18 @@ class ApplianceImageCreator(ImageCreator):
     #
     # Actual implementation
     #
-    def _mount_instroot(self, base_on = None):
-        self.__imgdir = self._mkdtemp()
-
+    def __get_outdir(self):
+        # a kept build stages its files next to its disks, so that what
+        # was converted or compressed before a failure is not lost
+        if self.state is not None:
+            return self.state.out_dir
+        return ImageCreator._outdir.fget(self)
+    _outdir = property(__get_outdir)
+
+    def __resuming(self):
+        return self.state is not None and self.state.done("install")
+
+    def _get_partitions(self):
         #list of partitions from kickstart file
         parts = kickstart.get_partitions(self.ks)
         # need to eliminate duplicate partitions
@@ -129,6 +244,9 @@ class ApplianceImageCreator(ImageCreator):
                 mountpoints.append(mp)
         for part in toremove:
             parts.remove(part)
+        return parts
+
+    def _get_disks(self, parts):
         #list of disks where a disk is an dict with name: and size
         disks = []
 
@@ -153,14 +271,11 @@ class ApplianceImageCreator(ImageCreator):
                     else: found = 'false'
                 if found == 'false':
                     disks.append({ 'name': disk, 'size': size })
+        return disks
 
-        #create disk
-        for item in disks:
-            logging.debug("Adding disk %s as %s/%s-%s.raw" % (item['name'], self.__imgdir, self.name, item['name']))
-            disk = SparseLoopbackDisk("%s/%s-%s.raw" % (self.__imgdir, self.name, item['name']), item['size'])
-            self.__disks[item['name']] = disk
-
-
+    def _get_bootloader(self):
+        """Returns the bootloader and the partition layout it needs."""
+        bootloader = None
         # Search for bootloader package in package list
         packages = kickstart.get_packages(self.ks)
         # make this the default
@@ -168,37 +283,154 @@ class ApplianceImageCreator(ImageCreator):
         # check for extlinux in kickstart then grub2 and falling back to grub
         if hasattr(self.ks.handler.bootloader, "extlinux"):
             if 'syslinux-extlinux' in packages:
-                self.bootloader = 'extlinux'
+                bootloader = 'extlinux'
             elif 'extlinux-bootloader' in packages:
-                self.bootloader = 'extlinux-bootloader'
+                bootloader = 'extlinux-bootloader'
             else:
                 logging.warning("WARNING! syslinux-extlinux package not found.")
         else:
             if 'grub2' in packages:
-                self.bootloader = 'grub2'
+                bootloader = 'grub2'
                 partition_layout = 'gpt'
             elif 'grub' in packages:
-                self.bootloader = 'grub'
+                bootloader = 'grub'
             else:
                 logging.warning("WARNING! grub package not found.")
+        return (bootloader, partition_layout)
 
-        self.__instloop = PartitionedMount(self.__disks,
-                                           self._instroot,
-                                           partition_layout)
+    def __check_backend(self):
+        if self.backend != "directory":
+            return
+        if self.state is not None:
+            raise CreatorError("Builds of the directory backend cannot be kept or resumed")
+        if self.bootloader in ('grub', 'extlinux'):
+            raise CreatorError("The %s bootloader can only be installed with the loop backend" %
+                               self.bootloader)
+
+    def _mount_instroot(self, base_on = None):
+        if self.state is not None:
+            self.__imgdir = self.state.disk_dir
+        else:
+            self.__imgdir = self._mkdtemp()
+
+        parts = self._get_partitions()
+        disks = self._get_disks(parts)
+
+        #create disk
+        for item in disks:
+            logging.debug("Adding disk %s as %s/%s-%s.raw" % (item['name'], self.__imgdir, self.name, item['name']))
+            disk = PooledLoopbackDisk("%s/%s-%s.raw" % (self.__imgdir, self.name, item['name']), item['size'])
+            self.__disks[item['name']] = disk
+
+        (self.bootloader, partition_layout) = self._get_bootloader()
+        self.__check_backend()
+
+        if self.backend == "directory":
+            self.__instloop = DirectoryPartitionedMount(self.__disks,
+                                                        self._instroot,
+                                                        partition_layout)
+        else:
+            self.__instloop = PartitionedMount(self.__disks,
+                                               self._instroot,
+                                               partition_layout)
+        self.__instloop.jobs = self.jobs
+        self.__instloop.uuid_seed = self.uuid_seed
+        self.__instloop.stats = self.stats
+
+        fsuuids = {}
+        if self.__resuming():
+            # the disks of the kept build are mounted again as they are
+            logging.info("Resuming build %s" % self.state.build_id)
+            self.__instloop.existing = True
+            fsuuids = self.state.data["fsuuids"]
 
         for p in parts:
-            if p.disk:
-                self.__instloop.add_partition(int(p.size), p.disk, p.mountpoint, p.fstype)
-            else:
-                self.__instloop.add_partition(int(p.size), "sda", p.mountpoint, p.fstype)
+            disk = p.disk or "sda"
+            fsuuid = fsuuids.get("%s:%s" % (disk, p.mountpoint))
+            self.__instloop.add_partition(int(p.size), disk, p.mountpoint, p.fstype, fsuuid)
 
         try:
             self.__instloop.mount()
         except MountError, e:
             raise CreatorError("Failed mount disks : %s" % e)
 
+        if self.__resuming():
+            return
+
         self._create_mkinitrd_config()
 
+        if self.state is not None:
+            disk_sizes = {}
+            for item in disks:
+                disk_sizes[item['name']] = item['size']
+            for p in self.__instloop.partitions:
+                fsuuids["%s:%s" % (p['disk'], p['mountpoint'])] = p['fsuuid']
+            self.state.update(disks = disk_sizes, fsuuids = fsuuids)
+
+    def plan(self):
+        """Work out the disks, partitions, bootloader and configs the build
+        would produce, without creating, mounting or installing anything,
+        so it needs neither root nor disk space. The kernel version in the
+        bootloader configs is a placeholder. Returns a dict describing the
+        appliance."""
+        parts = self._get_partitions()
+        disks = self._get_disks(parts)
+        for item in disks:
+            self.__disks[item['name']] = PooledLoopbackDisk("%s-%s.raw" % (self.name, item['name']), item['size'])
+        (self.bootloader, partition_layout) = self._get_bootloader()
+        self.__check_backend()
+        if not [p for p in parts if p.mountpoint == "/"]:
+            raise CreatorError("No / partition in the kickstart file")
+
+        self.__instloop = PartitionedMount(self.__disks, "/", partition_layout)
+        self.__instloop.uuid_seed = self.uuid_seed
+        for p in parts:
+            self.__instloop.add_partition(int(p.size), p.disk or "sda", p.mountpoint, p.fstype)
+        try:
+            self.__instloop.plan()
+        except MountError, e:
+            raise CreatorError("Failed to plan disks : %s" % e)
+
+        planned = []
+        for item in disks:
+            d = self.__instloop.disks[item['name']]
+            partitions = []
+            for n in d['partitions']:
+                p = self.__instloop.partitions[n]
+                partitions.append({ 'num': p['num'],
+                                    'type': p['type'],
+                                    'mountpoint': p['mountpoint'],
+                                    'fstype': p['fstype'],
+                                    'size': p['size'],
+                                    'start': p['table']['start'],
+                                    'sectors': p['table']['sectors'],
+                                    'uuid': p['fsuuid'] })
+            planned.append({ 'name': item['name'],
+                             'file': d['disk'].lofile,
+                             'size': item['size'],
+                             'partitions': partitions })
+
+        versions = ["KERNEL_VERSION"]
+        initrd = "initramfs"
+        configs = [("/etc/fstab", self._get_fstab()),
+                   ("/boot/grub/grub.conf", self._get_grub_config(versions, initrd))]
+        if self.bootloader == 'grub2':
+            if self.backend == "directory":
+                configs.append(("/boot/grub2/grub.cfg", self._get_grub2_config(versions, initrd)))
+            else:
+                configs.append(("/boot/grub2/grub.cfg", "# generated by grub2-mkconfig during the build\n"))
+        elif self.bootloader in ('extlinux', 'extlinux-bootloader'):
+            configs.append(("/boot/extlinux/extlinux.conf", self._get_extlinux_config(versions, initrd)))
+
+        return { 'name': self.name,
+                 'bootloader': self.bootloader,
+                 'layout': partition_layout,
+                 'backend': self.backend,
+                 'formats': self.__disk_formats,
+                 'disks': planned,
+                 'mount_order': self.__instloop.mountOrder,
+                 'configs': configs }
+
     def _create_grub_devices(self, grubversion = 1):
         devs = []
         parts = kickstart.get_partitions(self.ks)
@@ -251,7 +483,22 @@ class ApplianceImageCreator(ImageCreator):
 
         return (bootdevnum, rootdevnum, rootdev, prefix)
 
-    def _create_grub_config(self):
+    def _get_kernels(self):
+        """Returns the installed kernel versions and the prefix of their
+        initial ramdisks."""
+        versions = []
+        kernels = self._get_kernel_versions()
+        for kernel in kernels:
+            for version in kernels[kernel]:
+                versions.append(version)
+
+        if glob.glob(self._instroot + "/boot/initramfs*"):
+            initrd = "initramfs"
+        else:
+            initrd = "initrd"
+        return (versions, initrd)
+
+    def _get_grub_config(self, versions, initrd):
         (bootdevnum, rootdevnum, rootdev, prefix) = self._get_grub_boot_config()
         options = self.ks.handler.bootloader.appendLine
 
@@ -265,22 +512,16 @@ class ApplianceImageCreator(ImageCreator):
         grub += "splashimage=(hd0,%d)%s/grub/splash.xpm.gz\n" % (bootdevnum, prefix)
         grub += "hiddenmenu\n"
 
-        versions = []
-        kernels = self._get_kernel_versions()
-        for kernel in kernels:
-            for version in kernels[kernel]:
-                versions.append(version)
-
-        if int(subprocess.Popen("ls " + self._instroot + "/boot/initramfs* | wc -l", shell=True, stdout=subprocess.PIPE).communicate()[0].strip()) > 0:
-            initrd = "initramfs"
-        else:
-            initrd = "initrd"
-
         for v in versions:
             grub += "title %s (%s)\n" % (self.name, v)
             grub += "        root (hd0,%d)\n" % bootdevnum
             grub += "        kernel %s/vmlinuz-%s ro root=%s %s\n" % (prefix, v, rootdev, options)
             grub += "        initrd %s/%s-%s.img\n" % (prefix, initrd, v)
+        return grub
+
+    def _create_grub_config(self):
+        (versions, initrd) = self._get_kernels()
+        grub = self._get_grub_config(versions, initrd)
 
         logging.debug("Writing grub config %s/boot/grub/grub.conf" % self._instroot)
         if not os.path.isdir(self._instroot + "/boot/grub/"):
@@ -311,7 +552,7 @@ class ApplianceImageCreator(ImageCreator):
 
         return (bootdevnum, rootdevnum, rootdev, prefix)
 
-    def _create_extlinux_config(self):
+    def _get_extlinux_config(self, versions, initrd):
         (bootdevnum, rootdevnum, rootdev, prefix) = self._get_grub_boot_config()
         options = self.ks.handler.bootloader.appendLine
         # Search for bootloader package in package list
@@ -325,17 +566,6 @@ class ApplianceImageCreator(ImageCreator):
         extlinux += "timeout 20\n"
         extlinux += "totaltimeout 600\n\n"
 
-        versions = []
-        kernels = self._get_kernel_versions()
-        for kernel in kernels:
-            for version in kernels[kernel]:
-                versions.append(version)
-
-        if int(subprocess.Popen("ls " + self._instroot + "/boot/initramfs* | wc -l", shell=True, stdout=subprocess.PIPE).communicate()[0].strip()) > 0:
-            initrd = "initramfs"
-        else:
-            initrd = "initrd"
-
         for v in versions:
             extlinux += "label %s (%s)\n" % (self.name, v)
             extlinux += "\tkernel %s/vmlinuz-%s\n" % (prefix, v)
@@ -343,7 +573,11 @@ class ApplianceImageCreator(ImageCreator):
             if 'extlinux-bootloader' in packages:
                 extlinux += "\tfdtdir %s/dtb-%s/\n" % (prefix, v)
             extlinux += "\tinitrd %s/%s-%s.img\n\n" % (prefix, initrd, v)
+        return extlinux
 
+    def _create_extlinux_config(self):
+        (versions, initrd) = self._get_kernels()
+        extlinux = self._get_extlinux_config(versions, initrd)
 
         logging.debug("Writing extlinux config %s/boot/extlinux/extlinux.conf" % self._instroot)
         cfg = open(self._instroot + "/boot/extlinux/extlinux.conf", "w")
@@ -391,11 +625,12 @@ class ApplianceImageCreator(ImageCreator):
 
         subprocess.call(["mount", "--bind", "/dev", self._instroot + "/dev"])
 
-        grub = subprocess.Popen(["chroot", self._instroot, "/sbin/grub", "--batch", "--no-floppy"],
-                                stdin=subprocess.PIPE)
+        with self.stats.phase("grub-install"):
+            grub = subprocess.Popen(["chroot", self._instroot, "/sbin/grub", "--batch", "--no-floppy"],
+                                    stdin=subprocess.PIPE)
 
-        grub.communicate(setup)
-        rc = grub.wait()
+            grub.communicate(setup)
+            rc = grub.wait()
 
         subprocess.call(["umount", self._instroot + "/dev"])
 
@@ -417,7 +652,8 @@ class ApplianceImageCreator(ImageCreator):
         # mount full /dev filesystem
         subprocess.call(["mount", "--bind", "/dev", self._instroot + "/dev"])
 
-        rc = subprocess.call(["chroot", self._instroot, "grub2-install", "--no-floppy", "--grub-mkdevicemap=/boot/grub2/device.map", loopdev])
+        with self.stats.phase("grub2-install"):
+            rc = subprocess.call(["chroot", self._instroot, "grub2-install", "--no-floppy", "--grub-mkdevicemap=/boot/grub2/device.map", loopdev])
 
         if rc != 0:
             subprocess.call(["umount", self._instroot + "/dev"])
@@ -427,7 +663,8 @@ class ApplianceImageCreator(ImageCreator):
         logging.debug("Generating grub2 configuration file...")
 
         # Generating grub2 config file
-        subprocess.call(["chroot", self._instroot, "grub2-mkconfig", "-o", "/boot/grub2/grub.cfg"])
+        with self.stats.phase("grub2-mkconfig"):
+            subprocess.call(["chroot", self._instroot, "grub2-mkconfig", "-o", "/boot/grub2/grub.cfg"])
 
         # umount /dev filesystem
         subprocess.call(["umount", self._instroot + "/dev"])
@@ -457,6 +694,109 @@ class ApplianceImageCreator(ImageCreator):
 
         logging.debug("Grub2 configuration file generated.")
 
+    def _prepare_grub2_image(self):
+        """Set up grub2 for a disk image which is only assembled later:
+        write grub.cfg, copy the modules and build core.img, all inside
+        the tree. The boot code is written by __build_disks()."""
+        (bootdevnum, rootdevnum, rootdev, prefix) = self._get_grub_boot_config()
+        bootpartition = self.__instloop.partitions[bootdevnum]
+
+        grubdir = self._instroot + "/boot/grub2/i386-pc"
+        moddir = self._instroot + GRUB2_MODULES
+        if not os.path.isdir(moddir):
+            raise CreatorError("grub2 not installed : %s not found" % moddir)
+        if not os.path.isdir(grubdir):
+            os.makedirs(grubdir)
+        for f in os.listdir(moddir):
+            if os.path.isfile(os.path.join(moddir, f)):
+                shutil.copy(os.path.join(moddir, f), grubdir)
+
+        logging.debug("Building grub2 core.img for (hd0,gpt%d)" % bootpartition['num'])
+        with self.stats.phase("grub2-mkimage"):
+            rc = subprocess.call(["chroot", self._instroot, "grub2-mkimage",
+                                  "-O", "i386-pc", "-d", GRUB2_MODULES,
+                                  "-o", "/boot/grub2/i386-pc/core.img",
+                                  "-p", "(hd0,gpt%d)%s/grub2" % (bootpartition['num'], prefix),
+                                  "biosdisk", "part_gpt", "ext2"])
+        if rc != 0:
+            raise MountError("Unable to build grub2 core.img")
+
+        (versions, initrd) = self._get_kernels()
+        grub = self._get_grub2_config(versions, initrd)
+
+        logging.debug("Writing grub2 config %s/boot/grub2/grub.cfg" % self._instroot)
+        cfg = open(self._instroot + "/boot/grub2/grub.cfg", "w")
+        cfg.write(grub)
+        cfg.close()
+
+    def _get_grub2_config(self, versions, initrd):
+        """The grub.cfg of the directory backend; grub2-mkconfig probes the
+        mounted devices and there are none."""
+        (bootdevnum, rootdevnum, rootdev, prefix) = self._get_grub_boot_config()
+        bootpartition = self.__instloop.partitions[bootdevnum]
+        options = self.ks.handler.bootloader.appendLine
+
+        grub = ""
+        grub += "set default=0\n"
+        grub += "set timeout=5\n"
+        grub += "insmod part_gpt\n"
+        grub += "insmod ext2\n"
+        if bootpartition['fsuuid']:
+            grub += "search --no-floppy --fs-uuid --set=root %s\n" % bootpartition['fsuuid']
+        else:
+            grub += "set root=(hd0,gpt%d)\n" % bootpartition['num']
+        for v in versions:
+            grub += "menuentry '%s (%s)' {\n" % (self.name, v)
+            grub += "        linux %s/vmlinuz-%s ro root=%s %s\n" % (prefix, v, rootdev, options)
+            grub += "        initrd %s/%s-%s.img\n" % (prefix, initrd, v)
+            grub += "}\n"
+        return grub
+
+    def __build_disks(self):
+        """Assemble the disk images of the directory backend from the
+        tree, then write the grub2 boot code to them."""
+        if self.backend != "directory" or self.__instloop is None or self.__instloop.built:
+            return
+        self.__instloop.build_disks()
+        if self.bootloader != 'grub2':
+            return
+
+        biosboot = [p for p in self.__instloop.partitions if p['mountpoint'] == 'biosboot']
+        if not biosboot:
+            raise CreatorError("grub2 needs a biosboot partition to be installed "
+                               "with the directory backend")
+        p = biosboot[0]
+        grubdir = self._instroot + "/boot/grub2/i386-pc"
+        images = []
+        for f in ("boot.img", "core.img"):
+            img = open(os.path.join(grubdir, f), "rb")
+            try:
+                images.append(img.read())
+            finally:
+                img.close()
+        with self.stats.phase("grub2-install"):
+            install_grub2_bios(self.__disks[p['disk']].lofile, images[0], images[1],
+                               p['table']['start'], p['table']['sectors'])
+        logging.debug("Grub2 installed.")
+
+    def __shrink_disks(self):
+        """Shrink the finished disks to what their filesystems hold."""
+        if not self.shrink or self.__instloop is None or self.__shrunk:
+            return
+        pinned = []
+        if self.bootloader == 'extlinux':
+            # extlinux recorded the sectors of ldlinux.sys in the boot
+            # partition, so it must neither move nor be resized
+            mountpoints = [p['mountpoint'] for p in self.__instloop.partitions]
+            if "/boot" in mountpoints:
+                pinned.append("/boot")
+            else:
+                pinned.append("/")
+        with self.stats.phase("shrink"):
+            saved = self.__instloop.shrink(self.shrink_headroom, pinned)
+        logging.info("Shrinking saved %d MB of disk" % (saved / 1024 / 1024))
+        self.__shrunk = True
+
     def _install_extlinux(self):
         i = 0
         for name in self.__disks.keys():
@@ -475,21 +815,7 @@ class ApplianceImageCreator(ImageCreator):
             raise MountError("Unable to set MBR to %s" % loopdev)
 
         # Set Bootable flag
-        parted = "/usr/sbin/parted"
-        if not os.path.exists(parted):
-            parted = "/sbin/parted"
-            if not os.path.exists(parted):
-                raise CreatorError("Missed parted, please install it.")
-        dev_null = os.open("/dev/null", os.O_WRONLY)
-        rc = subprocess.call([parted, "-s", loopdev, "set", "%d" % (bootdevnum + 1), "boot", "on"],
-                             stdout = dev_null, stderr = dev_null)
-        os.close(dev_null)
-        # XXX disabled return code check because parted always fails to
-        # reload part table with loop devices. Annoying because we can't
-        # distinguish this failure from real partition failures :-(
-        if rc != 0 and 1 == 0:
-            raise MountError("Unable to set bootable flag to %sp%d" % (loopdev, (bootdevnum + 1)))
-
+        set_bootable(loopdev, bootdevnum + 1)
 
         # Ensure all data is flushed to disk before doing extlinux install
         subprocess.call(["sync"])
@@ -499,7 +825,8 @@ class ApplianceImageCreator(ImageCreator):
             fullpathextlinux = "/usr/sbin/extlinux"
             if not os.path.isfile(fullpathextlinux):
                 fullpathextlinux = "/usr/bin/extlinux"
-        rc = subprocess.call([fullpathextlinux, "-i", "%s/boot/extlinux" % self._instroot])
+        with self.stats.phase("extlinux-install"):
+            rc = subprocess.call([fullpathextlinux, "-i", "%s/boot/extlinux" % self._instroot])
         if rc != 0:
             raise MountError("Unable to install extlinux bootloader to %sp)d" % (loopdev, (bootdevnum + 1)))
 
@@ -509,36 +836,50 @@ class ApplianceImageCreator(ImageCreator):
         self._write_kickstart()
         # For EC2 lets always make a grub Legacy config file
         logging.debug("Writing GRUB Legacy config.")
-        self._create_grub_config()
+        with self.stats.phase("grub-legacy-config"):
+            self._create_grub_config()
 
         if self.bootloader == 'grub2':
             # We have GRUB2 package installed
             # Most probably this is Fedora 16+
             logging.debug("Using GRUB2.")
-            self._create_grub_devices(2)
-            self._install_grub2()
+            with self.stats.phase("bootloader-config", bootloader="grub2"):
+                self._create_grub_devices(2)
+            if self.backend == "directory":
+                self._prepare_grub2_image()
+            else:
+                self._install_grub2()
         elif self.bootloader == 'grub':
             # We have GRUB Legacy installed
             logging.debug("Using GRUB Legacy.")
-            self._create_grub_devices()
-            self._copy_grub_files()
+            with self.stats.phase("bootloader-config", bootloader="grub"):
+                self._create_grub_devices()
+                self._copy_grub_files()
             self._install_grub()
         elif self.bootloader == 'extlinux':
             logging.debug("Using EXTLINUX.")
-            self._create_extlinux_config()
+            with self.stats.phase("bootloader-config", bootloader="extlinux"):
+                self._create_extlinux_config()
             self._install_extlinux()
         elif self.bootloader == 'extlinux-bootloader':
             logging.debug("Using EXTLINUX from extlinux-bootloader package.")
-            self._create_extlinux_config()
+            with self.stats.phase("bootloader-config", bootloader="extlinux"):
+                self._create_extlinux_config()
         else:
             # No GRUB package is available
             logging.warning("WARNING! No bootloader found.")
 
     def _unmount_instroot(self):
         if not self.__instloop is None:
+            # trim while the filesystems are still mounted, afterwards
+            # there is nothing left to discard the free blocks through
+            self.__instloop.resparse()
             self.__instloop.cleanup()
 
     def _resparse(self, size = None):
+        if self.__instloop is None:
+            # resumed after the disks were unmounted
+            return 0
         return self.__instloop.resparse(size)
 
     def package(self, destdir, package, include):
@@ -546,10 +887,87 @@ class ApplianceImageCreator(ImageCreator):
            Stage
            add includes
            package
+
+           If destdir is "fd:N" a tar package is written as a single
+           forward only stream to file descriptor N instead, see
+           _stream_package().
         """
-        self._stage_final_image()
+        if destdir.startswith("fd:"):
+            return self._stream_package(int(destdir[3:]), package, include)
+
+        if package == "ova":
+            with self.stats.phase("archive", package=package):
+                dst = self._write_ova(destdir)
+        else:
+            self._stage_final_image()
+
+            #add stuff
+            if include:
+                with self.stats.phase("include"):
+                    self._copy_include(include)
+
+            #package
+            with self.stats.phase("archive", package=package):
+                dst = self._archive(destdir, package)
+
+        key = self.__artifact_key(package, include)
+        if key:
+            with self.stats.phase("cache-store"):
+                self.artifact_cache.store(key, [dst], {"name": self.name,
+                                                       "package": package,
+                                                       "formats": self.__disk_formats})
+        print "Finished"
+
+    def __artifact_key(self, package, include):
+        """Returns the digest of everything which determines the package,
+        or None when there is no artifact cache or the repo metadata
+        cannot be fetched."""
+        if self.artifact_cache is None:
+            return None
+        if self.__artifact_keys.has_key(package):
+            return self.__artifact_keys[package]
+
+        key = None
+        repos = repo_metadata_digest(self.ks, getattr(self, "releasever", None))
+        if repos is None:
+            logging.info("Not using the artifact cache, repo metadata unavailable")
+        else:
+            h = hashlib.sha256()
+            for value in (code_digest(), repos, str(self.ks.handler), self.name,
+                          ",".join(self.__disk_formats), package, self.vmem, self.vcpu,
+                          self.appliance_version, self.appliance_release,
+                          self.compression, self.compress_block_size,
+                          self.checksum, ",".join(self.checksum_types),
+                          self.uuid_seed, self.backend, self.qcow2_writer,
+                          self.shrink, self.shrink_headroom):
+                h.update("%s\0" % (value,))
+            if include:
+                digest_path(h, include)
+            key = h.hexdigest()
+        self.__artifact_keys[package] = key
+        return key
+
+    def restore_package(self, destdir, package, include):
+        """Copy the package of an identical earlier build from the
+        artifact cache into destdir.
+
+        Returns True on a cache hit, the appliance then needs neither to
+        be installed nor packaged. Streamed packages are never cached.
+        """
+        if destdir.startswith("fd:"):
+            return False
+        key = self.__artifact_key(package, include)
+        if key is None:
+            return False
+        with self.stats.phase("cache-restore"):
+            restored = self.artifact_cache.restore(key, destdir)
+        if restored is None:
+            logging.info("Artifact cache miss for %s" % key)
+            return False
+        print "Finished"
+        return True
 
-        #add stuff
+    def _copy_include(self, include):
         if include and os.path.isdir(include):
             logging.debug("adding everything in %s to %s" % (include, self._outdir))
             files = glob.glob('%s/*' % include)
@@ -564,7 +982,9 @@ class ApplianceImageCreator(ImageCreator):
             logging.debug("adding %s to %s" % (include, self._outdir))
             shutil.copy(include, self._outdir)
 
-        #package
+    def _archive(self, destdir, package):
+        """Package the staged files into destdir, returns the path of
+        the package (a file, or a directory for "none")."""
         (pkg, comp) = os.path.splitext(package)
         if comp:
             comp = comp.lstrip(".")
@@ -574,10 +994,10 @@ class ApplianceImageCreator(ImageCreator):
             files = glob.glob('%s/*' % self._outdir)
             if comp == "64":
                 logging.debug("creating %s with ZIP64 extensions" %  (dst))
-                z = zipfile.ZipFile(dst, "w", compression=8, allowZip64="True")
+                z = SparseZipFile(dst, "w", compression=8, allowZip64="True", workers=self.jobs)
             else:
                 logging.debug("creating %s" %  (dst))
-                z = zipfile.ZipFile(dst, "w", compression=8, allowZip64="False")
+                z = SparseZipFile(dst, "w", compression=8, allowZip64="False", workers=self.jobs)
             for file in files:
                 if file != dst:
                     if os.path.isdir(file):
@@ -592,6 +1012,7 @@ class ApplianceImageCreator(ImageCreator):
                         logging.debug("adding %s to %s" % (os.path.join(self.name, os.path.basename(file)), dst))
                         z.write(file, arcname = os.path.join(self.name, os.path.basename(file)), compress_type=None)
             z.close()
+            return dst
 
         elif pkg == "tar":
             if comp:
@@ -600,11 +1021,18 @@ class ApplianceImageCreator(ImageCreator):
                 dst = "%s/%s.tar" % (destdir, self.name)
             files = glob.glob('%s/*' % self._outdir)
             logging.debug("creating %s" %  (dst))
-            tar = tarfile.open(dst, "w|"+comp)
-            for file in files:
-                logging.debug("adding %s to %s" % (file, dst))
-                tar.add(file, arcname = os.path.join(self.name, os.path.basename(file)))
-            tar.close()
+            out = open(dst, "wb")
+            try:
+                (tar, compressor) = open_tar(out, comp, self.jobs)
+                for file in files:
+                    logging.debug("adding %s to %s" % (file, dst))
+                    add_to_tar(tar, file, os.path.join(self.name, os.path.basename(file)))
+                tar.close()
+                if compressor:
+                    compressor.close()
+            finally:
+                out.close()
+            return dst
 
         else:
             dst = os.path.join(destdir, self.name)
@@ -613,52 +1041,337 @@ class ApplianceImageCreator(ImageCreator):
             for f in os.listdir(self._outdir):
                 logging.debug("moving %s to %s" % (os.path.join(self._outdir, f), os.path.join(dst, f)))
                 shutil.move(os.path.join(self._outdir, f), os.path.join(dst, f))
-        print "Finished"
+        return dst
+
+    def _stream_package(self, fd, package, include):
+        """Write a tar package of the appliance to file descriptor fd.
+
+        Nothing is copied into the staging directory: raw disks are
+        archived straight from their loop files and included files from
+        where they are, so every byte is read exactly once and the output
+        can be piped to another program. The raw disks are checksummed
+        as they are archived and go first, the image xml holding their
+        checksums is written after them. A tar member needs its size up
+        front, so raw disks cannot be compressed on the way; the whole
+        stream is compressed by a tar.gz or tar.zst package instead.
+        """
+        (pkg, comp) = os.path.splitext(package)
+        if comp:
+            comp = comp.lstrip(".")
+        if pkg != "tar":
+            raise CreatorError("Streaming output requires a tar package, not %s" % package)
+        if self.compression and "raw" in self.__disk_formats:
+            raise CreatorError("Streaming raw disks requires compression none, not %s" %
+                               self.compression)
+
+        self.__streaming = True
+        self._stage_final_image()
+
+        out = os.fdopen(fd, "wb")
+        try:
+            with self.stats.phase("archive", package=package, streaming=True):
+                (tar, compressor) = open_tar(out, comp, self.jobs)
+                if "raw" in self.__disk_formats:
+                    for name in sorted(self.__disks.keys()):
+                        arcname = "%s-%s.raw" % (self.name, name)
+                        hasher = None
+                        if self.checksum and not self.__checksums.has_key((name, "raw")):
+                            hasher = MultiHasher(self.checksum_types)
+                        logging.debug("streaming %s as %s" % (self.__disks[name].lofile, arcname))
+                        add_to_tar(tar, self.__disks[name].lofile,
+                                   os.path.join(self.name, arcname), hasher)
+                        if hasher:
+                            self.__checksums[(name, "raw")] = hasher.hexdigests()
+                self._write_image_xml()
+
+                files = []
+                for f in sorted(os.listdir(self._outdir)):
+                    files.append((os.path.join(self._outdir, f), f))
+                if include and os.path.isdir(include):
+                    for f in sorted(os.listdir(include)):
+                        files.append((os.path.join(include, f), f))
+                elif include:
+                    files.append((include, os.path.basename(include)))
+                for (path, arcname) in files:
+                    logging.debug("streaming %s as %s" % (path, arcname))
+                    add_to_tar(tar, path, os.path.join(self.name, arcname))
+                tar.close()
+                if compressor:
+                    compressor.close()
+        finally:
+            out.close()
+        logging.info("Finished streaming %s package" % package)
+
+    def _write_ova(self, destdir):
+        """Write the appliance to destdir as an OVA holding an OVF
+        descriptor, a streamOptimized vmdk of every disk and a manifest.
+
+        The vmdks are written straight into the archive from the raw
+        disks and their digests computed on the way, so every disk is
+        read once. Returns the path of the OVA.
+        """
+        self.__build_disks()
+        self._resparse()
+        self.__shrink_disks()
+        if self.state is not None:
+            self.__load_state()
+
+        writer = StreamVmdkWriter(workers = self.jobs)
+        disks = []
+        for name in sorted(self.__disks.keys()):
+            disks.append((name, "%s-%s.vmdk" % (self.name, name),
+                          writer.capacity(self.__disks[name].lofile)))
+
+        dst = os.path.join(destdir, "%s.ova" % self.name)
+        logging.debug("creating %s" % dst)
+        ova = OvaArchive(dst, self.name)
+        ova.add_data("%s.ovf" % self.name, self._get_ovf(disks))
+        for (name, filename, capacity) in disks:
+            src = self.__disks[name].lofile
+            with self.stats.phase("convert", disk=name, format="vmdk", writer="native"):
+                ova.add_stream(filename, lambda out: writer.write(src, out, filename))
+        ova.close()
+        return dst
+
+    def _get_ovf(self, disks):
+        """Returns the OVF descriptor of the appliance, disks is a list
+        of (disk name, vmdk file name, capacity in bytes)."""
+        name = xml.sax.saxutils.escape(self.name)
+        nics = len(self.ks.handler.network.network)
+
+        ovf = '<?xml version="1.0" encoding="UTF-8"?>\n'
+        ovf += '<Envelope xmlns="http://schemas.dmtf.org/ovf/envelope/1"'
+        ovf += ' xmlns:ovf="http://schemas.dmtf.org/ovf/envelope/1"'
+        ovf += ' xmlns:rasd="http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_ResourceAllocationSettingData"'
+        ovf += ' xmlns:vssd="http://schemas.dmtf.org/wbem/wscim/1/cim-schema/2/CIM_VirtualSystemSettingData"'
+        ovf += ' xmlns:xsi="http://www.w3.org/2001/XMLSchema-instance">\n'
+        ovf += "  <References>\n"
+        for i in range(len(disks)):
+            ovf += "    <File ovf:id='file%d' ovf:href='%s'/>\n" % (i + 1, xml.sax.saxutils.escape(disks[i][1]))
+        ovf += "  </References>\n"
+        ovf += "  <DiskSection>\n"
+        ovf += "    <Info>Virtual disk information</Info>\n"
+        for i in range(len(disks)):
+            ovf += "    <Disk ovf:capacity='%d' ovf:capacityAllocationUnits='byte' ovf:diskId='vmdisk%d' ovf:fileRef='file%d' ovf:format='%s'/>\n" % (disks[i][2], i + 1, i + 1, VMDK_FORMAT_URL)
+        ovf += "  </DiskSection>\n"
+        if nics:
+            ovf += "  <NetworkSection>\n"
+            ovf += "    <Info>The list of logical networks</Info>\n"
+            ovf += "    <Network ovf:name='VM Network'>\n"
+            ovf += "      <Description>The VM Network network</Description>\n"
+            ovf += "    </Network>\n"
+            ovf += "  </NetworkSection>\n"
+        ovf += "  <VirtualSystem ovf:id='%s'>\n" % name
+        ovf += "    <Info>A virtual machine</Info>\n"
+        ovf += "    <Name>%s</Name>\n" % name
+        if self.appliance_version:
+            version = self.appliance_version
+            if self.appliance_release:
+                version += "-%s" % self.appliance_release
+            ovf += "    <ProductSection>\n"
+            ovf += "      <Info>Appliance information</Info>\n"
+            ovf += "      <Product>%s</Product>\n" % name
+            ovf += "      <Version>%s</Version>\n" % xml.sax.saxutils.escape(version)
+            ovf += "    </ProductSection>\n"
+        ovf += "    <OperatingSystemSection ovf:id='36'>\n"
+        ovf += "      <Info>The kind of installed guest operating system</Info>\n"
+        ovf += "    </OperatingSystemSection>\n"
+        ovf += "    <VirtualHardwareSection>\n"
+        ovf += "      <Info>Virtual hardware requirements</Info>\n"
+        ovf += "      <System>\n"
+        ovf += "        <vssd:ElementName>Virtual Hardware Family</vssd:ElementName>\n"
+        ovf += "        <vssd:InstanceID>0</vssd:InstanceID>\n"
+        ovf += "        <vssd:VirtualSystemIdentifier>%s</vssd:VirtualSystemIdentifier>\n" % name
+        ovf += "        <vssd:VirtualSystemType>vmx-07</vssd:VirtualSystemType>\n"
+        ovf += "      </System>\n"
+        items = []
+        items.append([("AllocationUnits", "hertz * 10^6"),
+                      ("Description", "Number of Virtual CPUs"),
+                      ("ElementName", "%s virtual CPU(s)" % self.vcpu),
+                      ("ResourceType", "3"),
+                      ("VirtualQuantity", "%s" % self.vcpu)])
+        items.append([("AllocationUnits", "byte * 2^20"),
+                      ("Description", "Memory Size"),
+                      ("ElementName", "%sMB of memory" % self.vmem),
+                      ("ResourceType", "4"),
+                      ("VirtualQuantity", "%s" % self.vmem)])
+        items.append([("Address", "0"),
+                      ("Description", "SCSI Controller"),
+                      ("ElementName", "SCSI Controller 0"),
+                      ("ResourceSubType", "lsilogic"),
+                      ("ResourceType", "6")])
+        controller = len(items)
+        for i in range(len(disks)):
+            # unit 7 is the controller itself
+            unit = i < 7 and i or i + 1
+            items.append([("AddressOnParent", "%d" % unit),
+                          ("ElementName", "Hard Disk %d" % (i + 1)),
+                          ("HostResource", "ovf:/disk/vmdisk%d" % (i + 1)),
+                          ("Parent", "%d" % controller),
+                          ("ResourceType", "17")])
+        for i in range(nics):
+            items.append([("AddressOnParent", "%d" % i),
+                          ("AutomaticAllocation", "true"),
+                          ("Connection", "VM Network"),
+                          ("ElementName", "Network adapter %d" % (i + 1)),
+                          ("ResourceSubType", "E1000"),
+                          ("ResourceType", "10")])
+        for i in range(len(items)):
+            # the CIM schema has the rasd elements in alphabetical order
+            fields = items[i] + [("InstanceID", "%d" % (i + 1))]
+            fields.sort()
+            ovf += "      <Item>\n"
+            for (key, value) in fields:
+                ovf += "        <rasd:%s>%s</rasd:%s>\n" % (key, value, key)
+            ovf += "      </Item>\n"
+        ovf += "    </VirtualHardwareSection>\n"
+        ovf += "  </VirtualSystem>\n"
+        ovf += "</Envelope>\n"
+        return ovf
 
     def _stage_final_image(self):
         """Stage the final system image in _outdir.
            Convert disks
            write meta data
         """
+        self.__build_disks()
         self._resparse()
+        self.__shrink_disks()
+
+        if self.state is not None:
+            self.__load_state()
+
+        #convert every disk to every non raw format and put in _outdir
+        self._convert_image()
+
+        #raw disks are compressed into _outdir
+        if "raw" in self.__disk_formats:
+            self._compress_image()
+        #write meta data in stage dir, a streamed package writes it once
+        #its raw disks are archived and checksummed
+        if not self.__streaming:
+            self._write_image_xml()
+
+    def __load_state(self):
+        """Pick up the disks, checksums and compressed images of the
+        kept build, the disks are not mounted when resuming after the
+        unmount phase."""
+        if not self.__disks:
+            self.__imgdir = self.state.disk_dir
+            for (name, size) in self.state.data["disks"].items():
+                self.__disks[name] = PooledLoopbackDisk("%s/%s-%s.raw" % (self.__imgdir, self.name, name), size)
+        for (key, digests) in self.state.data.get("checksums", {}).items():
+            self.__checksums[tuple(key.split(":", 1))] = digests
+        self.__compressed.update(self.state.data.get("compressed", {}))
+
+    def __checkpoint(self, step):
+        """Record step of the package phase as completed in the state."""
+        if self.state is None:
+            return
+        checksums = {}
+        for ((name, fmt), digests) in self.__checksums.items():
+            checksums["%s:%s" % (name, fmt)] = digests
+        self.state.mark(step, checksums = checksums, compressed = self.__compressed)
+
+    def _disk_artifacts(self):
+        """Returns a (disk name, format) pair for every produced disk image."""
+        artifacts = []
+        for fmt in self.__disk_formats:
+            for name in self.__disks.keys():
+                artifacts.append((name, fmt))
+        return artifacts
 
-        #if disk_format is not raw convert the disk and put in _outdir
-        if self.__disk_format != "raw":
-            self._convert_image()
-        #else move to _outdir
-        else:
+    def _compress_image(self):
+        if not self.compression:
             logging.debug("moving disks to stage location")
             for name in self.__disks.keys():
-                rc = subprocess.call(["xz", "-z", "%s/%s-%s.%s" %(self.__imgdir, self.name, name, self.__disk_format)])
-                if rc == 0:
-                    logging.debug("compression successful")
-                if rc != 0:
-                    raise CreatorError("Unable to compress disk to %s" % self.__disk_format)
-
-                src = "%s/%s-%s.%s.xz" % (self.__imgdir, self.name, name, self.__disk_format)
-                dst = "%s/%s-%s.%s.xz" % (self._outdir, self.name, name, self.__disk_format)
+                if self.state is not None and self.state.done("compress:" + name):
+                    continue
+                src = "%s/%s-%s.raw" % (self.__imgdir, self.name, name)
+                dst = "%s/%s-%s.raw" % (self._outdir, self.name, name)
+                if self.__streaming:
+                    # archived and checksummed straight from the loop file
+                    continue
+                if self.checksum:
+                    self.__checksums[(name, "raw")] = self.__checksum_file(src, name, "raw")
                 logging.debug("moving %s to %s" % (src, dst))
                 shutil.move(src, dst)
-        #write meta data in stage dir
-        self._write_image_xml()
+                self.__checkpoint("compress:" + name)
+            return
 
-    def _convert_image(self):
-        #convert disk format
+        compressor = BlockCompressor(self.compression,
+                                     self.compress_block_size,
+                                     self.jobs)
         for name in self.__disks.keys():
-            dst = "%s/%s-%s.%s" % (self._outdir, self.name, name, self.__disk_format)
-            logging.debug("converting %s image to %s" % (self.__disks[name].lofile, dst))
-            if self.__disk_format == "qcow2":
+            if self.state is not None and self.state.done("compress:" + name):
+                logging.info("Disk %s was compressed before, skipping" % name)
+                continue
+            src = self.__disks[name].lofile
+            dst = "%s/%s-%s.raw%s" % (self._outdir, self.name, name, compressor.suffix)
+            hasher = None
+            if self.checksum:
+                hasher = MultiHasher(self.checksum_types)
+            with self.stats.phase("compress", disk=name, method=self.compression,
+                                  checksum=hasher is not None):
+                index = compressor.compress(src, dst, hasher)
+            if hasher:
+                self.__checksums[(name, "raw")] = hasher.hexdigests()
+            logging.debug("compression of %s successful" % name)
+            self.__compressed[name] = (os.path.basename(dst), index)
+            self.__checkpoint("compress:" + name)
+
+    def _convert_disk(self, job):
+        (name, fmt) = job
+        dst = "%s/%s-%s.%s" % (self._outdir, self.name, name, fmt)
+        logging.debug("converting %s image to %s" % (self.__disks[name].lofile, dst))
+        hasher = None
+        if fmt == "qcow2" and self.qcow2_writer == "native":
+            logging.debug("using compressed qcow2 from the native writer")
+            writer = Qcow2Writer(workers = self.__convert_workers)
+            if self.checksum:
+                hasher = MultiHasher(self.checksum_types)
+            with self.stats.phase("convert", disk=name, format=fmt, writer="native",
+                                  checksum=hasher is not None):
+                writer.write(self.__disks[name].lofile, dst, hasher)
+            if hasher:
+                self.__checksums[job] = hasher.hexdigests()
+            rc = 0
+        else:
+            args = ["qemu-img", "convert"]
+            if fmt == "qcow2":
                 logging.debug("using compressed qcow2")
-                compressflag = "-c"
-            else:
-                compressflag = ""
-            rc = subprocess.call(["qemu-img", "convert", compressflag,
-                                   "-f", "raw", self.__disks[name].lofile,
-                                   "-O", self.__disk_format,  dst])
-            if rc == 0:
-                logging.debug("convert successful")
-            if rc != 0:
-                raise CreatorError("Unable to convert disk to %s" % self.__disk_format)
+                args.append("-c")
+            args.extend(["-f", "raw", self.__disks[name].lofile, "-O", fmt, dst])
+            with self.stats.phase("convert", disk=name, format=fmt):
+                rc = subprocess.call(args)
+        if rc == 0:
+            logging.debug("convert of %s to %s successful" % (name, fmt))
+        if rc != 0:
+            raise CreatorError("Unable to convert disk %s to %s" % (name, fmt))
+        # qemu-img writes the image on its own, it is checksummed while
+        # still hot in the page cache
+        if self.checksum and hasher is None:
+            self.__checksums[job] = self.__checksum_file(dst, name, fmt)
+        self.__checkpoint("convert:%s:%s" % job)
+
+    def _convert_image(self):
+        #convert disk format, every (disk, format) pair is independent
+        #and only reads the raw loop file so they all run concurrently
+        jobs = []
+        for (name, fmt) in self._disk_artifacts():
+            if fmt == "raw":
+                continue
+            if self.state is not None and self.state.done("convert:%s:%s" % (name, fmt)):
+                logging.info("Disk %s was converted to %s before, skipping" % (name, fmt))
+                continue
+            jobs.append((name, fmt))
+        if not jobs:
+            return
+
+        logging.debug("converting %d disk images" % len(jobs))
+        # the native writers share the workers among the conversions
+        self.__convert_workers = max(1, (self.jobs or default_workers()) / len(jobs))
+        parallel_map(self._convert_disk, jobs, self.jobs)
 
     def _write_kickstart(self):
         #write out the kicks tart to /root/anaconda-ks.cfg
@@ -668,6 +1381,27 @@ class ApplianceImageCreator(ImageCreator):
 
 
 
+    def _disk_path(self, name, fmt):
+        """Returns the path holding the uncompressed contents of a disk image."""
+        if fmt == "raw" and os.path.exists(self.__disks[name].lofile):
+            return self.__disks[name].lofile
+        return "%s/%s-%s.%s" % (self._outdir, self.name, name, fmt)
+
+    def __checksum_file(self, path, name, fmt):
+        with self.stats.phase("checksum", disk=name, format=fmt):
+            return checksum_file(path, self.checksum_types)
+
+    def _get_disk_checksums(self, name, fmt):
+        if not self.__checksums.has_key((name, fmt)):
+            self.__checksums[(name, fmt)] = self.__checksum_file(self._disk_path(name, fmt),
+                                                                 name, fmt)
+        digests = self.__checksums[(name, fmt)]
+
+        xml = ""
+        for alg in self.checksum_types:
+            xml += """      <checksum type='%s'>%s</checksum>\n""" % (alg, digests[alg])
+        return xml
+
     def _write_image_xml(self):
         xml = "<image>\n"
 
@@ -688,9 +1422,10 @@ class ApplianceImageCreator(ImageCreator):
         xml += "        <loader dev='hd'/>\n"
         xml += "      </os>\n"
 
+        # boot from the first requested format, the others are listed in storage
         i = 0
         for name in self.__disks.keys():
-            xml += "      <drive disk='%s-%s.%s' target='hd%s'/>\n" % (self.name, name, self.__disk_format, chr(ord('a')+i))
+            xml += "      <drive disk='%s-%s.%s' target='hd%s'/>\n" % (self.name, name, self.__disk_formats[0], chr(ord('a')+i))
             i = i + 1
 
         xml += "    </boot>\n"
@@ -704,44 +1439,21 @@ class ApplianceImageCreator(ImageCreator):
         xml += "  </domain>\n"
         xml += "  <storage>\n"
 
-        if self.checksum is True:
-            for name in self.__disks.keys():
-                diskpath = "%s/%s-%s.%s" % (self._outdir, self.name, name, self.__disk_format)
-                disk_size = os.path.getsize(diskpath)
-                meter_ct = 0
-                meter = progress.TextMeter()
-                meter.start(size=disk_size, text="Generating disk signature for %s-%s.%s" % (self.name, name, self.__disk_format))
-                xml += "    <disk file='%s-%s.%s' use='system' format='%s'>\n" % (self.name, name, self.__disk_format, self.__disk_format)
+        for (name, fmt) in self._disk_artifacts():
+            diskxml = ""
+            if fmt == "raw" and self.__compressed.has_key(name):
+                (compfile, index) = self.__compressed[name]
+                diskxml += "      <compression type='%s' file='%s' index='%s.idx' blocksize='%d' blocks='%d'/>\n" % (index['format'], compfile, compfile, index['block_size'], len(index['blocks']))
 
-                try:
-                    import hashlib
-                    m1 = hashlib.sha1()
-                    m2 = hashlib.sha256()
-                except:
-                    import sha
-                    m1 = sha.new()
-                    m2 = None
-                f = open(diskpath, "r")
-                while 1:
-                    chunk = f.read(65536)
-                    if not chunk:
-                        break
-                    m1.update(chunk)
-                    if m2:
-                        m2.update(chunk)
-                    meter.update(meter_ct)
-                    meter_ct = meter_ct + 65536
-
-                sha1checksum = m1.hexdigest()
-                xml +=  """      <checksum type='sha1'>%s</checksum>\n""" % sha1checksum
-
-                if m2:
-                    sha256checksum = m2.hexdigest()
-                    xml += """      <checksum type='sha256'>%s</checksum>\n""" % sha256checksum
+            if self.checksum is True:
+                diskxml += self._get_disk_checksums(name, fmt)
+
+            if diskxml:
+                xml += "    <disk file='%s-%s.%s' use='system' format='%s'>\n" % (self.name, name, fmt, fmt)
+                xml += diskxml
                 xml += "    </disk>\n"
-        else:
-            for name in self.__disks.keys():
-                xml += "    <disk file='%s-%s.%s' use='system' format='%s'/>\n" % (self.name, name, self.__disk_format, self.__disk_format)
+            else:
+                xml += "    <disk file='%s-%s.%s' use='system' format='%s'/>\n" % (self.name, name, fmt, fmt)
 
         xml += "  </storage>\n"
         xml += "</image>\n"
@@ -0,0 +1,375 @@
+#
+# archive.py: sparse aware tar and zip packaging of appliance images
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import bz2
+import time
+import zlib
+import tarfile
+import zipfile
+import subprocess
+import logging
+
+from imgcreate.errors import *
+from appcreate.sparse import extents
+from appcreate.parallel import parallel_map, parallel_imap, default_workers
+
+READ_SIZE = 1024 * 1024
+ZEROS = "\0" * READ_SIZE
+
+# size of the independently compressed pieces of packages
+CHUNK_SIZE = 1024 * 1024
+
+# compressions supported for tar packages, as the -p suffix
+TAR_COMPRESSIONS = ["gz", "bz2", "zst"]
+
+
+def sparse_map(path):
+    """Returns (size, [(offset, length), ...]) of the data extents of path,
+    or None if path has no holes and can be archived as a plain file."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.fstat(fd).st_size
+        data = [(o, l) for (o, l, is_data) in extents(fd, size) if is_data]
+    finally:
+        os.close(fd)
+    if sum([l for (o, l) in data]) == size:
+        return None
+    return (size, data)
+
+
+class SparseReader(object):
+    """A read only file object over a sparse file.
+
+    With holes = True the whole file is returned and holes are filled
+    from a zero buffer rather than read from disk. With holes = False
+    only the data extents are returned, concatenated, which is the
+    payload layout of a sparse tar member.
+
+    hasher, a MultiHasher, is fed the whole file as it is read, holes
+    included whether they are returned or not, but not the prefix.
+    """
+
+    def __init__(self, path, holes = True, prefix = "", hasher = None):
+        self.__fd = os.open(path, os.O_RDONLY)
+        self.__extents = []
+        for (offset, length, is_data) in extents(self.__fd):
+            if is_data or holes or hasher:
+                self.__extents.append((offset, length, is_data))
+        self.__holes = holes
+        self.__prefix = prefix
+        self.__hasher = hasher
+        self.__current = None
+
+    def __next_extent(self):
+        if self.__current is None or self.__current[1] == 0:
+            if not self.__extents:
+                return None
+            (offset, length, is_data) = self.__extents.pop(0)
+            self.__current = [offset, length, is_data]
+        return self.__current
+
+    def __read_some(self, size):
+        if self.__prefix:
+            buf = self.__prefix[:size]
+            self.__prefix = self.__prefix[size:]
+            return buf
+
+        ext = self.__next_extent()
+        while ext is not None and not ext[2] and not self.__holes:
+            # left out of the data, only hashed
+            self.__hasher.update_zeros(ext[1])
+            ext[1] = 0
+            ext = self.__next_extent()
+        if ext is None:
+            return ""
+        n = min(size, ext[1])
+        if ext[2]:
+            os.lseek(self.__fd, ext[0], os.SEEK_SET)
+            buf = os.read(self.__fd, n)
+            if not buf:
+                raise IOError("Unexpected end of sparse file")
+            n = len(buf)
+        else:
+            buf = ZEROS[:n]
+        ext[0] += n
+        ext[1] -= n
+        if self.__hasher:
+            self.__hasher.update(buf)
+        return buf
+
+    def read(self, size = -1):
+        """Read up to size bytes, only returning less at end of file."""
+        if size < 0:
+            size = READ_SIZE
+        size = min(size, READ_SIZE)
+        bufs = []
+        while size > 0:
+            buf = self.__read_some(size)
+            if not buf:
+                break
+            bufs.append(buf)
+            size -= len(buf)
+        return "".join(bufs)
+
+    def close(self):
+        if self.__fd is not None:
+            os.close(self.__fd)
+            self.__fd = None
+
+
+def add_to_tar(tar, path, arcname, hasher = None):
+    """Add path to tar like TarFile.add, storing files with holes as
+    PAX 1.0 sparse members so neither creating nor unpacking the
+    archive touches the holes. tar must use tarfile.PAX_FORMAT.
+
+    When path is a regular file its contents are fed to hasher, a
+    MultiHasher, on the way."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        tar.add(path, arcname, recursive=False)
+        for f in sorted(os.listdir(path)):
+            add_to_tar(tar, os.path.join(path, f), os.path.join(arcname, f))
+        return
+
+    if not os.path.isfile(path) or os.path.islink(path):
+        tar.add(path, arcname)
+        return
+
+    smap = sparse_map(path)
+    if smap is None and hasher is None:
+        tar.add(path, arcname)
+        return
+    if smap is None:
+        reader = SparseReader(path, hasher = hasher)
+        try:
+            tar.addfile(tar.gettarinfo(path, arcname), reader)
+        finally:
+            reader.close()
+        return
+
+    (size, data) = smap
+    if not data or data[-1][0] + data[-1][1] < size:
+        # a zero length final extent records the real end of file
+        data.append((size, 0))
+    header = "%d\n" % len(data)
+    for (offset, length) in data:
+        header += "%d\n%d\n" % (offset, length)
+    header += "\0" * (-len(header) % tarfile.BLOCKSIZE)
+
+    tarinfo = tar.gettarinfo(path, arcname)
+    tarinfo.name = "%s/GNUSparseFile.0/%s" % (os.path.dirname(arcname) or ".",
+                                            os.path.basename(arcname))
+    tarinfo.size = len(header) + sum([l for (o, l) in data])
+    tarinfo.pax_headers = {"GNU.sparse.major": "1",
+                           "GNU.sparse.minor": "0",
+                           "GNU.sparse.name": arcname,
+                           "GNU.sparse.realsize": str(size)}
+    logging.debug("adding sparse %s (%d of %d bytes allocated)" %
+                  (arcname, tarinfo.size - len(header), size))
+    reader = SparseReader(path, holes = False, prefix = header, hasher = hasher)
+    try:
+        tar.addfile(tarinfo, reader)
+        # tarfile stops at the end of the data, before a trailing hole
+        if reader.read(1):
+            raise IOError("%s changed while it was archived" % path)
+    finally:
+        reader.close()
+
+
+class ParallelCompressor(object):
+    """A write only file object compressing its data on all cpus.
+
+    The data is cut into chunks which are compressed independently and
+    written out in order as standalone gzip members or bzip2 streams.
+    Both formats are defined as a concatenation of such members, so the
+    result unpacks with the stock gzip, bzip2 and tar. zstd is handed to
+    the zstd binary, which compresses on several threads by itself.
+
+    close() flushes the compressed data but leaves fileobj open.
+    """
+
+    def __init__(self, fileobj, method, workers = None, chunksize = CHUNK_SIZE):
+        if not method in TAR_COMPRESSIONS:
+            raise CreatorError("Unsupported package compression %s" % method)
+        self.fileobj = fileobj
+        self.method = method
+        self.workers = workers or default_workers()
+        self.chunksize = chunksize
+        self.__pending = []
+        self.__size = 0
+        self.__proc = None
+        if method == "zst":
+            fileobj.flush()
+            self.__proc = subprocess.Popen(["zstd", "-q", "-c", "-T%d" % self.workers],
+                                           stdin=subprocess.PIPE, stdout=fileobj)
+
+    def __compress(self, data):
+        if self.method == "gz":
+            # wbits 31 produces a complete gzip member
+            c = zlib.compressobj(6, zlib.DEFLATED, 31)
+            return c.compress(data) + c.flush()
+        return bz2.compress(data, 9)
+
+    def __flush(self, final):
+        data = "".join(self.__pending)
+        keep = 0
+        if not final:
+            keep = len(data) % self.chunksize
+        chunks = []
+        for i in range(0, len(data) - keep, self.chunksize):
+            chunks.append(data[i:i+self.chunksize])
+        for out in parallel_map(self.__compress, chunks, self.workers):
+            self.fileobj.write(out)
+        if keep:
+            self.__pending = [data[-keep:]]
+        else:
+            self.__pending = []
+        self.__size = keep
+
+    def write(self, data):
+        if self.__proc:
+            self.__proc.stdin.write(data)
+            return
+        self.__pending.append(data)
+        self.__size += len(data)
+        if self.__size >= self.chunksize * self.workers * 2:
+            self.__flush(False)
+
+    def close(self):
+        if self.__proc:
+            self.__proc.stdin.close()
+            if self.__proc.wait() != 0:
+                raise CreatorError("zstd failed compressing package")
+            self.__proc = None
+            return
+        if self.__size:
+            self.__flush(True)
+
+
+def open_tar(fileobj, comp = None, workers = None):
+    """Open a PAX streaming tar writing to fileobj, compressed in parallel
+    with comp ("gz", "bz2", "zst" or None).
+
+    Returns (tar, compressor); close the tar first and then the
+    compressor, if any.
+    """
+    compressor = None
+    if comp:
+        compressor = ParallelCompressor(fileobj, comp, workers)
+        fileobj = compressor
+    # PAX format so that sparse disks are stored as sparse members
+    tar = tarfile.open(mode="w|", fileobj=fileobj, format=tarfile.PAX_FORMAT)
+    return (tar, compressor)
+
+
+def _read_chunks(fp, size):
+    """Yields (data, is_last) for the chunks of fp, always at least one."""
+    data = fp.read(size)
+    while True:
+        next = fp.read(size)
+        yield (data, not next)
+        if not next:
+            return
+        data = next
+
+def _deflate_chunk(job):
+    # Each chunk is an independent raw deflate stream; a sync flush ends
+    # it on a byte boundary so the pieces concatenate to one valid
+    # stream and only the last one is marked final.
+    (data, last) = job
+    c = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    if last:
+        return (data, c.compress(data) + c.flush(zlib.Z_FINISH))
+    return (data, c.compress(data) + c.flush(zlib.Z_SYNC_FLUSH))
+
+
+class SparseZipFile(zipfile.ZipFile):
+    """ZipFile which deflates members on all cpus and reads files with
+    holes without reading the holes.
+
+    Zip has no notion of sparse members, so the holes are still stored
+    (and deflate squashes them to almost nothing) but they are produced
+    from a zero buffer instead of being read from the disk image.
+    """
+
+    def __init__(self, file, mode = "r", compression = zipfile.ZIP_STORED,
+                 allowZip64 = False, workers = None):
+        zipfile.ZipFile.__init__(self, file, mode, compression, allowZip64)
+        self.workers = workers or default_workers()
+
+    def write(self, filename, arcname = None, compress_type = None):
+        if not os.path.isfile(filename) or os.path.islink(filename):
+            return zipfile.ZipFile.write(self, filename, arcname, compress_type)
+
+        st = os.stat(filename)
+        if arcname is None:
+            arcname = filename
+        arcname = os.path.normpath(os.path.splitdrive(arcname)[1])
+        while arcname[0] in (os.sep, os.altsep):
+            arcname = arcname[1:]
+        zinfo = zipfile.ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+        zinfo.external_attr = (st[0] & 0xFFFF) << 16L
+        if compress_type is None:
+            zinfo.compress_type = self.compression
+        else:
+            zinfo.compress_type = compress_type
+        zinfo.file_size = st.st_size
+        zinfo.flag_bits = 0x00
+        zinfo.header_offset = self.fp.tell()
+
+        self._writecheck(zinfo)
+        self._didModify = True
+
+        reader = SparseReader(filename)
+        try:
+            self._write_member(zinfo, reader)
+        finally:
+            reader.close()
+
+    def _write_member(self, zinfo, fp):
+        """Write the data of zinfo read from fp, then patch its header."""
+        zip64 = self._allowZip64 and zinfo.file_size * 1.05 > zipfile.ZIP64_LIMIT
+        zinfo.CRC = 0
+        zinfo.compress_size = 0
+        self.fp.write(zinfo.FileHeader(zip64))
+        crc = 0
+        file_size = 0
+        compress_size = 0
+        if zinfo.compress_type == zipfile.ZIP_DEFLATED:
+            chunks = parallel_imap(_deflate_chunk, _read_chunks(fp, CHUNK_SIZE),
+                                   self.workers)
+        else:
+            chunks = ((buf, buf) for (buf, last) in _read_chunks(fp, READ_SIZE))
+        for (buf, out) in chunks:
+            file_size += len(buf)
+            crc = zlib.crc32(buf, crc) & 0xffffffff
+            compress_size += len(out)
+            self.fp.write(out)
+        zinfo.CRC = crc
+        zinfo.file_size = file_size
+        zinfo.compress_size = compress_size
+        if not zip64 and self._allowZip64:
+            if file_size > zipfile.ZIP64_LIMIT or compress_size > zipfile.ZIP64_LIMIT:
+                raise RuntimeError("File size has increased during compressing")
+
+        position = self.fp.tell()
+        self.fp.seek(zinfo.header_offset, 0)
+        self.fp.write(zinfo.FileHeader(zip64))
+        self.fp.seek(position, 0)
+        self.filelist.append(zinfo)
+        self.NameToInfo[zinfo.filename] = zinfo
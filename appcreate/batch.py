@@ -0,0 +1,204 @@
+#
+# batch.py: run many appliance builds at once within the host resources
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import time
+import signal
+import subprocess
+import logging
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from appcreate.loop import free_loop_devices
+from appcreate.parallel import default_workers
+
+# memory set aside for every running build unless told otherwise
+DEFAULT_JOB_MEMORY = 1024 * 1024 * 1024L
+
+
+def available_memory():
+    """Returns the memory available to new processes in bytes."""
+    try:
+        f = open("/proc/meminfo")
+        try:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024L
+        finally:
+            f.close()
+    except IOError:
+        pass
+    return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_AVPHYS_PAGES")
+
+def free_space(path):
+    st = os.statvfs(path)
+    return st.f_bavail * st.f_frsize
+
+
+class BatchJob(object):
+    """One appliance build of a batch.
+
+    command is the argument list of the build, tmpdir the directory it
+    builds in, space the bytes it may need there at most and loops the
+    number of loop devices it attaches.
+    """
+
+    def __init__(self, name, command, tmpdir, space, loops, logfile):
+        self.name = name
+        self.command = command
+        self.tmpdir = tmpdir
+        self.space = space
+        self.loops = loops
+        self.logfile = logfile
+        self.proc = None
+        self.returncode = None
+        self.start_time = None
+        self.end_time = None
+
+    def __get_wall(self):
+        if self.start_time is None:
+            return None
+        return (self.end_time or time.time()) - self.start_time
+    wall = property(__get_wall)
+
+
+class BatchScheduler(object):
+    """Runs BatchJobs concurrently, starting a job only once the host has
+    room for it.
+
+    A job is admitted when fewer than max_jobs jobs run and the space it
+    needs in its tmpdir, its loop devices and job_memory bytes of memory
+    fit in what was free when the batch started, less what the running
+    jobs reserved. Jobs are admitted in order, but a job which does not
+    fit yet does not hold back smaller jobs behind it. A job too big to
+    ever fit runs on its own.
+    """
+
+    def __init__(self, jobs, max_jobs = None, job_memory = DEFAULT_JOB_MEMORY,
+                 poll_interval = 1.0):
+        self.jobs = jobs
+        self.max_jobs = max_jobs or max(1, default_workers() / 2)
+        self.job_memory = job_memory
+        self.poll_interval = poll_interval
+        self.__space = {}
+        self.__loops = free_loop_devices()
+        self.__memory = available_memory()
+        for job in jobs:
+            dev = os.stat(job.tmpdir).st_dev
+            if not self.__space.has_key(dev):
+                self.__space[dev] = free_space(job.tmpdir)
+
+    def __fits(self, job, running):
+        if len(running) >= self.max_jobs:
+            return False
+        dev = os.stat(job.tmpdir).st_dev
+        space = sum([j.space for j in running if os.stat(j.tmpdir).st_dev == dev])
+        if space + job.space > self.__space[dev]:
+            return False
+        if self.__loops is not None:
+            if sum([j.loops for j in running]) + job.loops > self.__loops:
+                return False
+        return (len(running) + 1) * self.job_memory <= self.__memory
+
+    def __start(self, job):
+        logging.info("Starting %s, log in %s" % (job.name, job.logfile))
+        log = open(job.logfile, "w")
+        try:
+            job.start_time = time.time()
+            job.proc = subprocess.Popen(job.command, stdout=log,
+                                        stderr=subprocess.STDOUT,
+                                        close_fds=True)
+        finally:
+            log.close()
+
+    def __reap(self, running):
+        for job in running[:]:
+            rc = job.proc.poll()
+            if rc is None:
+                continue
+            job.returncode = rc
+            job.end_time = time.time()
+            running.remove(job)
+            if rc == 0:
+                logging.info("%s finished in %.0fs" % (job.name, job.wall))
+            else:
+                logging.error("%s failed with status %d after %.0fs, see %s" %
+                              (job.name, rc, job.wall, job.logfile))
+
+    def run(self):
+        """Run every job, returns once all have finished."""
+        pending = list(self.jobs)
+        running = []
+        try:
+            while pending or running:
+                for job in pending[:]:
+                    if not self.__fits(job, running):
+                        if running:
+                            continue
+                        logging.warning("%s needs more than the host has free, "
+                                        "running it on its own" % job.name)
+                    self.__start(job)
+                    pending.remove(job)
+                    running.append(job)
+                self.__reap(running)
+                if pending or running:
+                    time.sleep(self.poll_interval)
+        except KeyboardInterrupt:
+            for job in running:
+                logging.error("Stopping %s" % job.name)
+                os.kill(job.proc.pid, signal.SIGTERM)
+            for job in running:
+                job.returncode = job.proc.wait()
+                job.end_time = time.time()
+            raise
+        return self.jobs
+
+    def summary(self):
+        """Returns a human readable table of the outcome of every job."""
+        lines = ["%-30s %-8s %8s  %s" % ("NAME", "STATUS", "TIME", "LOG")]
+        for job in self.jobs:
+            if job.returncode is None:
+                status = "not run"
+            elif job.returncode == 0:
+                status = "ok"
+            else:
+                status = "failed"
+            wall = ""
+            if job.wall is not None:
+                wall = "%.0fs" % job.wall
+            lines.append("%-30s %-8s %8s  %s" % (job.name, status, wall, job.logfile))
+        return "\n".join(lines)
+
+    def write_summary(self, path):
+        """Write the outcome of every job to path as a JSON document."""
+        report = []
+        for job in self.jobs:
+            report.append({ "name": job.name,
+                            "command": job.command,
+                            "returncode": job.returncode,
+                            "wall": job.wall,
+                            "log": job.logfile })
+        f = open(path, "w")
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+        finally:
+            f.close()
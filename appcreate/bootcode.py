@@ -0,0 +1,112 @@
+#
+# bootcode.py: write grub2 boot code to disk images without grub2-install
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import struct
+import logging
+
+from imgcreate.errors import *
+
+SECTOR_SIZE = 512
+
+# offsets into boot.img, from grub's include/grub/i386/pc/boot.h
+BPB_START = 0x3
+BPB_END = 0x5a
+KERNEL_SECTOR = 0x5c
+BOOT_DRIVE = 0x64
+DRIVE_CHECK = 0x66
+WINDOWS_NT_MAGIC = 0x1b8
+PART_END = 0x1fe
+
+# the blocklists at the end of the first sector of core.img (diskboot.img)
+# grow downwards, each is a 64 bit start sector, a 16 bit sector count
+# and the 16 bit segment the sectors are loaded to
+BLOCKLIST_SIZE = 12
+KERNEL_SEGMENT = 0x800 + (SECTOR_SIZE >> 4)
+
+
+def _read(fd, offset, length):
+    os.lseek(fd, offset, 0)
+    return os.read(fd, length)
+
+def _write(fd, offset, data):
+    os.lseek(fd, offset, 0)
+    while data:
+        data = data[os.write(fd, data):]
+
+def _patch_blocklist(core, start, sectors):
+    """Point the blocklist of core.img at its remaining sectors, which
+    follow its first sector on disk."""
+    core = list(core)
+    pos = SECTOR_SIZE - BLOCKLIST_SIZE
+    # clear the blocklists shipped with diskboot.img
+    while pos > 0 and struct.unpack("<H", "".join(core[pos + 8:pos + 10]))[0]:
+        core[pos:pos + BLOCKLIST_SIZE] = "\0" * BLOCKLIST_SIZE
+        pos -= BLOCKLIST_SIZE
+    pos = SECTOR_SIZE - BLOCKLIST_SIZE
+    core[pos:pos + BLOCKLIST_SIZE] = struct.pack("<QHH", start + 1, sectors - 1,
+                                                 KERNEL_SEGMENT)
+    return "".join(core)
+
+def install_grub2_bios(path, boot_img, core_img, start, sectors):
+    """Install grub2 for BIOS booting to the disk image path, which holds
+    a gpt partition table with a bios_grub partition at sector start,
+    sectors long.
+
+    This does what grub2-bios-setup does when it embeds core.img into the
+    bios_grub partition: core.img is written to the partition, with its
+    blocklist pointing at its own sectors, and boot.img to the first
+    sector, keeping the BPB area and the protective MBR of the disk.
+    """
+    if len(boot_img) != SECTOR_SIZE:
+        raise CreatorError("grub2 boot.img is %d bytes instead of %d" %
+                           (len(boot_img), SECTOR_SIZE))
+    core_sectors = (len(core_img) + SECTOR_SIZE - 1) / SECTOR_SIZE
+    if core_sectors < 2:
+        raise CreatorError("grub2 core.img is too small to be valid")
+    if core_sectors > sectors:
+        raise CreatorError("grub2 core.img needs %d sectors but the biosboot partition has %d" %
+                           (core_sectors, sectors))
+    core_img += "\0" * (core_sectors * SECTOR_SIZE - len(core_img))
+    core_img = _patch_blocklist(core_img, start, core_sectors)
+
+    try:
+        fd = os.open(path, os.O_RDWR)
+    except OSError, e:
+        raise CreatorError("Unable to open %s to install grub2: %s" % (path, e))
+    try:
+        try:
+            mbr = _read(fd, 0, SECTOR_SIZE)
+            boot = (boot_img[:BPB_START] + mbr[BPB_START:BPB_END] +
+                    boot_img[BPB_END:KERNEL_SECTOR] +
+                    struct.pack("<Q", start) +
+                    boot_img[KERNEL_SECTOR + 8:BOOT_DRIVE] +
+                    # take the boot drive from the BIOS
+                    "\xff" + boot_img[BOOT_DRIVE + 1:DRIVE_CHECK] +
+                    # a hard disk, enable the workaround for BIOSes
+                    # passing a wrong boot drive by nopping out its jmp
+                    "\x90\x90" + boot_img[DRIVE_CHECK + 2:WINDOWS_NT_MAGIC] +
+                    mbr[WINDOWS_NT_MAGIC:PART_END] + boot_img[PART_END:])
+            _write(fd, start * SECTOR_SIZE, core_img)
+            _write(fd, 0, boot)
+            os.fsync(fd)
+        except OSError, e:
+            raise CreatorError("Error installing grub2 to %s: %s" % (path, e))
+    finally:
+        os.close(fd)
+    logging.debug("Installed grub2 boot code to %s, core.img at sector %d" % (path, start))
@@ -0,0 +1,411 @@
+#
+# cache.py: content addressed store for build results
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import re
+import sys
+import glob
+import time
+import stat
+import fcntl
+import contextlib
+import shutil
+import hashlib
+import tempfile
+import urllib2
+import subprocess
+import logging
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+import imgcreate
+from imgcreate.errors import *
+
+# bump when the layout of the cache entries changes
+CACHE_FORMAT = 1
+
+MANIFEST = "manifest.json"
+
+# temporary directories of stores and downloads older than this are
+# left over from a build which died and are removed
+STALE_AGE = 24 * 3600
+
+
+def _basearch():
+    arch = os.uname()[4]
+    if re.match("i.86$", arch):
+        return "i386"
+    return arch
+
+def _fetch(url):
+    f = urllib2.urlopen(url)
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def _repomd(baseurl):
+    return _fetch(baseurl.rstrip("/") + "/repodata/repomd.xml")
+
+def _mirror_repomd(mirrorlist):
+    data = _fetch(mirrorlist)
+    if "<metalink" in data:
+        # a metalink carries the checksums of the current repomd.xml
+        hashes = re.findall(r"<hash type=\"sha256\">([0-9a-fA-F]+)</hash>", data)
+        if not hashes:
+            raise IOError("no repomd.xml checksum in metalink %s" % mirrorlist)
+        return hashes[0]
+    for url in data.splitlines():
+        url = url.strip()
+        if not url or url.startswith("#"):
+            continue
+        try:
+            return _repomd(url)
+        except (IOError, urllib2.URLError), e:
+            logging.debug("Mirror %s unusable: %s" % (url, e))
+    raise IOError("no usable mirror in %s" % mirrorlist)
+
+def repo_metadata_digest(ks, releasever = None):
+    """Returns a digest of the current metadata of every repo of ks, or
+    None if some repo metadata cannot be fetched.
+
+    The packages a kickstart resolves to are a function of its package
+    list and of the repo metadata, so this digest stands in for the
+    resolved package set without running a depsolve.
+    """
+    h = hashlib.sha256()
+    for repo in sorted(ks.handler.repo.repoList, key=lambda r: r.name):
+        url = repo.baseurl or repo.mirrorlist
+        if not url:
+            continue
+        url = url.replace("$basearch", _basearch())
+        if releasever:
+            url = url.replace("$releasever", releasever)
+        if "$" in url:
+            logging.info("Cannot resolve variables in repo %s url %s" % (repo.name, url))
+            return None
+        try:
+            if repo.baseurl:
+                data = _repomd(url)
+            else:
+                data = _mirror_repomd(url)
+        except (IOError, urllib2.URLError), e:
+            logging.info("Unable to fetch metadata of repo %s: %s" % (repo.name, e))
+            return None
+        h.update("%s\0%s\0" % (repo.name, hashlib.sha256(data).hexdigest()))
+    return h.hexdigest()
+
+def digest_path(h, path):
+    """Feed the names and contents of path, a file or a tree, to h."""
+    if os.path.isdir(path) and not os.path.islink(path):
+        for f in sorted(os.listdir(path)):
+            h.update("%s/\0" % f)
+            digest_path(h, os.path.join(path, f))
+    elif os.path.islink(path):
+        h.update("link\0%s\0" % os.readlink(path))
+    else:
+        f = open(path, "rb")
+        try:
+            while True:
+                buf = f.read(1024 * 1024)
+                if not buf:
+                    break
+                h.update(buf)
+        finally:
+            f.close()
+        h.update("\0")
+
+def code_digest():
+    """Returns a digest of the appcreate and imgcreate sources and of the
+    running script, so that any change to the tools invalidates what
+    earlier versions produced."""
+    h = hashlib.sha256()
+    for module in (os.path.dirname(__file__), os.path.dirname(imgcreate.__file__)):
+        for path in sorted(glob.glob(os.path.join(module, "*.py"))):
+            h.update("%s/%s\0" % (os.path.basename(module), os.path.basename(path)))
+            digest_path(h, path)
+    if os.path.isfile(sys.argv[0]):
+        h.update(os.path.basename(sys.argv[0]) + "\0")
+        digest_path(h, sys.argv[0])
+    return h.hexdigest()
+
+def copy_path(src, dst):
+    """Copy a file or tree, sharing the blocks when the filesystem can
+    reflink and keeping holes otherwise."""
+    rc = subprocess.call(["cp", "-a", "--reflink=auto", "--sparse=always", src, dst])
+    if rc != 0:
+        raise CreatorError("Unable to copy %s to %s" % (src, dst))
+
+def _allocated(path):
+    if os.path.isdir(path) and not os.path.islink(path):
+        size = 0
+        for f in os.listdir(path):
+            size += _allocated(os.path.join(path, f))
+        return size
+    return os.lstat(path).st_blocks * 512L
+
+
+class ContentCache(object):
+    """A directory of build results addressed by a digest of their inputs.
+
+    Every entry is a directory named after its key holding the stored
+    files and a manifest. Entries are assembled in a private temporary
+    directory and renamed into place, so a reader never sees a partial
+    entry. A lock file serializes renames and evictions (exclusively)
+    against copies out of the cache (shared), so any number of builds
+    can use the same cache directory at once.
+    Temporary directories a crashed build left behind are removed once
+    they are older than STALE_AGE.
+
+    The modification time of an entry is its last use; once the cache
+    holds more than max_size bytes the least recently used entries are
+    evicted.
+    """
+
+    def __init__(self, path, max_size = None):
+        self.path = path
+        self.max_size = max_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.__sweep()
+
+    def __sweep(self):
+        now = time.time()
+        for name in os.listdir(self.path):
+            if not (name.startswith(".store-") or name.startswith(".tmp-")):
+                continue
+            try:
+                if now - os.lstat(os.path.join(self.path, name)).st_mtime < STALE_AGE:
+                    continue
+            except OSError:
+                continue
+            logging.info("Removing %s left over in the cache" % name)
+            shutil.rmtree(os.path.join(self.path, name), ignore_errors = True)
+
+    def __lock(self, mode):
+        fd = os.open(os.path.join(self.path, ".lock"), os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(fd, mode)
+        return fd
+
+    def __unlock(self, fd):
+        fcntl.flock(fd, fcntl.LOCK_UN)
+        os.close(fd)
+
+    def __entry(self, key):
+        return os.path.join(self.path, key)
+
+    def manifest(self, key):
+        """Returns the manifest of the entry for key, or None."""
+        try:
+            f = open(os.path.join(self.__entry(key), MANIFEST))
+        except IOError:
+            return None
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    @contextlib.contextmanager
+    def entry(self, key):
+        """Context manager yielding the directory of the entry for key, or
+        None on a cache miss. The entry is marked as used and cannot be
+        evicted until the block is left; it must not be modified."""
+        lock = self.__lock(fcntl.LOCK_SH)
+        try:
+            manifest = self.manifest(key)
+            if manifest is None or manifest.get("format") != CACHE_FORMAT:
+                yield None
+            else:
+                os.utime(self.__entry(key), None)
+                yield self.__entry(key)
+        finally:
+            self.__unlock(lock)
+
+    def restore(self, key, destdir):
+        """Copy the files of the entry for key into destdir.
+
+        Returns the list of restored paths, or None on a cache miss.
+        """
+        with self.entry(key) as path:
+            if path is None:
+                return None
+            restored = []
+            for name in self.manifest(key)["files"]:
+                dst = os.path.join(destdir, name)
+                if os.path.isdir(dst) and not os.path.islink(dst):
+                    shutil.rmtree(dst)
+                elif os.path.lexists(dst):
+                    os.unlink(dst)
+                copy_path(os.path.join(path, name), dst)
+                restored.append(dst)
+        logging.info("Restored %s from cache entry %s" %
+                     (", ".join([os.path.basename(r) for r in restored]), key))
+        return restored
+
+    def mkdtemp(self):
+        """Returns a new temporary directory inside the cache, on the same
+        filesystem as the entries so that files can be moved in by store()."""
+        return tempfile.mkdtemp(prefix=".tmp-", dir=self.path)
+
+    def store(self, key, paths, info = None, move = False):
+        """Store copies of paths, files or trees, as the entry for key.
+
+        info is an optional JSON serializable dict recorded in the
+        manifest. With move = True the paths, which should come from
+        mkdtemp(), are moved into the entry instead of being copied.
+        Storing a key which is already present is a no-op.
+        """
+        if self.manifest(key) is not None:
+            return
+        tmp = tempfile.mkdtemp(prefix=".store-", dir=self.path)
+        try:
+            files = []
+            for path in paths:
+                name = os.path.basename(path.rstrip("/"))
+                if move:
+                    os.rename(path, os.path.join(tmp, name))
+                else:
+                    copy_path(path, os.path.join(tmp, name))
+                files.append(name)
+            manifest = { "format": CACHE_FORMAT,
+                         "key": key,
+                         "files": files,
+                         "created": time.time(),
+                         "size": _allocated(tmp) }
+            if info:
+                manifest["info"] = info
+            f = open(os.path.join(tmp, MANIFEST), "w")
+            try:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            finally:
+                f.close()
+
+            lock = self.__lock(fcntl.LOCK_EX)
+            try:
+                if os.path.exists(self.__entry(key)):
+                    # another build stored the same result meanwhile
+                    return
+                os.rename(tmp, self.__entry(key))
+                tmp = None
+                logging.info("Stored %s in cache entry %s" % (", ".join(files), key))
+                self.__evict(key)
+            finally:
+                self.__unlock(lock)
+        finally:
+            if tmp is not None:
+                shutil.rmtree(tmp, ignore_errors = True)
+
+    def remove(self, key):
+        """Remove the entry for key, if there is one."""
+        lock = self.__lock(fcntl.LOCK_EX)
+        try:
+            shutil.rmtree(self.__entry(key), ignore_errors = True)
+        finally:
+            self.__unlock(lock)
+
+    def __evict(self, keep):
+        # called with the lock held exclusively
+        if not self.max_size:
+            return
+        entries = []
+        total = 0
+        for key in os.listdir(self.path):
+            if key.startswith("."):
+                continue
+            manifest = self.manifest(key)
+            if manifest is None:
+                continue
+            total += manifest["size"]
+            entries.append((os.stat(self.__entry(key)).st_mtime, key, manifest["size"]))
+        entries.sort()
+        for (mtime, key, size) in entries:
+            if total <= self.max_size:
+                break
+            if key == keep:
+                continue
+            logging.info("Evicting cache entry %s (%d MB, last used %s)" %
+                         (key, size / 1024 / 1024, time.ctime(mtime)))
+            shutil.rmtree(self.__entry(key), ignore_errors = True)
+            total -= size
+
+
+# parts of an installed root which are not its package payload: kernel
+# filesystems and bind mounts, the yum cache and the fstab the creator
+# writes for the partitions of the build at hand
+ROOT_SKIP = ["proc", "sys", "dev", "selinux", "var/cache/yum", "etc/fstab"]
+
+TAR_OPTIONS = ["--numeric-owner", "--xattrs", "--xattrs-include=*", "--acls", "--sparse"]
+
+def _tar_excludes():
+    args = ["--anchored"]
+    for path in ROOT_SKIP:
+        args.extend(["--exclude=./%s" % path, "--exclude=./%s/*" % path])
+    return args
+
+def digest_root(h, root, dir = None):
+    """Feed the paths, modes and contents of the files in the tree at
+    root, less ROOT_SKIP, to h. Directories only count through what
+    they hold, so mount points and lost+found do not matter."""
+    if dir is None:
+        dir = root
+    for f in sorted(os.listdir(dir)):
+        path = os.path.join(dir, f)
+        rel = os.path.relpath(path, root)
+        if rel in ROOT_SKIP:
+            continue
+        st = os.lstat(path)
+        if stat.S_ISDIR(st.st_mode):
+            digest_root(h, root, path)
+            continue
+        h.update("%s\0%o\0" % (rel, st.st_mode))
+        if stat.S_ISREG(st.st_mode) or stat.S_ISLNK(st.st_mode):
+            digest_path(h, path)
+        else:
+            h.update("%d\0" % st.st_rdev)
+
+def snapshot_root(root, dst, workers = None):
+    """Write the tree at root, less ROOT_SKIP, to dst as a zstd
+    compressed tar keeping owners, permissions, xattrs, acls and holes."""
+    args = ["tar", "-C", root] + TAR_OPTIONS + _tar_excludes() + ["-cf", "-", "."]
+    out = open(dst, "wb")
+    try:
+        tar = subprocess.Popen(args, stdout=subprocess.PIPE)
+        zstd = subprocess.Popen(["zstd", "-q", "-c", "-T%d" % (workers or 0)],
+                                stdin=tar.stdout, stdout=out)
+        tar.stdout.close()
+        zrc = zstd.wait()
+        rc = tar.wait()
+    finally:
+        out.close()
+    # tar exits with 1 when a file changed while it was read
+    if rc > 1 or zrc != 0:
+        raise CreatorError("Unable to snapshot %s to %s" % (root, dst))
+
+def restore_root(src, root):
+    """Unpack a snapshot written by snapshot_root() into root."""
+    zstd = subprocess.Popen(["zstd", "-q", "-d", "-c", src], stdout=subprocess.PIPE)
+    tar = subprocess.Popen(["tar", "-C", root, "-xpf", "-"] + TAR_OPTIONS,
+                           stdin=zstd.stdout)
+    zstd.stdout.close()
+    rc = tar.wait()
+    zrc = zstd.wait()
+    if rc != 0 or zrc != 0:
+        raise CreatorError("Unable to restore %s into %s" % (src, root))
@@ -0,0 +1,115 @@
+#
+# checksum.py: multi-threaded, sparse aware disk image checksums
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import hashlib
+import threading
+import Queue
+import logging
+
+from imgcreate.errors import *
+from appcreate.sparse import extents
+
+BUFFER_SIZE = 4 * 1024 * 1024
+ZEROS = "\0" * BUFFER_SIZE
+
+DEFAULT_CHECKSUMS = ["sha1", "sha256"]
+
+
+class MultiHasher(object):
+    """Feeds the same data to several hash algorithms at once.
+
+    Each algorithm runs on its own thread; hashlib releases the GIL
+    while hashing large buffers so the digests are computed in parallel
+    while the caller carries on reading or compressing the next buffer.
+    """
+
+    def __init__(self, algorithms = DEFAULT_CHECKSUMS, depth = 4):
+        self.algorithms = list(algorithms)
+        self.__hashes = []
+        self.__queues = []
+        self.__threads = []
+        hashes = []
+        for alg in self.algorithms:
+            try:
+                hashes.append(hashlib.new(alg))
+            except ValueError:
+                raise CreatorError("Unsupported checksum type %s" % alg)
+        for h in hashes:
+            q = Queue.Queue(depth)
+            t = threading.Thread(target=self.__run, args=(h, q))
+            t.setDaemon(True)
+            t.start()
+            self.__hashes.append(h)
+            self.__queues.append(q)
+            self.__threads.append(t)
+
+    def __run(self, h, q):
+        while True:
+            data = q.get()
+            if data is None:
+                return
+            h.update(data)
+
+    def update(self, data):
+        if not data:
+            return
+        for q in self.__queues:
+            q.put(data)
+
+    def update_zeros(self, length):
+        """Hash length zero bytes without reading them from anywhere."""
+        while length >= BUFFER_SIZE:
+            self.update(ZEROS)
+            length -= BUFFER_SIZE
+        if length:
+            self.update(ZEROS[:length])
+
+    def hexdigests(self):
+        """Finish hashing and return a dict of algorithm to hex digest."""
+        for q in self.__queues:
+            q.put(None)
+        for t in self.__threads:
+            t.join()
+        digests = {}
+        for i in range(len(self.algorithms)):
+            digests[self.algorithms[i]] = self.__hashes[i].hexdigest()
+        return digests
+
+
+def checksum_file(path, algorithms = DEFAULT_CHECKSUMS):
+    """Checksum path in a single pass, hashing holes without reading them."""
+    hasher = MultiHasher(algorithms)
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for (offset, length, is_data) in extents(fd):
+            if not is_data:
+                hasher.update_zeros(length)
+                continue
+            os.lseek(fd, offset, os.SEEK_SET)
+            while length > 0:
+                data = os.read(fd, min(length, BUFFER_SIZE))
+                if not data:
+                    raise CreatorError("Unexpected end of file reading %s" % path)
+                hasher.update(data)
+                length -= len(data)
+    finally:
+        os.close(fd)
+    digests = hasher.hexdigests()
+    logging.debug("checksummed %s: %s" % (path, digests))
+    return digests
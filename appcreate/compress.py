@@ -0,0 +1,163 @@
+#
+# compress.py: block indexed, parallel compression of disk images
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import subprocess
+import logging
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from imgcreate.errors import *
+from appcreate.parallel import parallel_map, default_workers
+
+# command compressing stdin to stdout, file suffix
+COMPRESSORS = {
+    "xz": (["xz", "-z", "-c", "-q"], ".xz"),
+    "zstd": (["zstd", "-q", "-c"], ".zst"),
+}
+
+DEFAULT_BLOCK_SIZE = 16 * 1024 * 1024
+
+
+class BlockCompressor(object):
+    """Compresses a file as a sequence of independently compressed blocks.
+
+    Every block of the input is compressed on its own by a separate
+    compressor process, so all cpus are kept busy. Both xz and zstd
+    decoders accept concatenated streams, so the output is an ordinary
+    .xz or .zst file which decompresses with the stock tools.
+
+    Alongside the output a JSON block index (output + ".idx") is written
+    mapping each block's uncompressed offset to its compressed offset
+    and length, which allows any byte range of the image to be
+    decompressed without inflating what comes before it.
+    """
+
+    def __init__(self, method = "xz", blocksize = DEFAULT_BLOCK_SIZE,
+                 workers = None, level = None):
+        if not COMPRESSORS.has_key(method):
+            raise CreatorError("Unsupported compression method %s" % method)
+        if blocksize < 4096:
+            raise CreatorError("Compression block size %d is too small" % blocksize)
+        self.method = method
+        self.blocksize = blocksize
+        self.workers = workers or default_workers()
+        self.level = level
+        (self.command, self.suffix) = COMPRESSORS[method]
+
+    def __compress_block(self, job):
+        (src, offset) = job
+        f = open(src, "rb")
+        try:
+            f.seek(offset)
+            data = f.read(self.blocksize)
+        finally:
+            f.close()
+
+        args = list(self.command)
+        if self.level is not None:
+            args.append("-%d" % self.level)
+        p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        out = p.communicate(data)[0]
+        if p.returncode != 0:
+            raise CreatorError("%s failed compressing block at %d of %s" %
+                               (self.method, offset, src))
+        return (data, out)
+
+    def compress(self, src, dst = None, hasher = None):
+        """Compress src to dst (default src + suffix) and write its index.
+
+        If hasher is given (see checksum.MultiHasher) the uncompressed
+        data is fed to it in order as it is compressed, so the image
+        does not need to be read again to checksum it.
+
+        Returns the index as a dict.
+        """
+        if dst is None:
+            dst = src + self.suffix
+        size = os.path.getsize(src)
+        offsets = range(0, size, self.blocksize)
+        logging.debug("compressing %s to %s with %s in %d blocks" %
+                      (src, dst, self.method, len(offsets)))
+
+        index = {'format': self.method,
+                 'block_size': self.blocksize,
+                 'size': size,
+                 'blocks': []}
+        coffset = 0
+        out = open(dst, "wb")
+        try:
+            # Blocks are compressed a window at a time so that only a
+            # bounded number of compressed blocks are held in memory
+            # while they wait to be written out in order.
+            window = self.workers * 2
+            for i in range(0, len(offsets), window):
+                jobs = [(src, o) for o in offsets[i:i+window]]
+                results = parallel_map(self.__compress_block, jobs, self.workers)
+                for n in range(len(results)):
+                    (udata, data) = results[n]
+                    if hasher:
+                        hasher.update(udata)
+                    out.write(data)
+                    index['blocks'].append([jobs[n][1], len(udata), coffset, len(data)])
+                    coffset += len(data)
+        finally:
+            out.close()
+
+        idx = open(dst + ".idx", "w")
+        json.dump(index, idx)
+        idx.close()
+        logging.debug("compressed %s from %d to %d bytes" % (src, size, coffset))
+        return index
+
+
+def read_block_index(path):
+    """Load the block index written alongside a compressed image."""
+    f = open(path)
+    try:
+        return json.load(f)
+    finally:
+        f.close()
+
+def decompress_range(path, offset, length, index = None):
+    """Return length bytes at uncompressed offset of a block compressed
+    image, decompressing only the blocks which cover that range."""
+    if index is None:
+        index = read_block_index(path + ".idx")
+    (command, suffix) = COMPRESSORS[index['format']]
+    args = [command[0], "-d", "-c", "-q"]
+
+    data = ""
+    end = offset + length
+    f = open(path, "rb")
+    try:
+        for (uoff, ulen, coff, clen) in index['blocks']:
+            if uoff + ulen <= offset or uoff >= end:
+                continue
+            f.seek(coff)
+            p = subprocess.Popen(args, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            block = p.communicate(f.read(clen))[0]
+            if p.returncode != 0:
+                raise CreatorError("Unable to decompress block at %d of %s" % (uoff, path))
+            data += block[max(offset - uoff, 0):end - uoff]
+    finally:
+        f.close()
+    return data
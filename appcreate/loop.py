@@ -0,0 +1,97 @@
+#
+# loop.py: race free loop device allocation
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import glob
+import fcntl
+import subprocess
+import logging
+
+from imgcreate.errors import *
+from imgcreate.fs import SparseLoopbackDisk
+
+# every appliance-tools process on the host allocates loop devices
+# while holding this lock, so no two of them pick the same free device
+LOOP_LOCK = "/var/lock/appliance-tools-loop.lock"
+
+
+def _lock():
+    lockdir = os.path.dirname(LOOP_LOCK)
+    if not os.path.isdir(lockdir):
+        os.makedirs(lockdir)
+    fd = os.open(LOOP_LOCK, os.O_RDWR | os.O_CREAT, 0644)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    return fd
+
+def _unlock(fd):
+    fcntl.flock(fd, fcntl.LOCK_UN)
+    os.close(fd)
+
+def attach_loop(path, readonly = False):
+    """Attach path to a free loop device and return the device."""
+    args = ["/sbin/losetup", "--find", "--show"]
+    if readonly:
+        args.append("--read-only")
+    fd = _lock()
+    try:
+        losetup = subprocess.Popen(args + [path], stdout=subprocess.PIPE)
+        device = losetup.communicate()[0].strip()
+        if losetup.returncode != 0 or not device:
+            raise MountError("Failed to allocate loop device for '%s'" % path)
+    finally:
+        _unlock(fd)
+    logging.debug("Losetup add %s mapping to %s" % (device, path))
+    return device
+
+def detach_loop(device):
+    """Detach the loop device returned by attach_loop."""
+    logging.debug("Losetup remove %s" % device)
+    if subprocess.call(["/sbin/losetup", "-d", device]) != 0:
+        raise MountError("Failed to detach loop device %s" % device)
+
+def free_loop_devices():
+    """Returns the number of loop devices which can still be attached,
+    or None when the kernel creates them on demand without a limit."""
+    free = 0
+    for dev in glob.glob("/sys/block/loop*"):
+        if not os.path.exists(os.path.join(dev, "loop", "backing_file")):
+            free += 1
+    max_loop = 0
+    try:
+        f = open("/sys/module/loop/parameters/max_loop")
+        try:
+            max_loop = int(f.read())
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        pass
+    if max_loop == 0 and os.path.exists("/dev/loop-control"):
+        return None
+    return free
+
+
+class PooledLoopbackDisk(SparseLoopbackDisk):
+    """A SparseLoopbackDisk which attaches its loop device under the host
+    wide loop lock instead of racing other builds between losetup -f
+    and losetup."""
+
+    def create(self):
+        if self.device is not None:
+            return
+        self.expand(create = True)
+        self.device = attach_loop(self.lofile)
@@ -0,0 +1,110 @@
+#
+# ova.py: write OVA archives in a single pass
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import time
+import hashlib
+import tarfile
+import logging
+
+from imgcreate.errors import *
+
+
+class _HashingWriter(object):
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+        self.size = 0
+
+    def write(self, data):
+        self.fileobj.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+
+class OvaArchive(object):
+    """An OVA: a tar archive of an OVF descriptor, the files it references
+    and a manifest of their SHA256 digests.
+
+    Members whose size is not known up front (disks converted on the fly)
+    are written by a function straight into the archive; the tar header
+    is patched with the size afterwards, so the output file has to be
+    seekable but every member is only written once. The digests are
+    computed while writing and the manifest is added last, as the OVF
+    specification allows.
+    """
+
+    def __init__(self, path, name):
+        self.path = path
+        self.name = name
+        self.manifest = []
+        try:
+            self.fileobj = open(path, "wb")
+        except IOError, e:
+            raise CreatorError("Unable to create %s: %s" % (path, e))
+
+    def __tarinfo(self, arcname, size):
+        tarinfo = tarfile.TarInfo(arcname)
+        tarinfo.size = size
+        tarinfo.mtime = int(time.time())
+        tarinfo.mode = 0644
+        # ustar as the OVF specification asks, GNU for members over 8 GB
+        if size < 8 ** 11:
+            return tarinfo.tobuf(tarfile.USTAR_FORMAT)
+        return tarinfo.tobuf(tarfile.GNU_FORMAT)
+
+    def __pad(self, size):
+        self.fileobj.write("\0" * (-size % tarfile.BLOCKSIZE))
+
+    def add_data(self, arcname, data, digest = True):
+        """Add a member holding the string data."""
+        self.fileobj.write(self.__tarinfo(arcname, len(data)))
+        self.fileobj.write(data)
+        self.__pad(len(data))
+        if digest:
+            self.manifest.append((arcname, hashlib.sha256(data).hexdigest()))
+
+    def add_stream(self, arcname, func):
+        """Add a member written by func, which is called with a file like
+        object to write the contents to."""
+        start = self.fileobj.tell()
+        placeholder = self.__tarinfo(arcname, 0)
+        self.fileobj.write(placeholder)
+        out = _HashingWriter(self.fileobj)
+        func(out)
+        self.__pad(out.size)
+        end = self.fileobj.tell()
+
+        header = self.__tarinfo(arcname, out.size)
+        if len(header) != len(placeholder):
+            raise CreatorError("Unable to add %s to %s, tar header size changed" %
+                               (arcname, self.path))
+        self.fileobj.seek(start)
+        self.fileobj.write(header)
+        self.fileobj.seek(end)
+        self.manifest.append((arcname, out.hash.hexdigest()))
+        logging.debug("added %s (%d bytes) to %s" % (arcname, out.size, self.path))
+
+    def close(self):
+        mf = "".join(["SHA256(%s)= %s\n" % (arcname, digest)
+                      for (arcname, digest) in self.manifest])
+        self.add_data(self.name + ".mf", mf, digest = False)
+        # two zero blocks end the archive, padded to a full tar record
+        self.fileobj.write("\0" * tarfile.BLOCKSIZE * 2)
+        self.fileobj.write("\0" * (-self.fileobj.tell() % tarfile.RECORDSIZE))
+        self.fileobj.close()
@@ -0,0 +1,175 @@
+#
+# parallel.py: bounded worker pool helpers for appliance creation
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import sys
+import threading
+import Queue
+import logging
+import multiprocessing
+
+
+def default_workers():
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def parallel_map(func, items, workers = None):
+    """Run func over every item on a bounded pool of threads.
+
+    Results are returned in the same order as items. If any call raises,
+    the remaining queued items are abandoned and the first exception is
+    re-raised in the caller once the running workers have finished.
+
+    Threads are used rather than processes because the work handed to
+    this helper is either a child process (qemu-img, mkfs, ...) or code
+    which releases the GIL (hashlib, zlib, bz2, file I/O).
+    """
+    items = list(items)
+    if workers is None or workers < 1:
+        workers = default_workers()
+    workers = min(workers, len(items))
+
+    if workers <= 1:
+        return [func(item) for item in items]
+
+    results = [None] * len(items)
+    errors = []
+    todo = Queue.Queue()
+    for i in range(len(items)):
+        todo.put(i)
+
+    def worker():
+        while not errors:
+            try:
+                i = todo.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(items[i])
+            except:
+                errors.append(sys.exc_info())
+                return
+
+    threads = []
+    for n in range(workers):
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+    for t in threads:
+        t.join()
+
+    if errors:
+        (etype, evalue, etb) = errors[0]
+        if len(errors) > 1:
+            logging.debug("%d parallel jobs failed, reporting the first" % len(errors))
+        raise etype, evalue, etb
+
+    return results
+
+def parallel_imap(func, items, workers = None):
+    """Like parallel_map but lazily consumes an iterator of items and
+    yields the results in order, holding at most two items per worker
+    in memory at a time."""
+    if workers is None or workers < 1:
+        workers = default_workers()
+    window = []
+    for item in items:
+        window.append(item)
+        if len(window) >= workers * 2:
+            for result in parallel_map(func, window, workers):
+                yield result
+            window = []
+    if window:
+        for result in parallel_map(func, window, workers):
+            yield result
+
+def parallel_imap_unordered(func, items, workers = None):
+    """Like parallel_imap but yields the results as they complete.
+
+    The same threads work through all of items, which are handed to them
+    through a bounded queue, so a slow item only holds up its own
+    worker. At most two items per worker are in flight at a time. If any
+    call raises, no further items are started and the first exception is
+    re-raised once the workers have stopped.
+    """
+    if workers is None or workers < 1:
+        workers = default_workers()
+    if workers <= 1:
+        for item in items:
+            yield func(item)
+        return
+
+    todo = Queue.Queue(workers * 2)
+    done = Queue.Queue()
+    errors = []
+    abort = []
+    stop = object()
+
+    def worker():
+        while True:
+            item = todo.get()
+            if item is stop:
+                return
+            if errors or abort:
+                done.put(None)
+                continue
+            try:
+                done.put((func(item),))
+            except:
+                errors.append(sys.exc_info())
+                done.put(None)
+
+    threads = []
+    for n in range(workers):
+        t = threading.Thread(target=worker)
+        t.setDaemon(True)
+        t.start()
+        threads.append(t)
+
+    try:
+        pending = 0
+        for item in items:
+            while pending and (pending >= workers * 2 or not done.empty()):
+                result = done.get()
+                pending -= 1
+                if result is None:
+                    break
+                yield result[0]
+            if errors:
+                break
+            todo.put(item)
+            pending += 1
+        while pending and not errors:
+            result = done.get()
+            pending -= 1
+            if result is not None:
+                yield result[0]
+    finally:
+        abort.append(True)
+        for t in threads:
+            todo.put(stop)
+        for t in threads:
+            t.join()
+
+    if errors:
+        (etype, evalue, etb) = errors[0]
+        if len(errors) > 1:
+            logging.debug("%d parallel jobs failed, reporting the first" % len(errors))
+        raise etype, evalue, etb
@@ -24,10 +24,21 @@ import glob
 import shutil
 import subprocess
 import logging
+import time
 import re
+import tempfile
 
 from imgcreate.errors import *
 from imgcreate.fs import *
+from appcreate.partitiontable import open_partition_table, PartitionTable, SECTOR_SIZE
+from appcreate.parallel import parallel_map
+from appcreate.superblock import probe, new_uuid
+from appcreate.stats import Stats
+from appcreate.sparse import splice, extract, move, punch_hole
+
+# filesystems shrink() can resize
+SHRINKABLE_FSTYPES = ('ext2', 'ext3', 'ext4')
+MB = 1024 * 1024L
 
 
 class PartitionedMount(Mount):
@@ -48,26 +59,37 @@ class PartitionedMount(Mount):
         self.unmountOrder = []
         self.partition_layout = partition_layout
         self.has_extended = False # Has extended partition layout
+        self.jobs = None # Number of partitions formatted at once, None for one per cpu
+        self.uuid_seed = None # Derive filesystem UUIDs from this, None for random ones
+        self.stats = Stats() # Timing and resource usage of the formatting steps
+        self.existing = False # True if the disks already hold the partitions and filesystems
+
+    def __uuid_seed(self, disk, mountpoint):
+        if self.uuid_seed is None:
+            return None
+        return "%s:%s:%s" % (self.uuid_seed, disk, mountpoint)
+
+    def add_partition(self, size, disk, mountpoint, fstype = None, fsuuid = None):
+        # UUIDs are picked here and handed to mkfs, so that fstab and the
+        # bootloader configs can be rendered before anything is formatted
+        if fsuuid is None and mountpoint == '/boot/uboot':
+            fsuuid = new_uuid('vfat', self.__uuid_seed(disk, mountpoint))
+        elif fsuuid is None and mountpoint != 'biosboot':
+            fsuuid = new_uuid(fstype, self.__uuid_seed(disk, mountpoint))
 
-    def add_partition(self, size, disk, mountpoint, fstype = None):
         self.partitions.append({'size': size,
                                 'mountpoint': mountpoint, # Mount relative to chroot
                                 'fstype': fstype,
                                 'disk': disk,  # physical disk name holding partition
                                 'device': None, # kpartx device node for partition
                                 'mount': None, # Mount object
-                                'UUID': None, # UUID for partition
+                                'fsuuid': fsuuid, # UUID given to mkfs
+                                'UUID': fsuuid and "UUID=" + fsuuid, # UUID for partition
+                                'format_time': None, # Seconds taken to create the filesystem
+                                'table': None, # Entry in the written partition table
                                 'num': None}) # Partition number
 
-    def __format_disks(self):
-        logging.debug("Formatting disks")
-        for dev in self.disks.keys():
-            d = self.disks[dev]
-            logging.debug("Initializing partition table for %s with %s layout" % (d['disk'].device, self.partition_layout))
-            rc = subprocess.call(["/sbin/parted", "-s", d['disk'].device, "mklabel", "%s" % self.partition_layout])
-            if rc != 0:
-                raise MountError("Error writing partition table on %s" % d['disk'].device)
-
+    def _assign_partitions(self):
         logging.debug("Assigning partitions to disks")
         for n in range(len(self.partitions)):
             p = self.partitions[n]
@@ -82,6 +104,8 @@ class PartitionedMount(Mount):
                 d['extended'] += p['size']
                 p['type'] = 'logical'
                 p['num'] = d['numpart'] + 1
+                if p['num'] == 5:
+                    self.has_extended = True
             else:
                 p['type'] = 'primary'
                 p['num'] = d['numpart']
@@ -92,30 +116,50 @@ class PartitionedMount(Mount):
             d['partitions'].append(n)
             logging.debug("Assigned %s to %s%d at %d at size %d" % (p['mountpoint'], p['disk'], p['num'], p['start'], p['size']))
 
-        # XXX we should probably work in cylinder units to keep fdisk happier..
-        start = 0
-        logging.debug("Creating partitions")
-        for p in self.partitions:
-            d = self.disks[p['disk']]
+    def _disk_path(self, d):
+        """The file or device the partition table of disk d is written to."""
+        return d['disk'].device
+
+    def __fill_table(self, table, d):
+        for n in d['partitions']:
+            p = self.partitions[n]
             if p['num'] == 5 and self.partition_layout == 'msdos':
-                self.has_extended = True
                 logging.debug("Added extended part at %d of size %d" % (p['start'], d['extended']))
-                rc = subprocess.call(["/sbin/parted", "-s", d['disk'].device, "mkpart", "extended",
-                                      "%dM" % p['start'], "%dM" % (p['start'] + d['extended'])])
-
+            flags = []
+            if p['mountpoint'] == '/boot/uboot':
+                flags.append('boot')
+            if p['mountpoint'] == 'biosboot' and self.partition_layout == 'gpt':
+                flags.append('bios_grub')
             logging.debug("Add %s part at %d of size %d" % (p['type'], p['start'], p['size']))
-            if p['fstype'].startswith('ext'):
-                fstype = 'ext2'
-            if p['fstype'] == 'vfat':
-                fstype = 'fat32'
-            rc = subprocess.call(["/sbin/parted", "-a", "opt", "-s", d['disk'].device, "mkpart",
-                                  p['type'], fstype, "%dM" % p['start'], "%dM" % (p['start']+p['size'])])
-
-            # XXX disabled return code check because parted always fails to
-            # reload part table with loop devices. Annoying because we can't
-            # distinguish this failure from real partition failures :-(
-            #if rc != 0 and 1 == 0: 
-            #    raise MountError("Error creating partition on %s" % d['disk'].device)
+            # sector offsets are filled in by place() or write()
+            p['table'] = table.add_partition(p['start'], p['size'], p['type'], p['fstype'], flags)
+
+    def _write_partition_tables(self):
+        for dev in self.disks.keys():
+            d = self.disks[dev]
+            path = self._disk_path(d)
+            logging.debug("Writing partition table for %s with %s layout" % (path, self.partition_layout))
+            table = open_partition_table(path, self.partition_layout)
+            self.__fill_table(table, d)
+            table.write(path)
+
+    def plan(self):
+        """Number, order and place the partitions like mount() does,
+        without creating, writing or mounting anything."""
+        self._assign_partitions()
+        for dev in self.disks.keys():
+            d = self.disks[dev]
+            table = PartitionTable(self.partition_layout, d['disk'].size / SECTOR_SIZE)
+            self.__fill_table(table, d)
+            table.place()
+        self._calculate_mountorder()
+
+    def __format_disks(self):
+        logging.debug("Formatting disks")
+        self._assign_partitions()
+        if self.existing:
+            return
+        self._write_partition_tables()
 
     def __map_partitions(self):
         for dev in self.disks.keys():
@@ -203,7 +247,7 @@ class PartitionedMount(Mount):
             d['mapped'] = False
 
 
-    def __calculate_mountorder(self):
+    def _calculate_mountorder(self):
         for p in self.partitions:
             self.mountOrder.append(p['mountpoint'])
             self.unmountOrder.append(p['mountpoint'])
@@ -211,7 +255,7 @@ class PartitionedMount(Mount):
         self.mountOrder.sort()
         self.unmountOrder.sort()
         self.unmountOrder.reverse()
-        print str(self.mountOrder)
+        logging.debug("Mount order %s" % self.mountOrder)
 
     def cleanup(self):
         Mount.cleanup(self)
@@ -240,14 +284,53 @@ class PartitionedMount(Mount):
                     pass
                 p['mount'] = None
 
+    def __format_partition(self, p):
+        """Create the filesystem (or swap) of a single partition."""
+        mp = p['mountpoint']
+        if mp == 'biosboot':
+            # flagged bios_grub when the table was written, no filesystem
+            return
+        start = time.time()
+        with self.stats.phase("mkfs", mountpoint=mp, fstype=p['fstype'], size_mb=p['size']):
+            if mp == '/boot/uboot':
+                # the partition was marked bootable when the table was written
+                subprocess.call(["/sbin/mkfs.vfat", "-n", "uboot",
+                                 "-i", p['fsuuid'].replace("-", ""), p['device']])
+            elif mp == 'swap':
+                subprocess.call(["/sbin/mkswap", "-L", "_swap", "-U", p['fsuuid'], p['device']])
+            else:
+                logging.debug("Formating %s filesystem on %s" % (p['fstype'], p['device']))
+                rc = subprocess.call(["/sbin/mkfs." + p['fstype'], "-F", "-L", p['mountpoint'],
+                                      "-m", "1", "-b", "4096", "-U", p['fsuuid'], p['device']])
+                if rc != 0:
+                    raise MountError("Error creating %s filesystem on %s" % (p['fstype'], p['device']))
+                subprocess.call(["/sbin/tune2fs", "-c0", "-i0", "-Odir_index",
+                                 "-ouser_xattr,acl", p['device']])
+            self._check_uuid(p, p['device'])
+        p['format_time'] = time.time() - start
+        logging.info("Formatted %s (%s, %dM) in %.1fs" %
+                     (mp, p['fstype'], p['size'], p['format_time']))
+
     def mount(self):
         for dev in self.disks.keys():
             d = self.disks[dev]
             d['disk'].create()
 
-        self.__format_disks()
-        self.__map_partitions()
-        self.__calculate_mountorder()
+        with self.stats.phase("partition"):
+            self.__format_disks()
+            self.__map_partitions()
+        self._calculate_mountorder()
+
+        # The partitions are independent block devices, so create all
+        # their filesystems at once and only mount them in order after
+        if self.existing:
+            logging.info("Mounting the existing filesystems of %d partitions" % len(self.partitions))
+        else:
+            start = time.time()
+            with self.stats.phase("format", partitions=len(self.partitions)):
+                parallel_map(self.__format_partition, self.partitions, self.jobs)
+            logging.info("Formatted %d partitions in %.1fs" %
+                         (len(self.partitions), time.time() - start))
 
         for mp in self.mountOrder:
             p = None
@@ -258,44 +341,353 @@ class PartitionedMount(Mount):
 
             if mp == '/boot/uboot':
                 subprocess.call(["/bin/mkdir", "-p", "%s%s" % (self.mountdir, p['mountpoint'])])
-                # mark the partition bootable
-                subprocess.call(["/sbin/parted", "-s", self.disks[p['disk']]['disk'].device, "set", str(p['num']), "boot", "on"])
-                subprocess.call(["/sbin/mkfs.vfat", "-n", "uboot", p['device']])
-                p['UUID'] = self.__getuuid(p['device'])
                 continue
 
-            if mp == 'biosboot':
-                subprocess.call(["/sbin/parted", "-s", self.disks[p['disk']]['disk'].device, "set", "1", "bios_grub", "on"])
-                continue
-
-            if mp == 'swap':
-                subprocess.call(["/sbin/mkswap", "-L", "_swap", p['device']])
-                p['UUID'] = self.__getuuid(p['device'])
+            if mp == 'biosboot' or mp == 'swap':
                 continue
 
             rmmountdir = False
             if p['mountpoint'] == "/":
                 rmmountdir = True
-            pdisk = ExtDiskMount(RawDisk(p['size'] * 1024 * 1024, p['device']),
-                                 self.mountdir + p['mountpoint'],
-                                 p['fstype'],
-                                 4096,
-                                 p['mountpoint'],
-                                 rmmountdir)
+            pdisk = DiskMount(RawDisk(p['size'] * 1024 * 1024, p['device']),
+                              self.mountdir + p['mountpoint'],
+                              p['fstype'],
+                              rmmountdir)
             pdisk.mount()
             p['mount'] = pdisk
-            p['UUID'] = self.__getuuid(p['device'])
+
+    def __allocated(self):
+        allocated = 0
+        for dev in self.disks.keys():
+            allocated += os.stat(self.disks[dev]['disk'].lofile).st_blocks * 512L
+        return allocated
 
     def resparse(self, size = None):
-        # Can't re-sparse a disk image - too hard
-        pass
+        """Discard the free blocks of every mounted filesystem.
+
+        The loop driver turns the discards into holes punched in the
+        backing sparse files, so blocks written during the install and
+        freed again (the yum cache, ...) are not converted, compressed
+        and checksummed later on. Does nothing once the partitions are
+        unmounted. Returns the number of bytes reclaimed.
+        """
+        mounted = [p for p in self.partitions if p['mount'] != None]
+        if not mounted:
+            logging.debug("No mounted partitions to resparse")
+            return 0
+
+        before = self.__allocated()
+        for p in mounted:
+            mp = self.mountdir + p['mountpoint']
+            logging.debug("Discarding free blocks of %s" % mp)
+            try:
+                with self.stats.phase("fstrim", mountpoint=p['mountpoint']):
+                    rc = subprocess.call(["fstrim", mp])
+            except OSError, e:
+                logging.warning("Unable to run fstrim, disks will not be resparsed: %s" % e)
+                return 0
+            if rc != 0:
+                logging.warning("Unable to discard free blocks of %s" % mp)
+        after = self.__allocated()
+
+        reclaimed = max(before - after, 0)
+        logging.info("Resparse reclaimed %d MB (%d MB allocated)" %
+                     (reclaimed / 1024 / 1024, after / 1024 / 1024))
+        return reclaimed
+
+    def __measure(self, job):
+        """Extract the filesystem of a partition to image, check it and
+        return the smallest size in bytes it can be shrunk to."""
+        (p, path, image) = job
+        with self.stats.phase("extract", mountpoint=p['mountpoint']):
+            extract(path, p['table']['start'] * SECTOR_SIZE,
+                    p['table']['sectors'] * SECTOR_SIZE, image)
+        with self.stats.phase("fsck", mountpoint=p['mountpoint']):
+            rc = subprocess.call(["/sbin/e2fsck", "-f", "-y", image])
+        # 1 means errors were corrected
+        if rc & ~1:
+            raise MountError("Filesystem check of %s failed with status %d" % (p['mountpoint'], rc))
+        resize = subprocess.Popen(["/sbin/resize2fs", "-P", image], stdout=subprocess.PIPE)
+        out = resize.communicate()[0]
+        m = re.search(r"minimum size of the filesystem: (\d+)", out)
+        if resize.returncode != 0 or m is None:
+            raise MountError("Unable to find the minimum size of %s" % p['mountpoint'])
+        return int(m.group(1)) * probe(image)['block_size']
+
+    def __resize(self, job):
+        (p, image, size) = job
+        with self.stats.phase("resize2fs", mountpoint=p['mountpoint'], size_mb=size / MB):
+            rc = subprocess.call(["/sbin/resize2fs", image, "%dK" % (size / 1024)])
+        if rc != 0:
+            raise MountError("Unable to shrink %s to %dM" % (p['mountpoint'], size / MB))
+
+    def shrink(self, headroom = 10, pinned = []):
+        """Shrink the disk images to what they hold.
+
+        Every ext filesystem is shrunk to its minimum size plus headroom
+        percent, the partitions behind it are moved down, the partition
+        tables rewritten and the disk images truncated. Partitions up to
+        the last biosboot partition or mount point in pinned keep their
+        place and size, the boot code refers to their sectors.
+
+        resize2fs cannot resize a filesystem inside a larger image file,
+        so the data of every ext filesystem is extracted to an image of
+        its own next to the disk, shrunk there and copied back to its
+        new place. Works on the disk image files, so the partitions must
+        not be mapped. Returns the number of bytes the disks shrank by.
+        """
+        saved = 0
+        for dev in self.disks.keys():
+            d = self.disks[dev]
+            path = d['disk'].lofile
+            parts = [self.partitions[n] for n in d['partitions']]
+            for p in parts:
+                if p['table'] is None:
+                    raise MountError("No partition table written for %s" % path)
+
+            keep = 0
+            for i in range(len(parts)):
+                if parts[i]['mountpoint'] == 'biosboot' or parts[i]['mountpoint'] in pinned:
+                    keep = i + 1
+            shrinkable = [p for p in parts[keep:] if p['fstype'] in SHRINKABLE_FSTYPES]
+            if not shrinkable:
+                logging.info("Nothing to shrink on %s" % path)
+                continue
+
+            tmpdir = tempfile.mkdtemp(prefix = "shrink-", dir = os.path.dirname(path))
+            try:
+                images = {}
+                for p in shrinkable:
+                    images[parts.index(p)] = os.path.join(tmpdir, "part%d.img" % p['num'])
+                with self.stats.phase("measure", disk=dev):
+                    minimum = parallel_map(self.__measure,
+                                           [(p, path, images[parts.index(p)]) for p in shrinkable],
+                                           self.jobs)
+                sizes = [p['size'] for p in parts]
+                minimums = {}
+                for (p, size) in zip(shrinkable, minimum):
+                    i = parts.index(p)
+                    minimums[i] = size
+                    # the MiB holding the filesystem and its headroom; a
+                    # logical partition is placed a full MiB behind its EBR
+                    reserved = SECTOR_SIZE
+                    if p['type'] == 'logical':
+                        reserved = MB
+                    size = (size * (100 + headroom) / 100 + reserved + MB - 1) / MB
+                    sizes[i] = min(sizes[i], size)
+
+                old_sectors = d['disk'].size / SECTOR_SIZE
+                # the first MiB holds the partition table, the last one the
+                # backup gpt
+                sectors = (1 + sum(sizes)) * MB / SECTOR_SIZE
+                if self.partition_layout == 'gpt':
+                    sectors += MB / SECTOR_SIZE
+                if sectors >= old_sectors:
+                    logging.info("%s cannot be shrunk" % path)
+                    continue
+
+                old = [(p['table']['start'], p['table']['sectors']) for p in parts]
+                offset = 1
+                for (p, size) in zip(parts, sizes):
+                    p['size'] = size
+                    p['start'] = offset
+                    offset += size
+                d['extended'] = sum([p['size'] for p in parts if p['type'] == 'logical'])
+                table = PartitionTable(self.partition_layout, sectors)
+                self.__fill_table(table, d)
+                table.place()
+
+                resize = [(parts[i], images[i], parts[i]['table']['sectors'] * SECTOR_SIZE / 4096 * 4096)
+                          for i in sorted(images.keys())
+                          if parts[i]['table']['sectors'] < old[i][1]]
+                for (p, image, size) in resize:
+                    if size < minimums[parts.index(p)]:
+                        raise MountError("%s would be shrunk to %dK, below its minimum of %dK" %
+                                         (p['mountpoint'], size / 1024,
+                                          minimums[parts.index(p)] / 1024))
+                parallel_map(self.__resize, resize, self.jobs)
+
+                # every partition only moves down and ends before the old
+                # place of the next one, so they are moved front to back
+                fd = os.open(path, os.O_RDWR)
+                try:
+                    with self.stats.phase("move", disk=dev):
+                        ends = []
+                        for i in range(len(parts)):
+                            start = parts[i]['table']['start'] * SECTOR_SIZE
+                            length = min(old[i][1], parts[i]['table']['sectors']) * SECTOR_SIZE
+                            if images.has_key(i):
+                                punch_hole(fd, start, length)
+                                splice(images[i], path, start)
+                            else:
+                                move(path, old[i][0] * SECTOR_SIZE, start, length)
+                            ends.append(start + length)
+                        # what the moved partitions left behind up to the next one
+                        starts = [p['table']['start'] * SECTOR_SIZE for p in parts[1:]]
+                        for (end, start) in zip(ends, starts + [sectors * SECTOR_SIZE]):
+                            punch_hole(fd, end, start - end)
+                        os.ftruncate(fd, sectors * SECTOR_SIZE)
+                finally:
+                    os.close(fd)
+                with self.stats.phase("partition"):
+                    table.write(path)
+            finally:
+                shutil.rmtree(tmpdir, ignore_errors = True)
+
+            saved += (old_sectors - sectors) * SECTOR_SIZE
+            d['disk'].size = sectors * SECTOR_SIZE
+            logging.info("Shrank %s from %dM to %dM" % (path, old_sectors * SECTOR_SIZE / MB,
+                                                       sectors * SECTOR_SIZE / MB))
+        return saved
+
+    def _check_uuid(self, p, path):
+        # make sure mkfs used the UUID the configs were rendered with
+        info = probe(path)
+        if info is None:
+            logging.warning("No filesystem found on %s after formatting %s" %
+                            (path, p['mountpoint']))
+            p['UUID'] = None
+        elif info['uuid'] != p['fsuuid']:
+            logging.warning("%s was formatted with UUID %s instead of %s" %
+                            (p['mountpoint'], info['uuid'], p['fsuuid']))
+            p['fsuuid'] = info['uuid']
+            p['UUID'] = "UUID=" + info['uuid']
+
+
+class DirectoryPartitionedMount(PartitionedMount):
+    """A PartitionedMount which installs into a plain directory tree.
+
+    Nothing is attached, mapped or mounted: mount() only creates the
+    mount points in the tree. Once the tree is complete build_disks()
+    writes the partition tables to the disk images, creates every
+    filesystem as a standalone sparse image filled from its subtree
+    (mkfs.ext* -d, mkfs.vfat and mcopy, mkswap) and copies the data of
+    these images into the disk images at the partition offsets.
+    """
 
-    def __getuuid(self, partition):
-        devdata = subprocess.Popen(["/sbin/blkid", partition], stdout=subprocess.PIPE)
-        devdataout = devdata.communicate()[0].split()
-        for data in devdataout:
-            if data.startswith("UUID"):
-                UUID = data.replace('"', '')
+    def __init__(self, disks, mountdir, partition_layout):
+        PartitionedMount.__init__(self, disks, mountdir, partition_layout)
+        self.built = False # True once the disk images are assembled
+
+    def _disk_path(self, d):
+        return d['disk'].lofile
+
+    def mount(self):
+        with self.stats.phase("partition"):
+            self._assign_partitions()
+        self._calculate_mountorder()
+        for mp in self.mountOrder:
+            if mp == 'biosboot' or mp == 'swap':
                 continue
-        return UUID
+            if not os.path.isdir(self.mountdir + mp):
+                os.makedirs(self.mountdir + mp)
+
+    def unmount(self):
+        pass
 
+    def __create_image(self, path, size):
+        fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(fd, size)
+        finally:
+            os.close(fd)
+
+    def __detach_trees(self, staging):
+        """Move the subtree of every nested mount point out of the tree
+        of its parent, deepest first, so that each filesystem is built
+        from the files it will hold. Returns the tree of every mount
+        point."""
+        trees = {}
+        mountpoints = [mp for mp in self.mountOrder if mp.startswith("/")]
+        mountpoints.sort(key = len, reverse = True)
+        for i in range(len(mountpoints)):
+            mp = mountpoints[i]
+            if mp == "/":
+                trees[mp] = self.mountdir
+                continue
+            tree = os.path.join(staging, "tree%d" % i)
+            os.rename(self.mountdir + mp, tree)
+            os.mkdir(self.mountdir + mp)
+            shutil.copystat(tree, self.mountdir + mp)
+            trees[mp] = tree
+        return trees
+
+    def __attach_trees(self, trees):
+        mountpoints = trees.keys()
+        mountpoints.sort(key = len)
+        for mp in mountpoints:
+            if mp == "/":
+                continue
+            os.rmdir(self.mountdir + mp)
+            os.rename(trees[mp], self.mountdir + mp)
+
+    def __build_partition(self, p, trees, staging):
+        """Create the filesystem image of a single partition and copy it
+        into its disk image."""
+        mp = p['mountpoint']
+        if mp == 'biosboot':
+            # flagged bios_grub when the table was written, no filesystem
+            return
+        image = os.path.join(staging, "%s%d.img" % (p['disk'], p['num']))
+        self.__create_image(image, p['table']['sectors'] * 512L)
+        start = time.time()
+        try:
+            with self.stats.phase("mkfs", mountpoint=mp, fstype=p['fstype'], size_mb=p['size']):
+                if mp == '/boot/uboot':
+                    rc = subprocess.call(["/sbin/mkfs.vfat", "-n", "uboot",
+                                          "-i", p['fsuuid'].replace("-", ""), image])
+                    entries = [os.path.join(trees[mp], e) for e in os.listdir(trees[mp])]
+                    if rc == 0 and entries:
+                        rc = subprocess.call(["mcopy", "-s", "-p", "-Q", "-i", image] +
+                                             entries + ["::/"])
+                elif mp == 'swap':
+                    rc = subprocess.call(["/sbin/mkswap", "-L", "_swap", "-U", p['fsuuid'], image])
+                else:
+                    logging.debug("Creating %s filesystem of %s in %s" % (p['fstype'], mp, image))
+                    rc = subprocess.call(["/sbin/mkfs." + p['fstype'], "-F", "-L", mp,
+                                          "-m", "1", "-b", "4096", "-U", p['fsuuid'],
+                                          "-d", trees[mp], image])
+                    if rc == 0:
+                        subprocess.call(["/sbin/tune2fs", "-c0", "-i0", "-Odir_index",
+                                         "-ouser_xattr,acl", image])
+                if rc != 0:
+                    raise MountError("Error creating %s filesystem of %s" % (p['fstype'], mp))
+                self._check_uuid(p, image)
+            p['format_time'] = time.time() - start
+            with self.stats.phase("splice", mountpoint=mp):
+                disk = self._disk_path(self.disks[p['disk']])
+                copied = splice(image, disk, p['table']['start'] * 512L)
+        finally:
+            os.unlink(image)
+        logging.info("Built %s (%s, %dM, %dM of data) in %.1fs" %
+                     (mp, p['fstype'], p['size'], copied / 1024 / 1024,
+                      time.time() - start))
+
+    def build_disks(self):
+        """Assemble the disk images from the installed tree."""
+        if self.built:
+            return
+        for dev in self.disks.keys():
+            self.__create_image(self.disks[dev]['disk'].lofile,
+                                self.disks[dev]['disk'].size)
+        with self.stats.phase("partition"):
+            self._write_partition_tables()
+
+        # the subtrees are renamed, so they have to be on the filesystem
+        # of the tree; the images go along with them
+        staging = tempfile.mkdtemp(prefix = "partitions-",
+                                   dir = os.path.dirname(self.mountdir.rstrip("/")))
+        try:
+            trees = self.__detach_trees(staging)
+            try:
+                start = time.time()
+                with self.stats.phase("format", partitions=len(self.partitions)):
+                    parallel_map(lambda p: self.__build_partition(p, trees, staging),
+                                 self.partitions, self.jobs)
+                logging.info("Built %d partitions in %.1fs" %
+                             (len(self.partitions), time.time() - start))
+            finally:
+                self.__attach_trees(trees)
+        finally:
+            shutil.rmtree(staging, ignore_errors = True)
+        self.built = True
@@ -0,0 +1,345 @@
+#
+# partitiontable.py: msdos and gpt partition table writer
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import struct
+import uuid
+import zlib
+import random
+import logging
+
+from imgcreate.errors import *
+
+SECTOR_SIZE = 512
+# partitions are aligned to 1MiB, like parted -a opt does
+ALIGNMENT = 1024 * 1024 / SECTOR_SIZE
+
+MSDOS_TYPES = { 'ext': 0x83, 'vfat': 0x0c, 'swap': 0x82, 'extended': 0x05 }
+MSDOS_EXTENDED_TYPES = (0x05, 0x0f, 0x85)
+MSDOS_ACTIVE = 0x80
+
+GPT_TYPES = { 'ext': "0FC63DAF-8483-4772-8E79-3D69D8477DE4",
+              'vfat': "EBD0A0A2-B9E5-4433-87C0-68B6B72699C7",
+              'swap': "0657FD6D-A4AB-43C4-84E5-0933C84B4F4F",
+              'bios_grub': "21686148-6449-6E6F-744E-656564454649",
+              'esp': "C12A7328-F81F-11D2-BA4B-00A0C93EC93B" }
+GPT_ENTRIES = 128
+GPT_ENTRY_SIZE = 128
+# sectors used at each end of the disk by the header and the entries
+GPT_SECTORS = 1 + GPT_ENTRIES * GPT_ENTRY_SIZE / SECTOR_SIZE
+GPT_LEGACY_BOOTABLE = 1 << 2
+
+
+def _fstype_key(fstype):
+    if fstype and fstype.startswith('ext'):
+        return 'ext'
+    if fstype in ('vfat', 'swap'):
+        return fstype
+    return 'ext'
+
+def _chs(lba):
+    # CHS is meaningless on anything we create, but fill it in the
+    # way fdisk does with 255 heads and 63 sectors per track
+    cyl = lba / (255 * 63)
+    if cyl > 1023:
+        return "\xfe\xff\xff"
+    head = (lba / 63) % 255
+    sector = lba % 63 + 1
+    return struct.pack("<BBB", head, sector | ((cyl >> 2) & 0xc0), cyl & 0xff)
+
+def _msdos_entry(status, ptype, start, size):
+    return struct.pack("<B3sB3sII", status, _chs(start), ptype,
+                       _chs(start + size - 1), start, size)
+
+def _disk_sectors(fd):
+    return os.lseek(fd, 0, 2) / SECTOR_SIZE
+
+
+class PartitionTable(object):
+    """An msdos or gpt partition table for a disk or disk image.
+
+    Partitions are given in MiB, in the order they are numbered, and
+    the whole table (including the EBR chain of logical partitions and
+    both gpt copies) is written in one go by write(). Nothing here needs
+    root, a loop device or parted, so it works just as well on a plain
+    file.
+    """
+
+    def __init__(self, layout, sectors):
+        if not layout in ('msdos', 'gpt'):
+            raise MountError("Unsupported partition layout %s" % layout)
+        self.layout = layout
+        self.sectors = sectors
+        self.partitions = []
+
+        if layout == 'gpt':
+            self.first_usable = 1 + GPT_SECTORS
+            self.last_usable = sectors - 1 - GPT_SECTORS
+        else:
+            self.first_usable = 1
+            self.last_usable = sectors - 1
+
+    def add_partition(self, start, size, ptype = 'primary', fstype = None,
+                      flags = [], name = None):
+        """Add a partition starting at start MiB and size MiB long.
+
+        ptype is primary or logical (msdos only), flags may contain
+        'boot' and 'bios_grub'. Returns the partition's dict, whose
+        'start' and 'sectors' are filled in by place() or write().
+        """
+        if size <= 0:
+            raise MountError("Partition size must be positive, not %d" % size)
+        if ptype == 'logical' and self.layout != 'msdos':
+            raise MountError("Logical partitions need an msdos partition table")
+        if 'bios_grub' in flags and self.layout != 'gpt':
+            raise MountError("bios_grub partitions need a gpt partition table")
+        p = { 'mbstart': start,
+              'mbsize': size,
+              'type': ptype,
+              'fstype': fstype,
+              'flags': list(flags),
+              'name': name or ptype,
+              'start': None,
+              'sectors': None }
+        self.partitions.append(p)
+        return p
+
+    def __place(self, p, reserved = 0):
+        # reserved sectors at the start hold the EBR of logical partitions
+        start = p['mbstart'] * ALIGNMENT + reserved
+        end = (p['mbstart'] + p['mbsize']) * ALIGNMENT - 1
+        if start < self.first_usable:
+            start = self.first_usable
+        if end > self.last_usable:
+            logging.debug("Shrinking partition at %dM to fit the disk" % p['mbstart'])
+            end = self.last_usable
+        if end < start:
+            raise MountError("Partition at %dM of size %dM does not fit on a disk of %d sectors" %
+                             (p['mbstart'], p['mbsize'], self.sectors))
+        p['start'] = start
+        p['sectors'] = end - start + 1
+
+    def __check_overlaps(self):
+        spans = [(p['start'], p['start'] + p['sectors']) for p in self.partitions]
+        spans.sort()
+        for i in range(1, len(spans)):
+            if spans[i][0] < spans[i-1][1]:
+                raise MountError("Partitions at sectors %d and %d overlap" %
+                                 (spans[i-1][0], spans[i][0]))
+
+    def __msdos(self):
+        primary = [p for p in self.partitions if p['type'] == 'primary']
+        logical = [p for p in self.partitions if p['type'] == 'logical']
+        if len(primary) + (logical and 1 or 0) > 4:
+            raise MountError("Too many primary partitions for an msdos partition table")
+
+        for p in primary:
+            self.__place(p)
+        for p in logical:
+            self.__place(p, ALIGNMENT)
+        self.__check_overlaps()
+
+        writes = []
+        mbr = "\0" * 440
+        mbr += struct.pack("<I", random.getrandbits(32)) + "\0\0"
+        entries = []
+        for p in primary:
+            status = 'boot' in p['flags'] and MSDOS_ACTIVE or 0
+            entries.append(_msdos_entry(status, MSDOS_TYPES[_fstype_key(p['fstype'])],
+                                        p['start'], p['sectors']))
+
+        if logical:
+            ebrs = [p['mbstart'] * ALIGNMENT for p in logical]
+            ext_start = ebrs[0]
+            ext_end = logical[-1]['start'] + logical[-1]['sectors']
+            entries.append(_msdos_entry(0, MSDOS_TYPES['extended'],
+                                        ext_start, ext_end - ext_start))
+            for i in range(len(logical)):
+                p = logical[i]
+                status = 'boot' in p['flags'] and MSDOS_ACTIVE or 0
+                ebr = "\0" * 446
+                ebr += _msdos_entry(status, MSDOS_TYPES[_fstype_key(p['fstype'])],
+                                    p['start'] - ebrs[i], p['sectors'])
+                if i + 1 < len(logical):
+                    nxt = logical[i+1]
+                    ebr += _msdos_entry(0, MSDOS_TYPES['extended'],
+                                        ebrs[i+1] - ext_start,
+                                        nxt['start'] + nxt['sectors'] - ebrs[i+1])
+                else:
+                    ebr += "\0" * 16
+                ebr += "\0" * 32 + "\x55\xaa"
+                writes.append((ebrs[i], ebr))
+
+        mbr += "".join(entries) + "\0" * 16 * (4 - len(entries)) + "\x55\xaa"
+        writes.insert(0, (0, mbr))
+        return writes
+
+    def __gpt_header(self, current, backup, entries_lba, disk_guid, entries_crc):
+        fields = ["EFI PART", 0x00010000, 92, 0, 0, current, backup,
+                  self.first_usable, self.last_usable, disk_guid,
+                  entries_lba, GPT_ENTRIES, GPT_ENTRY_SIZE, entries_crc]
+        fmt = "<8sIIIIQQQQ16sQIII"
+        header = struct.pack(fmt, *fields)
+        fields[3] = zlib.crc32(header) & 0xffffffff
+        header = struct.pack(fmt, *fields)
+        return header + "\0" * (SECTOR_SIZE - len(header))
+
+    def __gpt(self):
+        if len(self.partitions) > GPT_ENTRIES:
+            raise MountError("Too many partitions for a gpt partition table")
+        for p in self.partitions:
+            self.__place(p)
+        self.__check_overlaps()
+
+        entries = ""
+        for p in self.partitions:
+            if 'bios_grub' in p['flags']:
+                ptype = GPT_TYPES['bios_grub']
+            elif 'boot' in p['flags']:
+                # parted's boot flag on gpt marks the EFI system partition
+                ptype = GPT_TYPES['esp']
+            else:
+                ptype = GPT_TYPES[_fstype_key(p['fstype'])]
+            name = p['name'].encode("utf-16-le")[:72]
+            entries += struct.pack("<16s16sQQQ72s", uuid.UUID(ptype).bytes_le,
+                                   uuid.uuid4().bytes_le, p['start'],
+                                   p['start'] + p['sectors'] - 1, 0, name)
+        entries += "\0" * (GPT_ENTRIES * GPT_ENTRY_SIZE - len(entries))
+        entries_crc = zlib.crc32(entries) & 0xffffffff
+
+        disk_guid = uuid.uuid4().bytes_le
+        last = self.sectors - 1
+        mbr = "\0" * 446
+        mbr += _msdos_entry(0, 0xee, 1, min(last, 0xffffffff))
+        mbr += "\0" * 48 + "\x55\xaa"
+
+        return [(0, mbr),
+                (1, self.__gpt_header(1, last, 2, disk_guid, entries_crc)),
+                (2, entries),
+                (last - GPT_SECTORS + 1, entries),
+                (last, self.__gpt_header(last, 1, last - GPT_SECTORS + 1,
+                                         disk_guid, entries_crc))]
+
+    def place(self):
+        """Work out the sectors of every partition without writing
+        anything. Returns the (lba, data) pairs write() would write."""
+        if self.layout == 'gpt':
+            return self.__gpt()
+        return self.__msdos()
+
+    def write(self, path):
+        """Write the partition table to path, a disk image or device."""
+        writes = self.place()
+
+        try:
+            fd = os.open(path, os.O_WRONLY)
+        except OSError, e:
+            raise MountError("Unable to open %s to write partition table: %s" % (path, e))
+        try:
+            try:
+                for (lba, data) in writes:
+                    os.lseek(fd, lba * SECTOR_SIZE, 0)
+                    if os.write(fd, data) != len(data):
+                        raise MountError("Short write of partition table on %s" % path)
+                os.fsync(fd)
+            except OSError, e:
+                raise MountError("Error writing partition table on %s: %s" % (path, e))
+        finally:
+            os.close(fd)
+        logging.debug("Wrote %s partition table with %d partitions to %s" %
+                      (self.layout, len(self.partitions), path))
+
+
+def open_partition_table(path, layout):
+    """Returns an empty PartitionTable sized for the disk at path."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return PartitionTable(layout, _disk_sectors(fd))
+    finally:
+        os.close(fd)
+
+def set_bootable(path, num):
+    """Mark partition num of an existing table on path as bootable: the
+    active flag for msdos (primary or logical), the legacy BIOS bootable
+    attribute for gpt."""
+    fd = os.open(path, os.O_RDWR)
+    try:
+        os.lseek(fd, SECTOR_SIZE, 0)
+        if os.read(fd, 8) == "EFI PART":
+            _gpt_set_bootable(fd, num)
+        else:
+            _msdos_set_bootable(fd, num)
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+def _msdos_set_bootable(fd, num):
+    os.lseek(fd, 0, 0)
+    mbr = os.read(fd, SECTOR_SIZE)
+    if mbr[510:] != "\x55\xaa":
+        raise MountError("No msdos partition table found")
+    if num <= 4:
+        os.lseek(fd, 446 + (num - 1) * 16, 0)
+        os.write(fd, chr(MSDOS_ACTIVE))
+        return
+
+    ext_start = None
+    for i in range(4):
+        entry = mbr[446 + i * 16:462 + i * 16]
+        if ord(entry[4]) in MSDOS_EXTENDED_TYPES:
+            ext_start = struct.unpack("<I", entry[8:12])[0]
+    if ext_start is None:
+        raise MountError("No extended partition holding partition %d" % num)
+
+    ebr = ext_start
+    for n in range(5, num):
+        os.lseek(fd, ebr * SECTOR_SIZE + 446 + 16, 0)
+        link = struct.unpack("<I", os.read(fd, 16)[8:12])[0]
+        if link == 0:
+            raise MountError("No logical partition %d" % num)
+        ebr = ext_start + link
+    os.lseek(fd, ebr * SECTOR_SIZE + 446, 0)
+    os.write(fd, chr(MSDOS_ACTIVE))
+
+def _gpt_set_bootable(fd, num):
+    fmt = "<8sIIIIQQQQ16sQIII"
+    os.lseek(fd, SECTOR_SIZE, 0)
+    primary = list(struct.unpack(fmt, os.read(fd, 92)))
+    os.lseek(fd, primary[6] * SECTOR_SIZE, 0)
+    backup = list(struct.unpack(fmt, os.read(fd, 92)))
+    if backup[0] != "EFI PART":
+        raise MountError("No backup gpt header found")
+    (nentries, entsize) = (primary[11], primary[12])
+    if num < 1 or num > nentries:
+        raise MountError("No gpt partition %d" % num)
+
+    os.lseek(fd, primary[10] * SECTOR_SIZE, 0)
+    entries = os.read(fd, nentries * entsize)
+    off = (num - 1) * entsize
+    attrs = struct.unpack("<Q", entries[off + 48:off + 56])[0] | GPT_LEGACY_BOOTABLE
+    entries = entries[:off + 48] + struct.pack("<Q", attrs) + entries[off + 56:]
+    entries_crc = zlib.crc32(entries) & 0xffffffff
+
+    # both copies get the new entries and a header with updated crcs
+    for f in (primary, backup):
+        (f[3], f[13]) = (0, entries_crc)
+        f[3] = zlib.crc32(struct.pack(fmt, *f)) & 0xffffffff
+        os.lseek(fd, f[10] * SECTOR_SIZE, 0)
+        os.write(fd, entries)
+        os.lseek(fd, f[5] * SECTOR_SIZE, 0)
+        os.write(fd, struct.pack(fmt, *f))
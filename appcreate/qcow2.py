@@ -0,0 +1,218 @@
+#
+# qcow2.py: parallel qcow2 writer for sparse raw disk images
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import zlib
+import struct
+import time
+import logging
+
+from imgcreate.errors import *
+from appcreate.parallel import parallel_imap, default_workers
+from appcreate.sparse import data_runs, read_chunks
+from appcreate.checksum import BUFFER_SIZE
+
+QCOW2_MAGIC = "QFI\xfb"
+QCOW2_VERSION = 3
+HEADER_LENGTH = 104
+
+CLUSTER_BITS = 16
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+SECTOR_SIZE = 512
+# 16 bit refcounts
+REFCOUNT_ORDER = 4
+REFCOUNTS_PER_BLOCK = CLUSTER_SIZE * 8 >> REFCOUNT_ORDER
+L2_ENTRIES = CLUSTER_SIZE / 8
+
+OFLAG_COPIED = 1 << 63
+OFLAG_COMPRESSED = 1 << 62
+# the number of additional sectors of a compressed cluster is stored
+# above its host offset
+CSIZE_SHIFT = 62 - (CLUSTER_BITS - 8)
+
+# qemu inflates compressed clusters with a 4k window
+DEFLATE_WBITS = -12
+
+# clusters handed to a worker at a time
+RUN_CLUSTERS = 32
+
+
+def _align(offset, alignment = CLUSTER_SIZE):
+    return (offset + alignment - 1) / alignment * alignment
+
+def _clusters(size):
+    return (size + CLUSTER_SIZE - 1) / CLUSTER_SIZE
+
+
+class Qcow2Writer(object):
+    """Writes a sparse raw disk image as a qcow2 (version 3) image.
+
+    Only the data extents of the raw image are read; clusters in holes
+    and clusters holding nothing but zeros are left unallocated. The
+    clusters are deflated, like qemu-img convert -c does, by a pool of
+    workers, and written in order, a cluster which does not shrink is
+    stored uncompressed. The L2 tables, the L1 table and the refcounts
+    are written after the data, the header last, so the raw image is
+    read once and the qcow2 image written once.
+
+    The header depends on where the data ends, so the image cannot be
+    checksummed front to back while it is written. Given a hasher,
+    write() hashes the header from memory and reads the rest of the
+    image back through the file it just wrote, while it is still in the
+    page cache and without scanning for holes.
+    """
+
+    def __init__(self, compress = True, workers = None, level = 6):
+        self.compress = compress
+        self.workers = workers or default_workers()
+        self.level = level
+
+    def __process(self, run):
+        (src, first, count) = run
+        clusters = []
+        for (index, buf) in read_chunks(src, first, count, CLUSTER_SIZE):
+            if self.compress:
+                c = zlib.compressobj(self.level, zlib.DEFLATED, DEFLATE_WBITS)
+                z = c.compress(buf) + c.flush()
+                if len(z) < CLUSTER_SIZE:
+                    clusters.append((index, z, True))
+                    continue
+            clusters.append((index, buf, False))
+        return clusters
+
+    def __hash(self, out, header, end, hasher):
+        hasher.update(header + "\0" * (CLUSTER_SIZE - len(header)))
+        out.seek(CLUSTER_SIZE)
+        pos = CLUSTER_SIZE
+        while pos < end:
+            buf = out.read(min(BUFFER_SIZE, end - pos))
+            if not buf:
+                raise CreatorError("Unexpected end of file hashing %s" % out.name)
+            hasher.update(buf)
+            pos += len(buf)
+
+    def write(self, src, dst, hasher = None):
+        """Write the raw image src to dst as a qcow2 image, feeding the
+        image to the MultiHasher hasher if one is given. Returns a dict
+        with the virtual size, the number of allocated clusters and the
+        size of the qcow2 image."""
+        start = time.time()
+        fd = os.open(src, os.O_RDONLY)
+        try:
+            size = _align(os.fstat(fd).st_size, SECTOR_SIZE)
+            runs = [(src, first, n) for (first, n) in
+                    data_runs(fd, size, CLUSTER_SIZE, RUN_CLUSTERS)]
+        finally:
+            os.close(fd)
+
+        out = open(dst, "w+b")
+        try:
+            l2_tables = {}
+            refcounts = { 0: 1 } # the header
+            pos = CLUSTER_SIZE
+            out.seek(pos)
+            allocated = 0
+            compressed = 0
+            for clusters in parallel_imap(self.__process, runs, self.workers):
+                for (index, buf, is_compressed) in clusters:
+                    if is_compressed:
+                        sectors = (pos + len(buf) - 1) / SECTOR_SIZE - pos / SECTOR_SIZE
+                        entry = OFLAG_COMPRESSED | (sectors << CSIZE_SHIFT) | pos
+                        end = pos / SECTOR_SIZE * SECTOR_SIZE + (sectors + 1) * SECTOR_SIZE
+                        for c in range(pos / CLUSTER_SIZE, (end - 1) / CLUSTER_SIZE + 1):
+                            refcounts[c] = refcounts.get(c, 0) + 1
+                        compressed += 1
+                    else:
+                        if pos % CLUSTER_SIZE:
+                            pos = _align(pos)
+                            out.seek(pos)
+                        entry = OFLAG_COPIED | pos
+                        refcounts[pos / CLUSTER_SIZE] = 1
+                    out.write(buf)
+                    pos += len(buf)
+                    allocated += 1
+                    (l1_index, l2_index) = divmod(index, L2_ENTRIES)
+                    if not l2_tables.has_key(l1_index):
+                        l2_tables[l1_index] = [0] * L2_ENTRIES
+                    l2_tables[l1_index][l2_index] = entry
+
+            pos = _align(pos)
+            l1_size = (_clusters(size) + L2_ENTRIES - 1) / L2_ENTRIES
+            l1 = [0] * l1_size
+            for l1_index in sorted(l2_tables.keys()):
+                out.seek(pos)
+                out.write(struct.pack(">%dQ" % L2_ENTRIES, *l2_tables[l1_index]))
+                refcounts[pos / CLUSTER_SIZE] = 1
+                l1[l1_index] = OFLAG_COPIED | pos
+                pos += CLUSTER_SIZE
+
+            l1_offset = pos
+            out.seek(pos)
+            out.write(struct.pack(">%dQ" % l1_size, *l1))
+            for n in range(max(1, _clusters(l1_size * 8))):
+                refcounts[pos / CLUSTER_SIZE] = 1
+                pos += CLUSTER_SIZE
+
+            # the refcount blocks have to cover themselves and the table
+            first = pos / CLUSTER_SIZE
+            blocks = 1
+            while True:
+                table_clusters = _clusters(blocks * 8)
+                needed = (first + table_clusters + blocks + REFCOUNTS_PER_BLOCK - 1) / REFCOUNTS_PER_BLOCK
+                if needed <= blocks:
+                    break
+                blocks = needed
+            table_offset = pos
+            for n in range(first, first + table_clusters + blocks):
+                refcounts[n] = 1
+            table = []
+            for b in range(blocks):
+                block_offset = (first + table_clusters + b) * CLUSTER_SIZE
+                table.append(block_offset)
+                base = b * REFCOUNTS_PER_BLOCK
+                out.seek(block_offset)
+                out.write(struct.pack(">%dH" % REFCOUNTS_PER_BLOCK,
+                                      *[refcounts.get(base + n, 0)
+                                        for n in range(REFCOUNTS_PER_BLOCK)]))
+            out.seek(table_offset)
+            out.write(struct.pack(">%dQ" % len(table), *table))
+            end = (first + table_clusters + blocks) * CLUSTER_SIZE
+
+            header = struct.pack(">4sIQIIQIIQQIIQQQQII", QCOW2_MAGIC, QCOW2_VERSION,
+                                 0, 0, CLUSTER_BITS, size, 0, l1_size, l1_offset,
+                                 table_offset, table_clusters, 0, 0,
+                                 0, 0, 0, REFCOUNT_ORDER, HEADER_LENGTH)
+            # no header extensions, just the end marker
+            header += struct.pack(">II", 0, 0)
+            out.seek(0)
+            out.write(header)
+            out.truncate(end)
+            if hasher is not None:
+                self.__hash(out, header, end, hasher)
+        except (IOError, OSError), e:
+            raise CreatorError("Error writing qcow2 image %s: %s" % (dst, e))
+        finally:
+            out.close()
+
+        logging.info("Wrote %s: %d of %d clusters allocated, %d compressed, %d MB in %.1fs" %
+                     (dst, allocated, _clusters(size), compressed, end / 1024 / 1024,
+                      time.time() - start))
+        return { "virtual_size": size,
+                 "clusters": allocated,
+                 "compressed": compressed,
+                 "size": end }
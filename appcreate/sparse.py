@@ -0,0 +1,226 @@
+#
+# sparse.py: helpers for working with sparse disk image files
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import errno
+import ctypes
+import ctypes.util
+
+# Not exported by the os module before python 3.3, values are from
+# linux/fs.h
+SEEK_DATA = getattr(os, "SEEK_DATA", 3)
+SEEK_HOLE = getattr(os, "SEEK_HOLE", 4)
+# from linux/falloc.h
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+
+_libc = None
+
+
+def extents(fd, size = None, start = 0):
+    """Yields (offset, length, is_data) tuples covering a whole file, or
+    the part of it from start to size.
+
+    Holes are found with SEEK_DATA/SEEK_HOLE. On filesystems which do not
+    support them the whole file is reported as a single data extent.
+    """
+    if size is None:
+        size = os.fstat(fd).st_size
+    offset = start
+    while offset < size:
+        try:
+            data = os.lseek(fd, offset, SEEK_DATA)
+        except OSError, e:
+            if e.errno == errno.ENXIO:
+                # nothing but hole up to the end of the file
+                yield (offset, size - offset, False)
+                return
+            if e.errno == errno.EINVAL:
+                yield (offset, size - offset, True)
+                return
+            raise
+        if data >= size:
+            yield (offset, size - offset, False)
+            return
+        if data > offset:
+            yield (offset, data - offset, False)
+        hole = min(os.lseek(fd, data, SEEK_HOLE), size)
+        yield (data, hole - data, True)
+        offset = hole
+
+def data_extents(path):
+    """Returns a list of (offset, length) for the allocated ranges of path."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        return [(o, l) for (o, l, is_data) in extents(fd) if is_data]
+    finally:
+        os.close(fd)
+
+def allocated_size(path):
+    """Returns the number of bytes of path which are not holes."""
+    return sum([l for (o, l) in data_extents(path)])
+
+def splice(src, dst, offset, bufsize = 1024 * 1024):
+    """Copy the data extents of the file src into the file dst starting
+    at offset. The holes of src are skipped, so what dst holds there is
+    left alone. Returns the number of bytes copied."""
+    copied = 0
+    sfd = os.open(src, os.O_RDONLY)
+    try:
+        dfd = os.open(dst, os.O_WRONLY)
+        try:
+            for (start, length, is_data) in extents(sfd):
+                if not is_data:
+                    continue
+                os.lseek(sfd, start, 0)
+                os.lseek(dfd, offset + start, 0)
+                while length > 0:
+                    buf = os.read(sfd, min(bufsize, length))
+                    if not buf:
+                        break
+                    length -= len(buf)
+                    copied += len(buf)
+                    while buf:
+                        buf = buf[os.write(dfd, buf):]
+        finally:
+            os.close(dfd)
+    finally:
+        os.close(sfd)
+    return copied
+
+def extract(src, offset, length, dst, bufsize = 1024 * 1024):
+    """Copy length bytes of src at offset to the new sparse file dst,
+    only the data extents are copied. Returns the number of bytes
+    copied."""
+    copied = 0
+    sfd = os.open(src, os.O_RDONLY)
+    try:
+        dfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0644)
+        try:
+            os.ftruncate(dfd, length)
+            for (start, l, is_data) in extents(sfd, offset + length, offset):
+                if not is_data:
+                    continue
+                os.lseek(sfd, start, 0)
+                os.lseek(dfd, start - offset, 0)
+                while l > 0:
+                    buf = os.read(sfd, min(bufsize, l))
+                    if not buf:
+                        break
+                    l -= len(buf)
+                    copied += len(buf)
+                    while buf:
+                        buf = buf[os.write(dfd, buf):]
+        finally:
+            os.close(dfd)
+    finally:
+        os.close(sfd)
+    return copied
+
+def punch_hole(fd, offset, length):
+    """Turn length bytes of fd at offset into a hole. Where holes cannot
+    be punched the range is overwritten with zeros instead."""
+    global _libc
+    if length <= 0:
+        return
+    if _libc is None:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+    # the 64 bit offset variant on 32 bit hosts
+    fallocate = getattr(_libc, "fallocate64", None) or _libc.fallocate
+    rc = fallocate(fd, FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE,
+                         ctypes.c_int64(offset), ctypes.c_int64(length))
+    if rc == 0:
+        return
+    if not ctypes.get_errno() in (errno.EOPNOTSUPP, errno.ENOSYS):
+        raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()))
+    os.lseek(fd, offset, 0)
+    while length > 0:
+        length -= os.write(fd, "\0" * min(length, 1024 * 1024))
+
+def move(path, src, dst, length, bufsize = 1024 * 1024):
+    """Move length bytes of path from offset src down to offset dst.
+
+    Only the data extents are copied, the holes of the source range are
+    punched into the destination range, so the moved range stays as
+    sparse as it was. What is left of the source range beyond the end of
+    the destination range is not touched. Returns the number of bytes
+    copied."""
+    if dst > src:
+        raise ValueError("Can only move data towards the start of %s" % path)
+    copied = 0
+    fd = os.open(path, os.O_RDWR)
+    try:
+        # reads always run ahead of the writes, which end below them
+        for (offset, l, is_data) in list(extents(fd, src + length, src)):
+            if not is_data:
+                if src != dst:
+                    punch_hole(fd, offset - src + dst, l)
+                continue
+            if src == dst:
+                continue
+            pos = offset
+            while l > 0:
+                os.lseek(fd, pos, 0)
+                buf = os.read(fd, min(bufsize, l))
+                if not buf:
+                    break
+                os.lseek(fd, pos - src + dst, 0)
+                l -= len(buf)
+                pos += len(buf)
+                copied += len(buf)
+                while buf:
+                    buf = buf[os.write(fd, buf):]
+    finally:
+        os.close(fd)
+    return copied
+
+def data_runs(fd, size, chunk_size, count):
+    """Yields (first, n) runs of at most count chunk_size chunks covering
+    every chunk of the file which holds data."""
+    next_chunk = 0
+    for (offset, length, is_data) in extents(fd, size):
+        if not is_data:
+            continue
+        first = max(offset / chunk_size, next_chunk)
+        end = (offset + length + chunk_size - 1) / chunk_size
+        while first < end:
+            n = min(count, end - first)
+            yield (first, n)
+            first += n
+        next_chunk = max(next_chunk, end)
+
+def read_chunks(path, first, count, chunk_size):
+    """Returns (index, data) for the chunks first to first + count - 1 of
+    path which are not all zeros, the last one padded to chunk_size."""
+    f = open(path, "rb")
+    try:
+        f.seek(first * chunk_size)
+        data = f.read(count * chunk_size)
+    finally:
+        f.close()
+    zero = "\0" * chunk_size
+    chunks = []
+    for i in range(count):
+        buf = data[i * chunk_size:(i + 1) * chunk_size]
+        if not buf:
+            break
+        if len(buf) < chunk_size:
+            buf += "\0" * (chunk_size - len(buf))
+        if buf != zero:
+            chunks.append((first + i, buf))
+    return chunks
@@ -0,0 +1,144 @@
+#
+# state.py: persistent build state for resuming failed builds
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import shutil
+import tempfile
+import threading
+import logging
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+from imgcreate.errors import *
+
+STATE_FILE = "state.json"
+
+# top level build phases, in order
+PHASES = ["mount", "install", "configure", "unmount", "package"]
+
+
+class BuildState(object):
+    """The on disk record of a build which can be resumed after a failure.
+
+    A state directory holds the disk images of the build ("disks"), its
+    staging directory ("out") and state.json, which lists the completed
+    phases and steps together with whatever the creator needs to pick
+    the build up again (partition UUIDs, checksums, ...). state.json is
+    rewritten atomically every time a phase or step completes.
+    """
+
+    def __init__(self, path, data = None):
+        self.path = path
+        self.data = data or { "completed": [] }
+        self.__lock = threading.Lock()
+
+    def __get_build_id(self):
+        return os.path.basename(self.path)
+    build_id = property(__get_build_id)
+
+    def __get_disk_dir(self):
+        return os.path.join(self.path, "disks")
+    disk_dir = property(__get_disk_dir)
+
+    def __get_out_dir(self):
+        return os.path.join(self.path, "out")
+    out_dir = property(__get_out_dir)
+
+    def done(self, step):
+        """Returns True if step (a phase or a step inside one) completed."""
+        return step in self.data["completed"]
+
+    def needed(self, phase):
+        """Returns True if phase has to run to finish the build. The disks
+        have to be mounted again for every phase up to unmount."""
+        if phase == "mount":
+            return not self.done("unmount")
+        return not self.done(phase)
+
+    def resumable(self):
+        """A build can only be resumed once its packages are installed."""
+        return self.done("install")
+
+    def mark(self, step, **data):
+        """Record step as completed along with data, then save."""
+        self.__lock.acquire()
+        try:
+            self.data.update(data)
+            if not step in self.data["completed"]:
+                self.data["completed"].append(step)
+            self.__save()
+        finally:
+            self.__lock.release()
+
+    def update(self, **data):
+        self.__lock.acquire()
+        try:
+            self.data.update(data)
+            self.__save()
+        finally:
+            self.__lock.release()
+
+    def __save(self):
+        tmp = os.path.join(self.path, STATE_FILE + ".tmp")
+        f = open(tmp, "w")
+        try:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmp, os.path.join(self.path, STATE_FILE))
+
+    def remove(self):
+        logging.debug("Removing build state %s" % self.path)
+        shutil.rmtree(self.path, ignore_errors = True)
+
+
+def new_build_state(basedir, name):
+    """Create the state directory of a new build of appliance name."""
+    if not os.path.isdir(basedir):
+        os.makedirs(basedir)
+    path = tempfile.mkdtemp(prefix = name + "-", dir = basedir)
+    os.mkdir(os.path.join(path, "disks"))
+    os.mkdir(os.path.join(path, "out"))
+    state = BuildState(path, { "completed": [], "name": name })
+    state.update()
+    return state
+
+def load_build_state(basedir, build_id):
+    """Load the state of a build kept after it failed."""
+    path = os.path.join(basedir, build_id)
+    try:
+        f = open(os.path.join(path, STATE_FILE))
+    except IOError, e:
+        raise CreatorError("No build %s in %s : %s" % (build_id, basedir, e.strerror))
+    try:
+        try:
+            data = json.load(f)
+        except ValueError, e:
+            raise CreatorError("Corrupt state of build %s : %s" % (build_id, e))
+    finally:
+        f.close()
+    state = BuildState(path, data)
+    if not state.resumable():
+        raise CreatorError("Build %s failed before its packages were installed "
+                           "and cannot be resumed" % build_id)
+    return state
@@ -0,0 +1,185 @@
+#
+# stats.py: per phase timing and resource accounting of a build
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import sys
+import time
+import resource
+import threading
+import logging
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+STATS_VERSION = 1
+
+# /proc/self/io counters, storage level and syscall level
+IO_FIELDS = { "read_bytes": "read_bytes",
+              "write_bytes": "write_bytes",
+              "rchar": "read_chars",
+              "wchar": "write_chars" }
+
+
+def _read_io():
+    counters = dict([(k, 0) for k in IO_FIELDS.values()])
+    try:
+        f = open("/proc/self/io")
+        try:
+            for line in f:
+                (key, value) = line.split(":", 1)
+                if IO_FIELDS.has_key(key):
+                    counters[IO_FIELDS[key]] = int(value)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        pass
+    return counters
+
+def _sample():
+    """Returns the resource counters of this process and its reaped
+    children at this instant."""
+    me = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    sample = { "wall": time.time(),
+               "cpu_user": me.ru_utime + children.ru_utime,
+               "cpu_system": me.ru_stime + children.ru_stime,
+               # high water marks in KB, the largest single process
+               "peak_rss_kb": max(me.ru_maxrss, children.ru_maxrss) }
+    sample.update(_read_io())
+    return sample
+
+
+class _Phase(object):
+    def __init__(self, stats, name, info):
+        self.stats = stats
+        self.record = { "name": name, "phases": [] }
+        self.record.update(info)
+        self.parent = None
+        self.__start = None
+
+    def __enter__(self):
+        self.parent = self.stats._push(self)
+        self.__start = _sample()
+        return self
+
+    def __exit__(self, etype, evalue, etb):
+        end = _sample()
+        self.stats._pop(self)
+        r = self.record
+        r["start"] = round(self.__start["wall"] - self.stats.start_time, 3)
+        for key in end.keys():
+            if key != "peak_rss_kb":
+                r[key] = end[key] - self.__start[key]
+        r["wall"] = round(r["wall"], 3)
+        r["cpu_user"] = round(r["cpu_user"], 3)
+        r["cpu_system"] = round(r["cpu_system"], 3)
+        r["cpu"] = round(r["cpu_user"] + r["cpu_system"], 3)
+        r["peak_rss_kb"] = end["peak_rss_kb"]
+        r["ok"] = etype is None
+        if not r["phases"]:
+            del r["phases"]
+        logging.debug("%s took %.1fs wall, %.1fs cpu" % (r["name"], r["wall"], r["cpu"]))
+        return False
+
+
+class Stats(object):
+    """Collects wall time, cpu time, I/O and peak memory per build phase.
+
+    Phases are opened with "with stats.phase(name, key=value, ...):" and
+    nest; the keyword arguments are stored alongside the measurements.
+    Phases opened on a worker thread without an enclosing phase of its
+    own are attached to the innermost phase of the thread which created
+    the Stats, so concurrent sub-phases (one per partition, per disk
+    conversion, ...) show up under the step which started them.
+
+    CPU time and I/O include child processes once they are reaped, and
+    are process wide: the numbers of sub-phases running at the same time
+    overlap and add up to more than their parent. peak_rss_kb is the
+    high water mark of the largest single process at the end of a phase.
+    """
+
+    def __init__(self):
+        self.start_time = time.time()
+        self.__start = _sample()
+        self.__lock = threading.Lock()
+        self.__local = threading.local()
+        self.__local.stack = []
+        self.__main = self.__local.stack
+        self.phases = []
+
+    def phase(self, name, **info):
+        return _Phase(self, name, info)
+
+    def __stack(self):
+        if not hasattr(self.__local, "stack"):
+            self.__local.stack = []
+        return self.__local.stack
+
+    def _push(self, phase):
+        stack = self.__stack()
+        self.__lock.acquire()
+        try:
+            if stack:
+                parent = stack[-1]
+            elif self.__main:
+                parent = self.__main[-1]
+            else:
+                parent = None
+            if parent:
+                parent.record["phases"].append(phase.record)
+            else:
+                self.phases.append(phase.record)
+        finally:
+            self.__lock.release()
+        stack.append(phase)
+        return parent
+
+    def _pop(self, phase):
+        stack = self.__stack()
+        if phase in stack:
+            stack.remove(phase)
+
+    def report(self):
+        """Returns the collected measurements as a JSON serializable dict."""
+        end = _sample()
+        total = { "wall": round(end["wall"] - self.__start["wall"], 3),
+                  "cpu_user": round(end["cpu_user"] - self.__start["cpu_user"], 3),
+                  "cpu_system": round(end["cpu_system"] - self.__start["cpu_system"], 3),
+                  "peak_rss_kb": end["peak_rss_kb"] }
+        total["cpu"] = round(total["cpu_user"] + total["cpu_system"], 3)
+        for key in IO_FIELDS.values():
+            total[key] = end[key] - self.__start[key]
+        return { "version": STATS_VERSION,
+                 "started": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime(self.start_time)),
+                 "argv": sys.argv,
+                 "cpus": os.sysconf("SC_NPROCESSORS_ONLN"),
+                 "total": total,
+                 "phases": self.phases }
+
+    def write(self, path):
+        """Write the report to path as a JSON document."""
+        report = self.report()
+        f = open(path, "w")
+        try:
+            json.dump(report, f, indent=2, sort_keys=True)
+            f.write("\n")
+        finally:
+            f.close()
+        logging.info("Wrote build statistics to %s" % path)
@@ -0,0 +1,116 @@
+#
+# superblock.py: read filesystem identity straight from the superblock
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+"""Probe ext2/3/4, swap and vfat superblocks without blkid or e2label.
+
+probe() returns a dict with the 'type', 'uuid' and 'label' of the
+filesystem found in a device or image file at a byte offset, or None,
+plus the 'block_size' of ext filesystems.
+UUIDs are formatted the way blkid prints them, so they can be used as
+UUID=... in fstab and on the kernel command line.
+"""
+
+import os
+import struct
+import uuid
+
+EXT_MAGIC = 0xEF53
+EXT3_FEATURE_COMPAT_HAS_JOURNAL = 0x4
+EXT4_FEATURE_INCOMPAT = 0x40 | 0x80 | 0x200 # extents, 64bit, flex_bg
+SWAP_PAGE_SIZES = (4096, 8192, 16384, 65536)
+
+
+def _read(fd, offset, length):
+    os.lseek(fd, offset, 0)
+    return os.read(fd, length)
+
+def _label(raw):
+    return raw.split("\0")[0].strip()
+
+def _probe_ext(fd, offset):
+    sb = _read(fd, offset + 1024, 256)
+    if len(sb) < 256 or struct.unpack("<H", sb[56:58])[0] != EXT_MAGIC:
+        return None
+    (compat, incompat) = struct.unpack("<II", sb[92:100])
+    if incompat & EXT4_FEATURE_INCOMPAT:
+        fstype = "ext4"
+    elif compat & EXT3_FEATURE_COMPAT_HAS_JOURNAL:
+        fstype = "ext3"
+    else:
+        fstype = "ext2"
+    return { 'type': fstype,
+             'uuid': str(uuid.UUID(bytes=sb[104:120])),
+             'label': _label(sb[120:136]),
+             'block_size': 1024 << struct.unpack("<I", sb[24:28])[0] }
+
+def _probe_swap(fd, offset):
+    for pagesize in SWAP_PAGE_SIZES:
+        if _read(fd, offset + pagesize - 10, 10) == "SWAPSPACE2":
+            hdr = _read(fd, offset + 1024, 44)
+            return { 'type': "swap",
+                     'uuid': str(uuid.UUID(bytes=hdr[12:28])),
+                     'label': _label(hdr[28:44]) }
+    return None
+
+def _probe_vfat(fd, offset):
+    bs = _read(fd, offset, 512)
+    if len(bs) < 512 or bs[510:512] != "\x55\xaa":
+        return None
+    if bs[82:87] == "FAT32":
+        (idoff, labeloff) = (67, 71)
+    elif bs[54:57] == "FAT":
+        (idoff, labeloff) = (39, 43)
+    else:
+        return None
+    volid = struct.unpack("<I", bs[idoff:idoff+4])[0]
+    label = _label(bs[labeloff:labeloff+11])
+    if label == "NO NAME":
+        label = ""
+    return { 'type': "vfat",
+             'uuid': vfat_uuid(volid),
+             'label': label }
+
+def vfat_uuid(volid):
+    """Format a vfat volume id the way blkid does."""
+    return "%04X-%04X" % (volid >> 16, volid & 0xffff)
+
+def probe(path, offset = 0):
+    """Identify the filesystem on path at byte offset, or return None."""
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        for prober in (_probe_ext, _probe_swap, _probe_vfat):
+            info = prober(fd, offset)
+            if info:
+                return info
+    finally:
+        os.close(fd)
+    return None
+
+def new_uuid(fstype, seed = None):
+    """Returns a new UUID for a filesystem of fstype, formatted for it.
+
+    With a seed the UUID is derived from it, so rebuilding the same
+    appliance yields the same filesystem identities.
+    """
+    if seed is None:
+        u = uuid.uuid4()
+    else:
+        u = uuid.uuid5(uuid.NAMESPACE_OID, seed)
+    if fstype == "vfat":
+        return vfat_uuid(struct.unpack("<I", u.bytes[:4])[0])
+    return str(u)
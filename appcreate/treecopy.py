@@ -0,0 +1,292 @@
+#
+# treecopy.py: copy directory trees in parallel, cloning file data where possible
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import stat
+import time
+import errno
+import fcntl
+import ctypes
+import ctypes.util
+import logging
+
+from imgcreate.errors import *
+from appcreate.parallel import parallel_imap_unordered, default_workers
+from appcreate.sparse import extents
+
+# from linux/fs.h
+FICLONE = 0x40049409
+
+# errors meaning cloning or copy_file_range cannot work between the two
+# files, the data is copied some other way then
+_UNSUPPORTED = (errno.EXDEV, errno.EOPNOTSUPP, errno.EINVAL, errno.ENOTTY,
+                errno.ENOSYS, errno.EBADF, errno.EPERM)
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno = True)
+_copy_file_range = getattr(_libc, "copy_file_range", None)
+
+
+def _errno():
+    return ctypes.get_errno()
+
+def _oserror(path):
+    e = _errno()
+    return OSError(e, os.strerror(e), path)
+
+def _raise(e):
+    raise e
+
+def list_xattrs(path):
+    """Returns the names of the extended attributes of path, without
+    following symlinks."""
+    size = _libc.llistxattr(path, None, 0)
+    if size < 0:
+        if _errno() in (errno.ENOTSUP, errno.ENOSYS):
+            return []
+        raise _oserror(path)
+    buf = ctypes.create_string_buffer(size)
+    size = _libc.llistxattr(path, buf, size)
+    if size < 0:
+        raise _oserror(path)
+    return [name for name in buf.raw[:size].split("\0") if name]
+
+def get_xattr(path, name):
+    size = _libc.lgetxattr(path, name, None, 0)
+    if size < 0:
+        raise _oserror(path)
+    buf = ctypes.create_string_buffer(size)
+    size = _libc.lgetxattr(path, name, buf, size)
+    if size < 0:
+        raise _oserror(path)
+    return buf.raw[:size]
+
+def set_xattr(path, name, value):
+    if _libc.lsetxattr(path, name, value, len(value), 0) < 0:
+        raise _oserror(path)
+
+
+class TreeCopier(object):
+    """Copies a directory tree the way cp -a or rsync -aHAX do.
+
+    Owners, permissions, times, hardlinks, extended attributes (and so
+    ACLs, SELinux labels and file capabilities), device nodes, fifos,
+    sockets, symlinks and holes are kept. The tree is walked in the
+    calling thread, which creates the directories and special files,
+    while the data of the regular files is copied by a pool of workers.
+    A file is cloned (FICLONE) when source and target are on a
+    filesystem sharing extents between files, otherwise its data
+    extents are copied with copy_file_range, in the kernel, or read and
+    written where that is not possible either.
+    """
+
+    def __init__(self, workers = None, bufsize = 1024 * 1024):
+        self.workers = workers or default_workers()
+        self.bufsize = bufsize
+        self.clone = True
+        self.copy_range = _copy_file_range is not None
+
+    def __copy_data(self, sfd, dfd, size):
+        """Copy the data extents of sfd to dfd. Returns True when the
+        data was cloned."""
+        if self.clone:
+            try:
+                fcntl.ioctl(dfd, FICLONE, sfd)
+                return True
+            except IOError, e:
+                if not e.errno in _UNSUPPORTED:
+                    raise
+                # stays off once the filesystems were found not to share
+                # extents, to save the ioctl on every file
+                if e.errno in (errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY):
+                    self.clone = False
+        for (offset, length, is_data) in extents(sfd, size):
+            if not is_data:
+                continue
+            if self.copy_range:
+                done = self.__copy_range(sfd, dfd, offset, length)
+                offset += done
+                length -= done
+            os.lseek(sfd, offset, 0)
+            os.lseek(dfd, offset, 0)
+            while length > 0:
+                buf = os.read(sfd, min(self.bufsize, length))
+                if not buf:
+                    break
+                length -= len(buf)
+                while buf:
+                    buf = buf[os.write(dfd, buf):]
+        os.ftruncate(dfd, size)
+        return False
+
+    def __copy_range(self, sfd, dfd, offset, length):
+        """copy_file_range length bytes at offset, returns how many were
+        copied before it stopped or turned out not to work."""
+        done = 0
+        off_in = ctypes.c_int64(offset)
+        off_out = ctypes.c_int64(offset)
+        while done < length:
+            n = _copy_file_range(sfd, ctypes.byref(off_in), dfd, ctypes.byref(off_out),
+                                 ctypes.c_size_t(length - done), 0)
+            if n < 0:
+                if _errno() in _UNSUPPORTED:
+                    self.copy_range = False
+                    return done
+                raise _oserror("copy_file_range")
+            if n == 0:
+                break
+            done += n
+        return done
+
+    def __copy_metadata(self, path, st, src):
+        os.lchown(path, st.st_uid, st.st_gid)
+        if not stat.S_ISLNK(st.st_mode):
+            # after chown, which clears the setuid and setgid bits
+            os.chmod(path, stat.S_IMODE(st.st_mode))
+        # after chown too, which drops security.capability
+        for name in list_xattrs(src):
+            try:
+                set_xattr(path, name, get_xattr(src, name))
+            except OSError, e:
+                if e.errno == errno.ENODATA:
+                    continue
+                logging.warning("Unable to copy extended attribute %s of %s: %s" %
+                                (name, src, e.strerror))
+        if not stat.S_ISLNK(st.st_mode) and not stat.S_ISDIR(st.st_mode):
+            os.utime(path, (st.st_atime, st.st_mtime))
+
+    def __copy_file(self, job):
+        (src, dst, st) = job
+        sfd = os.open(src, os.O_RDONLY)
+        try:
+            dfd = os.open(dst, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+            try:
+                cloned = self.__copy_data(sfd, dfd, st.st_size)
+            finally:
+                os.close(dfd)
+        finally:
+            os.close(sfd)
+        self.__copy_metadata(dst, st, src)
+        return (st.st_size, cloned)
+
+    def __make_room(self, path, st):
+        """Remove what is in the way of creating path."""
+        try:
+            old = os.lstat(path)
+        except OSError:
+            return
+        if stat.S_ISDIR(old.st_mode) and stat.S_ISDIR(st.st_mode):
+            return
+        if stat.S_ISDIR(old.st_mode):
+            raise CreatorError("Unable to copy %s over the directory %s" % (path, path))
+        os.unlink(path)
+
+    def __walk(self, src, dst, counts, links, dirs):
+        """Create the directories, symlinks and special files and yield
+        a job for every regular file to copy."""
+        inodes = {}
+        # a directory which cannot be read must fail the copy, not be
+        # left out of it
+        for (dirpath, dirnames, filenames) in os.walk(src, onerror = _raise):
+            reldir = os.path.relpath(dirpath, src)
+            for name in sorted(dirnames + filenames):
+                s = os.path.join(dirpath, name)
+                d = os.path.normpath(os.path.join(dst, reldir, name))
+                st = os.lstat(s)
+                if st.st_nlink > 1 and not stat.S_ISDIR(st.st_mode):
+                    key = (st.st_dev, st.st_ino)
+                    if inodes.has_key(key):
+                        links.append((inodes[key], d, st))
+                        continue
+                    inodes[key] = d
+                self.__make_room(d, st)
+                if stat.S_ISDIR(st.st_mode):
+                    if not os.path.isdir(d):
+                        os.mkdir(d, 0700)
+                    self.__copy_metadata(d, st, s)
+                    dirs.append((d, st))
+                    counts['dirs'] += 1
+                elif stat.S_ISREG(st.st_mode):
+                    yield (s, d, st)
+                elif stat.S_ISLNK(st.st_mode):
+                    os.symlink(os.readlink(s), d)
+                    self.__copy_metadata(d, st, s)
+                    counts['special'] += 1
+                else:
+                    os.mknod(d, st.st_mode, st.st_rdev)
+                    self.__copy_metadata(d, st, s)
+                    counts['special'] += 1
+
+    def copy_file(self, src, dst):
+        """Copy the single file src to dst, cloning it where possible.
+        Returns True when the data was cloned."""
+        try:
+            (size, cloned) = self.__copy_file((src, dst, os.stat(src)))
+        except (IOError, OSError), e:
+            raise CreatorError("Unable to copy %s to %s: %s" % (src, dst, e))
+        return cloned
+
+    def copy(self, src, dst):
+        """Copy everything in the directory src, dotfiles included, into
+        the directory dst. Returns a dict of what was copied."""
+        start = time.time()
+        counts = { 'files': 0, 'bytes': 0, 'cloned': 0, 'dirs': 0,
+                   'special': 0, 'hardlinks': 0 }
+        links = []
+        dirs = []
+        try:
+            if not os.path.isdir(dst):
+                os.makedirs(dst)
+            jobs = self.__walk(src, dst, counts, links, dirs)
+            for (size, cloned) in parallel_imap_unordered(self.__copy_file, jobs, self.workers):
+                counts['files'] += 1
+                counts['bytes'] += size
+                if cloned:
+                    counts['cloned'] += 1
+            # every file linked to exists now
+            for (target, path, st) in links:
+                self.__make_room(path, st)
+                os.link(target, path)
+                counts['hardlinks'] += 1
+            # adding the entries changed the times of the directories
+            st = os.stat(src)
+            dirs.append((dst, st))
+            self.__copy_metadata(dst, st, src)
+            for (path, st) in reversed(dirs):
+                os.utime(path, (st.st_atime, st.st_mtime))
+        except (IOError, OSError), e:
+            raise CreatorError("Unable to copy %s to %s: %s" % (src, dst, e))
+
+        counts['seconds'] = time.time() - start
+        elapsed = max(counts['seconds'], 0.001)
+        logging.info("Copied %s to %s: %d files (%d cloned), %d MB, %d directories, "
+                     "%d hardlinks, %d other in %.1fs, %.0f files/s, %.1f MB/s" %
+                     (src, dst, counts['files'], counts['cloned'],
+                      counts['bytes'] / 1024 / 1024, counts['dirs'], counts['hardlinks'],
+                      counts['special'], counts['seconds'], counts['files'] / elapsed,
+                      counts['bytes'] / 1024.0 / 1024.0 / elapsed))
+        return counts
+
+
+def copy_tree(src, dst, workers = None):
+    """Copy the contents of the directory src into dst, see TreeCopier."""
+    return TreeCopier(workers).copy(src, dst)
+
+def copy_file(src, dst):
+    """Copy the file src to dst, sharing its blocks when the filesystem
+    can clone and keeping its holes otherwise. Returns True when cloned."""
+    return TreeCopier(1).copy_file(src, dst)
@@ -0,0 +1,177 @@
+#
+# vmdk.py: parallel streamOptimized vmdk writer for sparse raw disk images
+#
+# Copyright 2007-2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import zlib
+import struct
+import random
+import time
+import logging
+
+from imgcreate.errors import *
+from appcreate.parallel import parallel_imap, default_workers
+from appcreate.sparse import data_runs, read_chunks
+
+SECTOR_SIZE = 512
+VMDK_MAGIC = 0x564d444b # "KDMV"
+VMDK_VERSION = 3
+# valid newline detection, compressed grains, markers
+VMDK_FLAGS = 1 | (1 << 16) | (1 << 17)
+COMPRESSION_DEFLATE = 1
+GD_AT_END = 0xffffffffffffffffL
+
+GRAIN_SECTORS = 128
+GRAIN_SIZE = GRAIN_SECTORS * SECTOR_SIZE
+GT_ENTRIES = 512
+GT_SECTORS = GT_ENTRIES * 4 / SECTOR_SIZE
+DESCRIPTOR_OFFSET = 1
+DESCRIPTOR_SECTORS = 20
+# the header and descriptor fill the first grain
+OVERHEAD_SECTORS = GRAIN_SECTORS
+
+MARKER_EOS = 0
+MARKER_GT = 1
+MARKER_GD = 2
+MARKER_FOOTER = 3
+
+# grains handed to a worker at a time
+RUN_GRAINS = 32
+
+VMDK_FORMAT_URL = "http://www.vmware.com/interfaces/specifications/vmdk.html#streamOptimized"
+
+
+def _sectors(size):
+    return (size + SECTOR_SIZE - 1) / SECTOR_SIZE
+
+def _pad(data):
+    return data + "\0" * (-len(data) % SECTOR_SIZE)
+
+def _header(capacity, gd_offset):
+    return struct.pack("<IIIQQQQIQQQB4cH433x", VMDK_MAGIC, VMDK_VERSION, VMDK_FLAGS,
+                       capacity, GRAIN_SECTORS, DESCRIPTOR_OFFSET, DESCRIPTOR_SECTORS,
+                       GT_ENTRIES, 0, gd_offset, OVERHEAD_SECTORS, 0,
+                       "\n", " ", "\r", "\n", COMPRESSION_DEFLATE)
+
+def _marker(sectors, mtype):
+    return struct.pack("<QII496x", sectors, 0, mtype)
+
+def _descriptor(capacity, filename):
+    cylinders = min(capacity / (255 * 63), 65535)
+    desc = ""
+    desc += "# Disk DescriptorFile\n"
+    desc += "version=1\n"
+    desc += "CID=%08x\n" % random.getrandbits(32)
+    desc += "parentCID=ffffffff\n"
+    desc += "createType=\"streamOptimized\"\n"
+    desc += "\n"
+    desc += "# Extent description\n"
+    desc += "RW %d SPARSE \"%s\"\n" % (capacity, filename)
+    desc += "\n"
+    desc += "# The Disk Data Base\n"
+    desc += "#DDB\n"
+    desc += "\n"
+    desc += "ddb.virtualHWVersion = \"4\"\n"
+    desc += "ddb.geometry.cylinders = \"%d\"\n" % cylinders
+    desc += "ddb.geometry.heads = \"255\"\n"
+    desc += "ddb.geometry.sectors = \"63\"\n"
+    desc += "ddb.adapterType = \"lsilogic\"\n"
+    if len(desc) > DESCRIPTOR_SECTORS * SECTOR_SIZE:
+        raise CreatorError("vmdk descriptor of %s is too long" % filename)
+    return desc + "\0" * (DESCRIPTOR_SECTORS * SECTOR_SIZE - len(desc))
+
+
+class StreamVmdkWriter(object):
+    """Writes a sparse raw disk image as a streamOptimized vmdk.
+
+    A streamOptimized vmdk is written front to back without seeking, so
+    it can go straight into a tar stream. Only the data extents of the
+    raw image are read and all-zero grains are left out; the grains are
+    deflated by a pool of workers and written in order, followed by the
+    grain tables, the grain directory and the footer.
+    """
+
+    def __init__(self, workers = None, level = 6):
+        self.workers = workers or default_workers()
+        self.level = level
+
+    def __process(self, run):
+        (src, first, count) = run
+        return [(index, zlib.compress(buf, self.level))
+                for (index, buf) in read_chunks(src, first, count, GRAIN_SIZE)]
+
+    def capacity(self, src):
+        """Returns the capacity in bytes of the vmdk written for src."""
+        return _sectors(os.path.getsize(src)) * SECTOR_SIZE
+
+    def write(self, src, out, filename):
+        """Write the raw image src as a vmdk named filename to the file
+        object out, which is only ever written to. Returns the number of
+        bytes written."""
+        start = time.time()
+        fd = os.open(src, os.O_RDONLY)
+        try:
+            capacity = _sectors(os.fstat(fd).st_size)
+            runs = [(src, first, n) for (first, n) in
+                    data_runs(fd, capacity * SECTOR_SIZE, GRAIN_SIZE, RUN_GRAINS)]
+        finally:
+            os.close(fd)
+
+        try:
+            out.write(_header(capacity, GD_AT_END))
+            out.write(_descriptor(capacity, filename))
+            pos = DESCRIPTOR_OFFSET + DESCRIPTOR_SECTORS
+            out.write("\0" * (OVERHEAD_SECTORS - pos) * SECTOR_SIZE)
+            pos = OVERHEAD_SECTORS
+
+            grains = {}
+            for compressed in parallel_imap(self.__process, runs, self.workers):
+                for (index, z) in compressed:
+                    data = _pad(struct.pack("<QI", index * GRAIN_SECTORS, len(z)) + z)
+                    out.write(data)
+                    grains[index] = pos
+                    pos += len(data) / SECTOR_SIZE
+
+            tables = (capacity + GRAIN_SECTORS * GT_ENTRIES - 1) / (GRAIN_SECTORS * GT_ENTRIES)
+            directory = []
+            for t in range(tables):
+                out.write(_marker(GT_SECTORS, MARKER_GT))
+                pos += 1
+                directory.append(pos)
+                out.write(struct.pack("<%dI" % GT_ENTRIES,
+                                      *[grains.get(t * GT_ENTRIES + i, 0)
+                                        for i in range(GT_ENTRIES)]))
+                pos += GT_SECTORS
+
+            gd = _pad(struct.pack("<%dI" % len(directory), *directory))
+            out.write(_marker(len(gd) / SECTOR_SIZE, MARKER_GD))
+            pos += 1
+            gd_offset = pos
+            out.write(gd)
+            pos += len(gd) / SECTOR_SIZE
+
+            out.write(_marker(1, MARKER_FOOTER))
+            out.write(_header(capacity, gd_offset))
+            out.write(_marker(0, MARKER_EOS))
+            pos += 3
+        except (IOError, OSError), e:
+            raise CreatorError("Error writing vmdk %s: %s" % (filename, e))
+
+        logging.info("Wrote %s: %d of %d grains, %d MB in %.1fs" %
+                     (filename, len(grains), (capacity + GRAIN_SECTORS - 1) / GRAIN_SECTORS,
+                      pos * SECTOR_SIZE / 1024 / 1024, time.time() - start))
+        return pos * SECTOR_SIZE
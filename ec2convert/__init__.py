@@ -16,4 +16,5 @@
 
 
 from fs import *
+from artifacts import *
 from ec2config import *
\ No newline at end of file
@@ -0,0 +1,193 @@
+#
+# artifacts.py: cache of the files ec2-converter downloads
+#
+# Copyright 2008, Red Hat  Inc.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; version 2 of the License.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU Library General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program; if not, write to the Free Software
+# Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307, USA.
+
+import os
+import re
+import fcntl
+import shutil
+import hashlib
+import urllib2
+import logging
+
+from imgcreate.errors import *
+from appcreate.cache import ContentCache
+
+DEFAULT_CACHE = "/var/cache/ec2-converter"
+
+# the files put into every image: name, url and sha256, None to take
+# whatever the url serves the first time
+ARTIFACTS = {
+    "ec2-api-tools": ("http://s3.amazonaws.com/ec2-downloads/ec2-api-tools-1.2-9739.zip", None),
+    "ec2-ami-tools": ("http://s3.amazonaws.com/ec2-downloads/ec2-ami-tools.noarch.rpm", None),
+    "kernel-xen": ("http://kojipkgs.fedoraproject.org/packages/kernel-xen-2.6/2.6.21.7/2.fc8/i686/kernel-xen-2.6.21.7-2.fc8.i686.rpm", None),
+}
+
+def _url_key(url):
+    return "url-" + hashlib.sha256(url).hexdigest()
+
+
+class ArtifactCache(object):
+    """Downloads the artifacts once and keeps them in a ContentCache.
+
+    Every file is stored under the sha256 of its contents, and a second
+    entry per url records which digest the url served, so artifacts
+    without a pinned checksum are found offline too. A pinned checksum
+    is verified when the file is downloaded. The cache directory can be
+    shared by any number of conversions at once; a download lock per
+    url makes sure a file is only fetched by one of them.
+    """
+
+    def __init__(self, path = DEFAULT_CACHE, mirror = None, offline = False):
+        self.cache = ContentCache(path)
+        self.path = path
+        self.mirror = mirror
+        self.offline = offline
+        self.sources = dict(ARTIFACTS)
+        self.hits = 0
+        self.misses = 0
+        self.downloaded = 0
+
+    def set_source(self, name, url, sha256 = None):
+        if sha256 is not None and not re.match("[0-9a-f]{64}$", sha256):
+            raise CreatorError("Invalid sha256 checksum '%s' for %s" % (sha256, name))
+        self.sources[name] = (url, sha256)
+
+    def load_sources(self, path):
+        """Read the sources of the artifacts from path, a file with one
+        NAME URL [SHA256] per line."""
+        try:
+            f = open(path)
+        except IOError, e:
+            raise CreatorError("Unable to read %s: %s" % (path, e))
+        try:
+            lineno = 0
+            for line in f:
+                lineno += 1
+                fields = line.split()
+                if not fields or fields[0].startswith("#"):
+                    continue
+                if len(fields) not in (2, 3):
+                    raise CreatorError("%s:%d: expected NAME URL [SHA256]" % (path, lineno))
+                if not self.sources.has_key(fields[0]):
+                    raise CreatorError("%s:%d: unknown artifact %s, known are: %s" %
+                                       (path, lineno, fields[0],
+                                        ", ".join(sorted(self.sources.keys()))))
+                self.set_source(fields[0], fields[1], (fields[2:] or [None])[0])
+        finally:
+            f.close()
+
+    def url(self, name):
+        """Returns the url artifact name is fetched from."""
+        url = self.sources[name][0]
+        if self.mirror and url == ARTIFACTS[name][0]:
+            return self.mirror.rstrip("/") + "/" + os.path.basename(url)
+        return url
+
+    def __lookup(self, url, sha256):
+        if sha256 is not None:
+            return sha256
+        manifest = self.cache.manifest(_url_key(url))
+        if manifest is None:
+            return None
+        return manifest["info"]["sha256"]
+
+    def __download(self, name, url, sha256):
+        if self.offline:
+            raise CreatorError("%s is not cached and downloads are disabled, "
+                               "fetch it from %s first" % (name, url))
+        logging.info("Downloading %s from %s" % (name, url))
+        tmp = self.cache.mkdtemp()
+        path = os.path.join(tmp, os.path.basename(url))
+        h = hashlib.sha256()
+        try:
+            src = urllib2.urlopen(url)
+            try:
+                dst = open(path, "wb")
+                try:
+                    while True:
+                        buf = src.read(1024 * 1024)
+                        if not buf:
+                            break
+                        h.update(buf)
+                        dst.write(buf)
+                        self.downloaded += len(buf)
+                finally:
+                    dst.close()
+            finally:
+                src.close()
+        except (IOError, OSError, ValueError), e:
+            # ValueError is what urllib2 makes of a malformed url
+            shutil.rmtree(tmp, ignore_errors = True)
+            raise CreatorError("Unable to download %s from %s: %s" % (name, url, e))
+
+        digest = h.hexdigest()
+        try:
+            if sha256 is not None and digest != sha256:
+                raise CreatorError("Checksum mismatch for %s from %s: expected %s, got %s" %
+                                   (name, url, sha256, digest))
+            self.cache.store(digest, [path], { "name": name, "url": url }, move = True)
+        finally:
+            shutil.rmtree(tmp, ignore_errors = True)
+        # the url may serve something else than when it was last fetched
+        if self.__lookup(url, None) not in (None, digest):
+            self.cache.remove(_url_key(url))
+        self.cache.store(_url_key(url), [], { "url": url, "sha256": digest })
+        return digest
+
+    def fetch(self, name, destdir):
+        """Copy artifact name into destdir, downloading it unless it is
+        cached. Returns the path of the copy."""
+        (url, sha256) = self.sources[name]
+        url = self.url(name)
+
+        digest = self.__lookup(url, sha256)
+        if digest is not None:
+            restored = self.cache.restore(digest, destdir)
+            if restored:
+                self.hits += 1
+                logging.info("Cache hit for %s (%s)" % (name, digest[:12]))
+                return restored[0]
+
+        # concurrent conversions missing the same file wait for the
+        # first one to download it
+        fd = os.open(os.path.join(self.path, ".fetch-%s.lock" % _url_key(url)),
+                     os.O_RDWR | os.O_CREAT, 0644)
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        try:
+            digest = self.__lookup(url, sha256)
+            restored = None
+            if digest is not None:
+                restored = self.cache.restore(digest, destdir)
+            if restored:
+                self.hits += 1
+                logging.info("Cache hit for %s (%s)" % (name, digest[:12]))
+            else:
+                digest = self.__download(name, url, sha256)
+                self.misses += 1
+                logging.info("Cache miss for %s, stored as %s" % (name, digest[:12]))
+                restored = self.cache.restore(digest, destdir)
+                if not restored:
+                    raise CreatorError("%s vanished from the cache" % name)
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+        return restored[0]
+
+    def log_stats(self):
+        logging.info("Artifact cache %s: %d hits, %d misses, %d MB downloaded" %
+                     (self.path, self.hits, self.misses, self.downloaded / 1024 / 1024))
@@ -18,13 +18,27 @@
 import os
 import sys
 import logging
-import random
-import shutil
+import tempfile
 import ec2convert.rpmcheck as rpmcheck
 import ec2convert.fs as fs
+from ec2convert.artifacts import ArtifactCache
+from imgcreate.errors import CreatorError
     
 class EC2Config():
-    
+
+    def __init__(self, downloaddir = "/tmp", artifacts = None):
+        self.downloaddir = downloaddir
+        self.artifacts = artifacts or ArtifactCache()
+
+    def fetch(self, name):
+        """Returns the path of a copy of artifact name in downloaddir, or
+        None if it cannot be had."""
+        try:
+            return self.artifacts.fetch(name, self.downloaddir)
+        except CreatorError, e:
+            logging.error(str(e))
+            return None
+
     def makedev(self,tmpdir):
         os.popen("/sbin/MAKEDEV -d %s/dev -x console" % tmpdir)
         os.popen("/sbin/MAKEDEV -d %s/dev -x null" % tmpdir)
@@ -67,12 +81,7 @@ class EC2Config():
         ec2_rclocal += "if [ -e /mnt/openssh_id.pub ] ; then\n"
         ec2_rclocal += "cat /mnt/openssh_id.pub >> /root/.ssh/authorized_keys\n"
         ec2_rclocal += "chmod 600 /root/.ssh/authorized_keys\n"
-        ec2_rclocal += "fi\n\n"
-        ec2_rclocal += "# Update the EC2 AMI creation tools\n"
-        ec2_rclocal += "echo Updating ec2-ami-tools\n"
-        ec2_rclocal += "curl -o /tmp/ec2-ami-tools.noarch.rpm http://s3.amazonaws.com/ec2-downloads/ec2-ami-tools.noarch.rpm && \n"
-        ec2_rclocal += "rpm -Uvh /tmp/ec2-ami-tools.noarch.rpm && \n"
-        ec2_rclocal += "echo \" + Updated ec2-ami-tools\"\n"
+        ec2_rclocal += "fi\n"
         rclocal.writelines(ec2_rclocal)
         rclocal.close()    
         return True
@@ -122,12 +131,21 @@ class EC2Config():
         else:
             os.mkdir(tmpdir + "/home/ec2")
             
-        ec2td = os.system("curl -o /tmp/ec2-api-tools-1.2-9739.zip http://s3.amazonaws.com/ec2-downloads/ec2-api-tools-1.2-9739.zip")
-        if ec2td == 0:
-            os.system("unzip -qo /tmp/ec2-api-tools-1.2-9739.zip -d /home/ec2")
+        api_tools = self.fetch("ec2-api-tools")
+        if api_tools:
+            os.system("unzip -qo %s -d %s/home/ec2" % (api_tools,tmpdir))
         else:
             logging.error( "EC2 tools download error!")
             return False
+
+        # installed now from the cache instead of being fetched by
+        # rc.local on every boot
+        ami_tools = self.fetch("ec2-ami-tools")
+        if ami_tools:
+            os.system("rpm -Uvh --nodeps %s --root=%s" % (ami_tools,tmpdir))
+        else:
+            logging.error( "EC2 AMI tools download error!")
+            return False
             
         return True
             
@@ -135,9 +153,9 @@ class EC2Config():
     def kernel_modules(self,tmpdir):    
         logging.info("Configure image for accepting the EC2 kernel")
     
-        kd = os.system("curl -o /tmp/kernel-xen-2.6.21.7-2.fc8.i686.rpm http://kojipkgs.fedoraproject.org/packages/kernel-xen-2.6/2.6.21.7/2.fc8/i686/kernel-xen-2.6.21.7-2.fc8.i686.rpm")
-        if kd == 0:
-            os.system("rpm -ivh --nodeps /tmp/kernel-xen-2.6.21.7-2.fc8.i686.rpm --root=%s" % tmpdir)
+        kernel = self.fetch("kernel-xen")
+        if kernel:
+            os.system("rpm -ivh --nodeps %s --root=%s" % (kernel,tmpdir))
         else:
             logging.error("Kernel download error!")
             return False
@@ -145,38 +163,15 @@ class EC2Config():
         return True
 
 
-def convert(imagefile, inputtype, tmpdirectory, checkrpms, sshconfig, newimagepath):
-    tmpdir = tmpdirectory + "/ec2-convert-" + (''.join(random.sample('123567890abcdefghijklmnopqrstuvwxyz', 8)))
-    tmpimage = tmpdir + "-tmpimage"
-    newimage = tmpimage + "/ec2-diskimage.img"
-
-    if inputtype == "loopbackfs":
-        fsutil = fs.LoopbackFSImage()
-
-    elif inputtype == "diskimage":
-        fsutil = fs.LoopBackDiskImage()
-
-    elif options.inputtype == "directory":
-        fsutil = fs.DirectoryImage()
-       
-    else:
-        logging.error("No input type was provided")
-        return False
-
-    os.mkdir(tmpdir)
-    os.mkdir(tmpimage)
-
-    if inputtype =="diskimage" or inputtype == "loopbackfs":
-        logging.info("Copying %s to %s" % (imagefile,tmpimage))
-        shutil.copy(imagefile,newimage)
-
-    fsutil.setup_fs(imagefile,tmpdir)
-
+def configure(tmpdir, workdir, checkrpms, sshconfig, artifacts = None):
+    """Make the root mounted on tmpdir bootable on EC2, taking the
+    downloads from the artifacts cache into workdir. Returns False if a
+    step failed."""
     if checkrpms:
         if not rpmcheck.checkpkgs(tmpdir):
             return False 
 
-    config = EC2Config()
+    config = EC2Config(workdir, artifacts)
     # Each method returns TRUE if successful, or false if it failed
     # We catch false and return False if we failed.
     if not config.makedev(tmpdir):
@@ -198,11 +193,59 @@ def convert(imagefile, inputtype, tmpdirectory, checkrpms, sshconfig, newimagepa
         
     if not config.kernel_modules(tmpdir):
         return False
-        
-    fsutil.unmount(tmpdir)
 
-    shutil.move(newimage,newimagepath) 
-    
-    fsutil.cleanup(tmpdir)    
-    
+    return True
+
+
+def convert(imagefile, inputtype, tmpdirectory, checkrpms, sshconfig, newimagepath,
+            size = None, headroom_percent = fs.HEADROOM_PERCENT, headroom_mb = fs.HEADROOM_MB,
+            jobs = None, artifacts = None):
+    if artifacts is None:
+        artifacts = ArtifactCache()
+
+    if inputtype == "loopbackfs":
+        fsutil = fs.LoopbackFSImage()
+
+    elif inputtype == "diskimage":
+        fsutil = fs.LoopBackDiskImage(size, headroom_percent, headroom_mb)
+        fsutil.jobs = jobs
+
+    elif inputtype == "directory":
+        fsutil = fs.DirectoryImage(size, headroom_percent, headroom_mb)
+        fsutil.jobs = jobs
+       
+    else:
+        logging.error("No input type was provided")
+        return False
+
+    # everything of this conversion lives below its own directory, so
+    # concurrent conversions sharing tmpdirectory never collide
+    workdir = tempfile.mkdtemp(prefix = "ec2-convert-", dir = tmpdirectory)
+    tmpdir = workdir + "/root"
+    tmpimage = tmpdir + "-tmpimage"
+    newimage = tmpimage + "/ec2-diskimage.img"
+    os.mkdir(tmpdir)
+    os.mkdir(tmpimage)
+
+    try:
+        # a loopback filesystem is modified in place, so it is worked on in
+        # a copy and the input is left alone; the files of a disk image are
+        # copied into a new image by setup_fs, it needs no copy
+        if inputtype == "loopbackfs":
+            fs.clone_image(imagefile, newimage)
+            fsutil.setup_fs(newimage, tmpdir)
+        else:
+            fsutil.setup_fs(imagefile,tmpdir)
+
+        if not configure(tmpdir, workdir, checkrpms, sshconfig, artifacts):
+            return False
+
+        fsutil.unmount(tmpdir)
+
+        fs.move_image(newimage,newimagepath)
+    finally:
+        fsutil.unmount(tmpdir)
+        fs.remove_workdir(workdir)
+        artifacts.log_stats()
+
     return True
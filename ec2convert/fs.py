@@ -21,140 +21,284 @@ import logging
 import sys
 import shutil
 import time
- 
-class LoopBackDiskImage(): 
+import appcreate.superblock as superblock
+import appcreate.sparse as sparse
+from appcreate.treecopy import copy_tree, copy_file
+from appcreate.loop import attach_loop, detach_loop
+from imgcreate.errors import CreatorError
+
+# the new image holds what the input uses, plus this much in percent of
+# it and in MB as free space
+HEADROOM_PERCENT = 30
+HEADROOM_MB = 150
+
+
+def used_space(path):
+    """Returns the bytes used below path. For a mount point these come
+    from the block counts of its filesystem; any other directory has to
+    be walked, summing the blocks allocated to every inode once."""
+    if os.path.ismount(path):
+        st = os.statvfs(path)
+        return (st.f_blocks - st.f_bfree) * st.f_frsize
+    logging.info("%s is not a mount point, walking it to find its size" % path)
+    used = 0
+    seen = {}
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in dirnames + filenames:
+            st = os.lstat(os.path.join(dirpath, name))
+            if st.st_nlink > 1:
+                if seen.has_key((st.st_dev, st.st_ino)):
+                    continue
+                seen[(st.st_dev, st.st_ino)] = True
+            used += st.st_blocks * 512L
+    return used
+
+def image_size(used, headroom_percent = HEADROOM_PERCENT, headroom_mb = HEADROOM_MB):
+    """Returns the size in MB of an image holding used bytes."""
+    used_mb = (used + 1024 * 1024 - 1) / (1024 * 1024)
+    return int(used_mb + used_mb * headroom_percent / 100 + headroom_mb)
+
+def create_image(path, size_mb):
+    """Create an ext3 filesystem in the new sparse file path, size_mb
+    large. The file reads as zeros, so mke2fs is told not to zero the
+    inode tables and the journal and only writes its metadata. Its
+    discard punches holes into the file, which also lets it skip
+    zeroing what the lazy options leave out."""
+    logging.info("Creating a new disk image with additional freespace: %dM total" % size_mb)
+    f = open(path, "w")
+    try:
+        f.truncate(size_mb * 1024L * 1024L)
+    finally:
+        f.close()
+    rc = subprocess.call(["mke2fs", "-F", "-j", "-q",
+                          "-E", "lazy_itable_init=1,lazy_journal_init=1", path])
+    if rc != 0:
+        logging.error("Unable to create a filesystem on %s" % path)
+        sys.exit(1)
+
+
+def clone_image(src, dst):
+    """Copy the image src to dst without touching src, sharing its
+    blocks when the filesystem can and copying only its data otherwise."""
+    start = time.time()
+    try:
+        cloned = copy_file(src, dst)
+    except CreatorError, e:
+        logging.error(str(e))
+        sys.exit(1)
+    if cloned:
+        logging.info("Cloned %s to %s" % (src, dst))
+    else:
+        logging.info("Copied %s to %s, %dM of data in %.1fs" %
+                     (src, dst, sparse.allocated_size(dst) / 1024 / 1024,
+                      time.time() - start))
+
+
+def move_image(src, dst):
+    """Move the image src to dst, keeping its holes when dst is on
+    another filesystem."""
+    try:
+        os.rename(src, dst)
+        return
+    except OSError:
+        pass
+    clone_image(src, dst)
+    os.unlink(src)
+
+
+def conversion_space(imagefile, inputtype, size = None,
+                     headroom_percent = HEADROOM_PERCENT, headroom_mb = HEADROOM_MB):
+    """Returns the bytes the conversion of imagefile may take in the
+    temporary directory at most."""
+    if inputtype == "loopbackfs":
+        # the copy worked on, which may share its blocks with the input
+        return sparse.allocated_size(imagefile)
+    if size:
+        return size * 1024L * 1024L
+    if inputtype == "directory":
+        used = used_space(imagefile)
+    else:
+        # the partitions cannot use more than the disk has allocated
+        used = sparse.allocated_size(imagefile)
+    return image_size(used, headroom_percent, headroom_mb) * 1024L * 1024L
+
+def conversion_loops(inputtype):
+    """Returns the number of loop devices the conversion attaches."""
+    if inputtype == "diskimage":
+        # the input disk and the new image, the partitions are mounted
+        # from their device mapper devices
+        return 2
+    return 1
+
+def remove_workdir(workdir):
+    """Remove the temporary directory of a conversion, unless something
+    is still mounted below it."""
+    mounts = [line.split()[1] for line in open("/proc/mounts")]
+    busy = [m for m in mounts if m.startswith(workdir + "/")]
+    if busy:
+        logging.error("Not removing %s, %s is still mounted" % (workdir, busy[0]))
+        return
+    shutil.rmtree(workdir, ignore_errors = True)
+
+
+class LoopImage():
+    """An image mounted through a loop device which was allocated under
+    the host wide loop lock, so concurrent conversions never pick the
+    same device."""
+
+    def __init__(self):
+        self.device = None
+
+    def mount(self, image, mountpoint):
+        try:
+            self.device = attach_loop(image)
+        except CreatorError, e:
+            logging.error("%s, please review your loopback device settings and "
+                          "remove unneeded ones" % e)
+            sys.exit(1)
+        if subprocess.call(["/bin/mount", self.device, mountpoint]) != 0:
+            logging.error("Unable to mount %s on %s" % (image, mountpoint))
+            self.__detach()
+            sys.exit(1)
+
+    def __detach(self):
+        try:
+            detach_loop(self.device)
+        except CreatorError, e:
+            logging.error(str(e))
+        self.device = None
+
+    def unmount(self,tmpdir):
+        if self.device is None:
+            return
+        logging.debug("Unmounting directory %s" % tmpdir)
+        if subprocess.call(["/bin/umount", tmpdir]) != 0:
+            logging.error("Unable to unmount %s" % tmpdir)
+            return
+        self.__detach()
+
+
+class ImageSizing(LoopImage):
+    """How large the new image is made: size MB if given, otherwise
+    what the input uses plus headroom_percent and headroom_mb."""
+
+    def __init__(self, size = None, headroom_percent = HEADROOM_PERCENT, headroom_mb = HEADROOM_MB):
+        LoopImage.__init__(self)
+        self.size = size
+        self.headroom_percent = headroom_percent
+        self.headroom_mb = headroom_mb
+        # number of files copied at once, None for one per cpu
+        self.jobs = None
+
+    def copy_root(self, src, dst):
+        logging.info("Copying %s to the new root" % src)
+        try:
+            copy_tree(src, dst, self.jobs)
+        except CreatorError, e:
+            logging.error(str(e))
+            sys.exit(1)
+
+    def new_image_size(self, paths):
+        if self.size:
+            return self.size
+        used = 0
+        for path in paths:
+            used += used_space(path)
+        logging.info("Disk Space Required: %dM" % (used / 1024 / 1024))
+        return image_size(used, self.headroom_percent, self.headroom_mb)
+
+
+class LoopBackDiskImage(ImageSizing): 
+
+    def __partitions(self, loop_device):
+        kpartx = subprocess.Popen(["/sbin/kpartx", "-l", loop_device],
+                                  stdout=subprocess.PIPE)
+        out = kpartx.communicate()[0]
+        return [line.split()[0] for line in out.splitlines() if line.strip()]
 
     def setup_fs(self,imagefile,tmpdir):
-            loop_devices = [] 
             loop_partition_dict = {} 
             tmproot = tmpdir + "-tmproot"
             tmpimage = tmpdir + "-tmpimage"            
             
             logging.debug("TMPDIR: " + tmpdir)
-            free_loop_dev = os.popen("/sbin/losetup -f")
-            loop_device = free_loop_dev.read().strip()
-
-            if not loop_device:
+            # the input is only read from, its files are copied into
+            # a new image
+            try:
+                loop_device = attach_loop(imagefile, readonly = True)
+            except CreatorError, e:
+                logging.error("%s, please review your loopback device settings and "
+                              "remove unneeded ones" % e)
                 sys.exit(1)
-     
-            os.system("/sbin/losetup %s %s" % (loop_device,imagefile))
-            os.system("/sbin/kpartx -a %s" % loop_device)
-
-            loop_partitions = os.popen("/sbin/kpartx -lv %s|awk {'print $1'}" % loop_device)
-
-            for dev in loop_partitions:
-                dev = dev.strip()
-                label = os.popen("e2label /dev/mapper/%s 2>&1 " % dev)
-                label = label.read().strip()
-                if label.startswith("e2label"):
-                    logging.error("Unable to detect partition label on %s, continuing anyways, if %s is a swap partition, no action is needed" % (dev,dev))          
-                else:    
-                    loop_partition_dict[dev] = label  
-                    logging.debug( dev + " : " + label)
-
-            dev = loop_partition_dict.values()
-            dev.sort()
-            os.mkdir(tmproot) 
-
-            for value in dev:
-                for key in loop_partition_dict.keys():
-                    if (value == loop_partition_dict[key]):
-                        ld = os.popen("/sbin/losetup -f")
-                        loop_partition_device = ld.read().strip()
-                        if not loop_device:
-                            logging.error("Please review your loopback device settings and remove unneeded ones")
-                            sys.exit(1)
-                        os.system("mount -o loop /dev/mapper/%s %s%s" % (key,tmproot,value))
-            
-            tmp_disk_space = os.popen("du -s %s|awk {'print $1'}" % tmproot)
-            tmp_disk_space= int(tmp_disk_space.read()) / 1024
-            logging.info("Disk Space Required: %sM" % str(tmp_disk_space))
+            mounted = []
+            try:
+                os.system("/sbin/kpartx -r -a %s" % loop_device)
 
-            new_disk_space = int(tmp_disk_space + ((tmp_disk_space * 0.30) + 150))
+                for dev in self.__partitions(loop_device):
+                    info = superblock.probe("/dev/mapper/%s" % dev)
+                    if info is None or not info['type'].startswith("ext"):
+                        logging.error("Unable to detect partition label on %s, continuing anyways, if %s is a swap partition, no action is needed" % (dev,dev))          
+                    else:    
+                        label = info['label']
+                        loop_partition_dict[dev] = label  
+                        logging.debug( dev + " : " + label)
 
-            logging.info("\nCreating a new disk image with additional freespace: " + str(new_disk_space) + "M total")
-            create_disk = os.system("dd if=/dev/zero of=%s/ec2-diskimage.img bs=1M count=%s" % (tmpimage,new_disk_space))
-            os.system("mke2fs -Fj %s/ec2-diskimage.img" % tmpimage)
-            if not loop_device:
-                logging.error("Please review your loopback device settings and remove unneeded ones")
-                sys.exit(1)
-            os.system("mount -o loop %s/ec2-diskimage.img %s" % (tmpimage,tmpdir))
-            
-            logging.info("Performing rsync on all partitions to new root")
-            os.system("rsync -u -r -a  %s/* %s" % (tmproot,tmpdir))
+                dev = loop_partition_dict.values()
+                dev.sort()
+                os.mkdir(tmproot) 
+
+                for value in dev:
+                    for key in loop_partition_dict.keys():
+                        if (value == loop_partition_dict[key]):
+                            # the loop device is read-only, a journal that
+                            # still needs recovery cannot be replayed on it
+                            if os.system("mount -o ro /dev/mapper/%s %s%s" % (key,tmproot,value)) != 0 and \
+                               os.system("mount -o ro,noload /dev/mapper/%s %s%s" % (key,tmproot,value)) != 0:
+                                logging.error("Unable to mount partition %s" % value)
+                                sys.exit(1)
+                            mounted.append(value)
+
+                # every partition is mounted, their block counts add up
+                # to what the new image has to hold
+                new_disk_space = self.new_image_size([tmproot + value for value in dev])
+                create_image("%s/ec2-diskimage.img" % tmpimage, new_disk_space)
+                self.mount("%s/ec2-diskimage.img" % tmpimage, tmpdir)
 
-            dev.sort(reverse=True)
+                # the partitions are mounted into one tree, copied as a whole
+                self.copy_root(tmproot, tmpdir)
+            finally:
+                mounted.sort(reverse=True)
 
-            for value in dev:
-                logging.info("Unmounting %s%s" % (tmpdir,value))
-                os.system("umount %s%s" % (tmproot,value))
+                for value in mounted:
+                    logging.info("Unmounting %s%s" % (tmproot,value))
+                    os.system("umount %s%s" % (tmproot,value))
 
-            logging.info("Freeing loopdevices")
-            os.system("kpartx -d %s" % loop_device)
-            os.system("losetup -d %s" % loop_device)
+                logging.info("Freeing loopdevices")
+                os.system("kpartx -d %s" % loop_device)
+                try:
+                    detach_loop(loop_device)
+                except CreatorError, e:
+                    logging.error(str(e))
             return
         
-    def unmount(self,tmpdir):
-        logging.debug("Unmounting directory %s" % tmpdir)
-        os.system("/bin/umount %s" % tmpdir)
-        return
-    
-    def cleanup(self,tmpdir):
-        os.system("rm -rf %s/*" % tmpdir)
-        return
 
-class DirectoryImage(): 
+class DirectoryImage(ImageSizing): 
 
     def setup_fs(self,imagefile,tmpdir):
-            tmproot = tmpdir + "-tmproot"
             tmpimage = tmpdir + "-tmpimage"            
             
             logging.info("TMPDIR: " + tmpdir)
-            tmp_disk_space = os.popen("du -s %s|awk {'print $1'}" % imagefile)
-            tmp_disk_space= int(tmp_disk_space.read()) / 1024
-            logging.info("Disk Space Required: %sM" % str(tmp_disk_space))
-
-            new_disk_space = int(tmp_disk_space + ((tmp_disk_space * 0.30) + 150))
-
-            logging.info("Creating a new disk image with additional freespace: " + str(new_disk_space) + "M total")
-            create_disk = os.system("dd if=/dev/zero of=%s/ec2-diskimage.img bs=1M count=%s" % (tmpimage,new_disk_space))
-            os.system("mke2fs -Fj %s/ec2-diskimage.img" % tmpimage)
+            new_disk_space = self.new_image_size([imagefile])
+            create_image("%s/ec2-diskimage.img" % tmpimage, new_disk_space)
+            self.mount("%s/ec2-diskimage.img" % tmpimage, tmpdir)
 
-            free_loop_dev = os.popen("/sbin/losetup -f")
-            loop_device = free_loop_dev.read().strip()
-
-            if not loop_device:
-                logging.error("Please review your loopback device settings and remove unneeded ones")
-                sys.exit(1)
-
-            os.system("mount -o loop %s/ec2-diskimage.img %s" % (tmpimage,tmpdir))
-            
-            logging.info("Performing rsync on all partitions to new root")
-            os.system("rsync -u -r -a  %s/* %s" % (imagefile,tmpdir))
+            self.copy_root(imagefile, tmpdir)
             return
         
-    def unmount(self,tmpdir):
-        logging.debug("Unmounting directory %s" % tmpdir)
-        os.system("/bin/umount %s" % tmpdir)
-        return
-    
-    def cleanup(self,tmpdir):
-        os.system("rm -rf %s/*" % tmpdir)
-        return
 
-        
-class LoopbackFSImage():
+class LoopbackFSImage(LoopImage):
     
     def setup_fs(self,imagefile,tmpdir):
         logging.debug("Mounting %s to %s" % (imagefile,tmpdir))
-        os.system("/bin/mount -o loop %s %s" % (imagefile,tmpdir))
+        self.mount(imagefile, tmpdir)
         return
-    
-    def unmount(self,tmpdir):
-        logging.debug("Unmounting directory %s" % tmpdir)
-        os.system("/bin/umount %s" % tmpdir)
-        return
-    
-    def cleanup(self,tmpdir):
-        os.system("rm -rf %s/*" % tmpdir)
- 